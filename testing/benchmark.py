@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+import argparse
+import contextlib
+import copy
+import datetime
+import logging
+import os
+import platform
+import subprocess
+import sys
+import timeit
+
+import redis
+import simplejson as json
+
+from testing.fake_redis import FakeRedis
+from testing.synthetic import InProcessKairos
+from testing.synthetic import SyntheticKairos
+from tscached import app
+from tscached import utils
+from tscached.cache_calls import cold
+from tscached.kquery import KQuery
+from tscached.mts import MTS
+
+
+"""
+    Benchmarks for the cache engine, runnable offline on one box: no Redis, no KairosDB.
+    Redis is testing.fake_redis, Kairos is testing.synthetic answering in-process (memoized, so the
+    generator stays out of the timings). Micro-benchmarks cover the MTS operations; end-to-end ones drive
+    the Flask app through its hot, warm and cold paths. Results are written as JSON for comparison across
+    commits:
+        python -m testing.benchmark --output before.json
+        (change things)
+        python -m testing.benchmark --output after.json --compare before.json
+"""
+
+
+HOUR = 3600
+
+CASES = []  # list of Case
+
+
+class Case(object):
+    """ One benchmark: fn(*setup()) is timed; setup, if given, runs untimed before every repetition. """
+
+    def __init__(self, name, params, fn, setup=None, number=1):
+        self.name = name
+        self.params = params
+        self.fn = fn
+        self.setup = setup
+        self.number = number  # calls per repetition; only for functions that don't mutate their input
+
+    def label(self):
+        return '%s[%s]' % (self.name, ','.join(['%s=%s' % (k, self.params[k]) for k in sorted(self.params)]))
+
+
+def measure(case, repeat):
+    """ :return: dict, per-call timings of a case in milliseconds. """
+    args = case.setup() if case.setup else ()
+    case.fn(*args)  # warm-up: fills memos and caches, and fails fast if the case is broken.
+
+    samples = []
+    for _ in xrange(repeat):
+        args = case.setup() if case.setup else ()
+        started = timeit.default_timer()
+        for _ in xrange(case.number):
+            case.fn(*args)
+        samples.append((timeit.default_timer() - started) / case.number * 1000)
+    samples.sort()
+    return {
+        'name': case.name,
+        'params': case.params,
+        'label': case.label(),
+        'repeat': repeat,
+        'number': case.number,
+        'min_ms': round(samples[0], 4),
+        'median_ms': round(samples[len(samples) / 2], 4),
+        'mean_ms': round(sum(samples) / len(samples), 4),
+        'max_ms': round(samples[-1], 4),
+    }
+
+
+def points(count, start_ms=1500000000000, resolution=10000):
+    return [[start_ms + ndx * resolution, float(ndx % 97)] for ndx in xrange(count)]
+
+
+def make_mts(values, redis_client=None):
+    mts = MTS(redis_client)
+    mts.result = {'name': 'bench.metric', 'tags': {'host': ['host-000']}, 'group_by': [], 'values': values}
+    return mts
+
+
+def micro_cases(sizes):
+    for size in sizes:
+        new_points = 60
+        overlap = 5
+
+        def _setup_end(size=size):
+            old = points(size)
+            new = points(new_points, start_ms=old[-overlap][0])
+            return make_mts(old), make_mts(new)
+        CASES.append(Case('mts.merge_at_end', {'points': size}, lambda old, new: old.merge_at_end(new), _setup_end))
+
+        def _setup_beginning(size=size):
+            old = points(size, start_ms=1500000000000 + (new_points - overlap) * 10000)
+            new = points(new_points)
+            return make_mts(old), make_mts(new)
+        CASES.append(Case('mts.merge_at_beginning', {'points': size},
+                          lambda old, new: old.merge_at_beginning(new), _setup_beginning))
+
+        values = points(size)
+        start = datetime.datetime.fromtimestamp(values[size / 2][0] / 1000)
+        plain = make_mts(values)
+        CASES.append(Case('mts.efficient_trim', {'points': size},
+                          lambda plain=plain, start=start: plain.efficient_trim(start, None), number=10))
+        CASES.append(Case('mts.robust_trim', {'points': size},
+                          lambda plain=plain, start=start: list(plain.robust_trim(start, None)), number=10))
+
+        CASES.append(Case('mts.serialize', {'points': size}, lambda plain=plain: plain.serialize(), number=10))
+
+        for count in ([10, 100] if size <= 10000 else [10]):
+            cached = FakeRedis()
+            keys = []
+            for ndx in xrange(count):
+                key = 'tscached:mts:bench%d' % ndx
+                cached.set(key, json.dumps(make_mts(values).result))
+                keys.append(key)
+            CASES.append(Case('mts.from_cache', {'points': size, 'mts': count},
+                              lambda cached=cached, keys=keys: list(MTS.from_cache(keys, cached))))
+
+
+def request_payload(end_s, hours, group_by_host=True):
+    metric = {'name': 'bench.metric', 'tags': {},
+              'aggregators': [{'name': 'avg', 'align_sampling': True, 'sampling': {'value': 1, 'unit': 'minutes'}}]}
+    if group_by_host:
+        metric['group_by'] = [{'name': 'tag', 'tags': ['host']}]
+    return {'start_absolute': (end_s - hours * HOUR) * 1000, 'end_absolute': end_s * 1000, 'metrics': [metric]}
+
+
+@contextlib.contextmanager
+def patched(redis_client, kairos):
+    """ Point tscached at the fake Redis and the in-process Kairos. """
+    original_redis, original_post = redis.StrictRedis, utils.requests.post
+    redis.StrictRedis = lambda *args, **kwargs: redis_client
+    utils.requests.post = kairos
+    try:
+        yield
+    finally:
+        redis.StrictRedis, utils.requests.post = original_redis, original_post
+
+
+def rewind(redis_client, payload, seconds):
+    """ Make a cached KQuery (and its MTS) look `seconds` out of date, so the next request goes WARM. """
+    kquery = next(KQuery.from_request(copy.deepcopy(payload), redis_client))
+    cached = json.loads(redis_client.get(kquery.get_key()))
+    cached['last_add_data'] -= seconds
+    redis_client.set(kquery.get_key(), json.dumps(cached))
+    for mts_key in cached['mts_keys']:
+        result = json.loads(redis_client.get(mts_key))
+        result['values'] = [v for v in result['values'] if v[0] <= cached['last_add_data'] * 1000]
+        redis_client.set(mts_key, json.dumps(result))
+
+
+def earlier(payload, seconds):
+    """ The same request, starting a little earlier: fills the cache so that payload is fully inside it. """
+    payload = copy.deepcopy(payload)
+    payload['start_absolute'] -= seconds * 1000
+    return payload
+
+
+def flushed(redis_client):
+    redis_client.flushall()
+    return ()
+
+
+def snapshot(redis_client):
+    return copy.deepcopy(redis_client.data), copy.deepcopy(redis_client.expires)
+
+
+def restore(redis_client, state):
+    redis_client.data, redis_client.expires = copy.deepcopy(state[0]), copy.deepcopy(state[1])
+
+
+def end_to_end_cases(cardinalities, hours):
+    end_s = int(datetime.datetime.now().strftime('%s')) / 60 * 60
+    client = app.test_client()
+
+    def _post(payload, expected_mode):
+        response = client.post('/api/v1/datapoints/query', data=json.dumps(payload))
+        mode = response.headers.get('X-tscached-mode')
+        if response.status_code != 200 or mode != expected_mode:
+            message = 'Expected %s, got %d %s: %s' % (expected_mode, response.status_code, mode, response.data[:200])
+            raise AssertionError(message)
+        return response
+
+    config = app.config['tscached']
+    for cardinality in cardinalities:
+        kairos = InProcessKairos(SyntheticKairos(cardinality=cardinality, resolution=10000, gap_ratio=0.01))
+        payload = request_payload(end_s, hours)
+        params = {'series': cardinality, 'hours': hours}
+
+        fake = FakeRedis()
+
+        def _cold(fake=fake, kairos=kairos, payload=payload):
+            with patched(fake, kairos):
+                _post(payload, 'cold_miss')
+        CASES.append(Case('e2e.cold', params, _cold, setup=lambda fake=fake: flushed(fake)))
+
+        fake = FakeRedis()
+
+        def _cold_merge(fake=fake, kairos=kairos, payload=payload):
+            kquery = next(KQuery.from_request(copy.deepcopy(payload), fake))
+            kquery.get_key()  # as handle_query does, before the query picks up bookkeeping fields.
+            with patched(fake, kairos):
+                cold(config, fake, kquery, utils.populate_time_range(payload))
+        CASES.append(Case('cache_calls.cold', params, _cold_merge, setup=lambda fake=fake: flushed(fake)))
+
+        fake = FakeRedis()
+
+        def _hot(fake=fake, kairos=kairos, payload=payload):
+            with patched(fake, kairos):
+                _post(payload, 'hot')
+
+        def _hot_setup(fake=fake, kairos=kairos, payload=payload):
+            if not fake.data:
+                with patched(fake, kairos):
+                    _post(earlier(payload, 60), 'cold_miss')
+            return ()
+        CASES.append(Case('e2e.hot', params, _hot, setup=_hot_setup))
+
+        fake = FakeRedis()
+        state = []
+
+        def _warm(fake=fake, kairos=kairos, payload=payload):
+            with patched(fake, kairos):
+                _post(payload, 'warm_append')
+
+        def _warm_setup(fake=fake, kairos=kairos, payload=payload, state=state):
+            if not state:
+                with patched(fake, kairos):
+                    _post(earlier(payload, 60), 'cold_miss')
+                rewind(fake, payload, 300)
+                state.append(snapshot(fake))
+            restore(fake, state[0])
+            return ()
+        CASES.append(Case('e2e.warm', params, _warm, setup=_warm_setup))
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+    }
+
+
+def compare(results, baseline):
+    """ Print a table of median timings against a baseline run. """
+    before = dict((r['label'], r) for r in baseline['results'])
+    print '%-60s %12s %12s %8s' % ('benchmark', 'before ms', 'after ms', 'ratio')
+    for result in results:
+        old = before.get(result['label'])
+        if not old:
+            print '%-60s %12s %12.3f %8s' % (result['label'], '-', result['median_ms'], '-')
+            continue
+        ratio = result['median_ms'] / old['median_ms'] if old['median_ms'] else float('inf')
+        print '%-60s %12.3f %12.3f %7.2fx' % (result['label'], old['median_ms'], result['median_ms'], ratio)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the tscached cache engine.')
+    parser.add_argument('--output', help='write JSON results here (default: stdout)')
+    parser.add_argument('--compare', help='JSON results of an earlier run, to compare against')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=10, help='timed repetitions per benchmark')
+    parser.add_argument('--quick', action='store_true', help='smaller inputs, for a fast sanity run')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)  # logging I/O would swamp what we're measuring.
+    if args.quick:
+        micro_cases([1000])
+        end_to_end_cases([10], 1)
+    else:
+        micro_cases([1000, 10000, 100000])
+        end_to_end_cases([10, 100], 3)
+
+    results = []
+    for case in CASES:
+        if args.filter not in case.name:
+            continue
+        result = measure(case, args.repeat)
+        sys.stderr.write('%-60s median %10.3f ms\n' % (result['label'], result['median_ms']))
+        results.append(result)
+
+    report = {'environment': environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(results, json.loads(f.read()))
+
+
+if __name__ == '__main__':
+    main()
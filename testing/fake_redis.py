@@ -0,0 +1,277 @@
+import fnmatch
+import time
+
+
+"""
+    An in-process, dict-backed stand-in for redis.StrictRedis: just enough of it (strings, hashes, sets,
+    sorted sets, lists, expiry and pipelines) to run tscached end to end with no Redis server.
+    For benchmarks and simulations, where the point is to measure tscached rather than the network.
+    Not a faithful Redis; type errors and the like are not emulated.
+"""
+
+
+class FakeRedis(object):
+
+    def __init__(self, clock=time.time):
+        """ :param clock: callable returning the current unix time; lets simulations run faster than real time. """
+        self.clock = clock
+        self.data = {}
+        self.expires = {}  # key -> unix time it expires at
+
+    # housekeeping
+
+    def _alive(self, key):
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= self.clock():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def _get(self, key, default=None):
+        if self._alive(key):
+            return self.data[key]
+        return default
+
+    def _setdefault(self, key, empty):
+        if not self._alive(key):
+            self.data[key] = empty
+        return self.data[key]
+
+    def _cleanup(self, key):
+        if key in self.data and not self.data[key]:
+            self.delete(key)
+
+    def used_bytes(self):
+        """ Rough memory footprint: the size of every live key and value. """
+        total = 0
+        for key in list(self.data.keys()):
+            value = self._get(key)
+            if value is None:
+                continue
+            total += len(key)
+            if isinstance(value, str):
+                total += len(value)
+            elif isinstance(value, dict):
+                total += sum([len(str(k)) + len(str(v)) for k, v in value.iteritems()])
+            else:
+                total += sum([len(str(v)) for v in value])
+        return total
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def flushall(self):
+        self.data.clear()
+        self.expires.clear()
+        return True
+
+    # keys
+
+    def delete(self, *keys):
+        count = 0
+        for key in keys:
+            if self._alive(key):
+                count += 1
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return count
+
+    def exists(self, key):
+        return self._alive(key)
+
+    def expire(self, key, seconds):
+        if not self._alive(key):
+            return False
+        self.expires[key] = self.clock() + seconds
+        return True
+
+    def ttl(self, key):
+        if not self._alive(key):
+            return -2
+        if key not in self.expires:
+            return -1
+        return int(round(self.expires[key] - self.clock()))
+
+    def rename(self, src, dst):
+        if not self._alive(src):
+            raise KeyError(src)
+        self.delete(dst)
+        self.data[dst] = self.data.pop(src)
+        if src in self.expires:
+            self.expires[dst] = self.expires.pop(src)
+        return True
+
+    def scan_iter(self, match=None, count=None):
+        for key in list(self.data.keys()):
+            if self._alive(key) and (match is None or fnmatch.fnmatchcase(key, match)):
+                yield key
+
+    # strings
+
+    def get(self, key):
+        return self._get(key)
+
+    def set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        alive = self._alive(key)
+        if (nx and alive) or (xx and not alive):
+            return None
+        self.data[key] = str(value)
+        self.expires.pop(key, None)
+        if ex:
+            self.expires[key] = self.clock() + ex
+        elif px:
+            self.expires[key] = self.clock() + px / 1000.0
+        return True
+
+    # hashes
+
+    def hset(self, key, field, value):
+        fields = self._setdefault(key, {})
+        new = field not in fields
+        fields[field] = str(value)
+        return int(new)
+
+    def hmset(self, key, mapping):
+        fields = self._setdefault(key, {})
+        for field, value in mapping.iteritems():
+            fields[field] = str(value)
+        return True
+
+    def hget(self, key, field):
+        return self._get(key, {}).get(field)
+
+    def hmget(self, key, fields, *args):
+        if isinstance(fields, basestring):
+            fields = [fields]
+        values = self._get(key, {})
+        return [values.get(field) for field in list(fields) + list(args)]
+
+    def hgetall(self, key):
+        return dict(self._get(key, {}))
+
+    def hvals(self, key):
+        return self._get(key, {}).values()
+
+    def hlen(self, key):
+        return len(self._get(key, {}))
+
+    def hdel(self, key, *fields):
+        values = self._get(key, {})
+        count = 0
+        for field in fields:
+            if values.pop(field, None) is not None:
+                count += 1
+        self._cleanup(key)
+        return count
+
+    def hincrby(self, key, field, amount=1):
+        fields = self._setdefault(key, {})
+        fields[field] = str(int(fields.get(field, 0)) + amount)
+        return int(fields[field])
+
+    def hincrbyfloat(self, key, field, amount=1.0):
+        fields = self._setdefault(key, {})
+        fields[field] = repr(float(fields.get(field, 0)) + amount)
+        return float(fields[field])
+
+    # sets
+
+    def sadd(self, key, *members):
+        values = self._setdefault(key, set())
+        before = len(values)
+        values.update(members)
+        return len(values) - before
+
+    def smembers(self, key):
+        return set(self._get(key, set()))
+
+    def srem(self, key, *members):
+        values = self._get(key, set())
+        before = len(values)
+        values.difference_update(members)
+        count = before - len(values)
+        self._cleanup(key)
+        return count
+
+    def scard(self, key):
+        return len(self._get(key, set()))
+
+    # sorted sets. scores are kept, but lex ranges assume (as tscached does) that they are all equal.
+
+    def zadd(self, key, *args):
+        values = self._setdefault(key, {})
+        added = 0
+        for ndx in xrange(0, len(args), 2):
+            if args[ndx + 1] not in values:
+                added += 1
+            values[args[ndx + 1]] = float(args[ndx])
+        return added
+
+    def _lex_range(self, key, low, high):
+        def _above(member):
+            if low == '-':
+                return True
+            return member >= low[1:] if low[0] == '[' else member > low[1:]
+
+        def _below(member):
+            if high == '+':
+                return True
+            return member <= high[1:] if high[0] == '[' else member < high[1:]
+        return [m for m in sorted(self._get(key, {})) if _above(m) and _below(m)]
+
+    def zlexcount(self, key, low, high):
+        return len(self._lex_range(key, low, high))
+
+    def zrangebylex(self, key, low, high, start=None, num=None):
+        members = self._lex_range(key, low, high)
+        if start is not None and num is not None:
+            members = members[start:start + num]
+        return members
+
+    def zscan_iter(self, key, match=None, count=None):
+        for member, score in sorted(self._get(key, {}).items()):
+            if match is None or fnmatch.fnmatchcase(member, match):
+                yield member, score
+
+    # lists
+
+    def lpush(self, key, *values):
+        items = self._setdefault(key, [])
+        for value in values:
+            items.insert(0, str(value))
+        return len(items)
+
+    def ltrim(self, key, start, end):
+        items = self._get(key, [])
+        items[:] = items[start:(end + 1) if end != -1 else None]
+        self._cleanup(key)
+        return True
+
+    def lrange(self, key, start, end):
+        return list(self._get(key, [])[start:(end + 1) if end != -1 else None])
+
+    def llen(self, key):
+        return len(self._get(key, []))
+
+
+class FakePipeline(object):
+    """ Queues calls, runs them all on execute(). """
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __getattr__(self, name):
+        method = getattr(self.redis_client, name)
+
+        def _queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return _queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [method(*args, **kwargs) for method, args, kwargs in commands]
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+import argparse
+import BaseHTTPServer
+import random
+import SocketServer
+import threading
+import time
+import urlparse
+import zlib
+
+import simplejson as json
+
+from testing.synthetic import SyntheticKairos
+
+
+"""
+    A stand-in KairosDB, over HTTP, for load testing tscached without a Kairos cluster.
+    Datapoints come from testing.synthetic: deterministic, so tscached's merges can be checked against a
+    fresh query. Serves /api/v1/datapoints/query (and /tags), the metricnames, tagnames and tagvalues
+    metadata endpoints and the health check, with configurable latency and error injection.
+    GET /simulator/stats reports what was asked of it: requests, errors and datapoints served.
+        python -m testing.kairos_simulator --port 8080 --cardinality 50 --latency 20 --error-rate 0.01
+    then point tscached's kairosdb section at it, and drive tscached with testing.load_driver.
+"""
+
+
+class Simulator(object):
+    """ Everything but the HTTP: what to answer, how slowly, and how often to fail. """
+
+    def __init__(self, synthetic, metric_names, latency=0, latency_per_point=0, jitter=0, error_rate=0,
+                 timeout_rate=0, timeout=60, seed=0):
+        """ :param synthetic: testing.synthetic.SyntheticKairos
+            :param metric_names: list of str, what /api/v1/metricnames lists.
+            :param latency: float, ms added to every response.
+            :param latency_per_point: float, ms added per raw datapoint read, like a real backend's scan cost.
+            :param jitter: float, 0 to 1, latency varies by up to this fraction either way.
+            :param error_rate: float, 0 to 1, share of queries answered 500.
+            :param timeout_rate: float, 0 to 1, share of queries that hang for `timeout` seconds first.
+            :param timeout: float, seconds.
+            :param seed: int, for the random number generator; makes error injection repeatable.
+        """
+        self.synthetic = synthetic
+        self.metric_names = metric_names
+        self.latency = latency
+        self.latency_per_point = latency_per_point
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'queries': 0, 'errors': 0, 'timeouts': 0, 'datapoints': 0,
+                      'by_endpoint': {}}
+
+    def count(self, endpoint, **amounts):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['by_endpoint'][endpoint] = self.stats['by_endpoint'].get(endpoint, 0) + 1
+            for name, amount in amounts.iteritems():
+                self.stats[name] += amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, by_endpoint=dict(self.stats['by_endpoint']))
+
+    def roll(self):
+        with self.lock:
+            return self.random.random()
+
+    def delay(self, points=0):
+        """ Sleep as long as the configured latency says this response takes. """
+        ms = self.latency + self.latency_per_point * points
+        if self.jitter:
+            ms *= 1 + self.jitter * (2 * self.roll() - 1)
+        if ms > 0:
+            time.sleep(ms / 1000.0)
+
+    def inject_failure(self, endpoint):
+        """ :return: 2-tuple (int status, dict body) if this request should fail; else None. """
+        roll = self.roll()
+        if roll < self.timeout_rate:
+            self.count(endpoint, timeouts=1)
+            time.sleep(self.timeout)
+            return 500, {'errors': ['simulated timeout']}
+        if roll < self.timeout_rate + self.error_rate:
+            self.count(endpoint, errors=1)
+            return 500, {'errors': ['simulated failure']}
+        return None
+
+    def query(self, body):
+        """ :return: 2-tuple (int status, dict body). """
+        failure = self.inject_failure('query')
+        if failure:
+            return failure
+        response = self.synthetic.query(body)
+        points = sum([q['sample_size'] for q in response['queries']])
+        self.count('query', queries=len(body.get('metrics', [])), datapoints=points)
+        self.delay(points)
+        return 200, response
+
+    def tags_query(self, body):
+        failure = self.inject_failure('query_tags')
+        if failure:
+            return failure
+        self.count('query_tags', queries=len(body.get('metrics', [])))
+        self.delay()
+        return 200, self.synthetic.tags_query(body)
+
+    def metadata(self, name):
+        self.count(name)
+        self.delay()
+        if name == 'metricnames':
+            return 200, {'results': self.metric_names}
+        tags = self.synthetic.series(self.metric_names[0] if self.metric_names else '')
+        if name == 'tagnames':
+            return 200, {'results': sorted(set([tag for series in tags for tag in series]))}
+        return 200, {'results': sorted(set([value for series in tags for value in series.values()]))}
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    simulator = None  # set by serve()
+
+    def log_message(self, format, *args):
+        pass  # per-request logging would cost more than the requests.
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length) if length else ''
+        if self.headers.get('Content-Encoding') == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return data
+
+    def respond(self, status, body=None):
+        data = json.dumps(body) if body is not None else ''
+        headers = {'Content-Type': 'application/json'}
+        if data and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self, payload):
+        path = urlparse.urlparse(self.path).path.rstrip('/')
+        if path == '/api/v1/health/check':
+            return 204, None
+        if path == '/simulator/stats':
+            return 200, self.simulator.snapshot()
+        if path in ['/api/v1/metricnames', '/api/v1/tagnames', '/api/v1/tagvalues']:
+            return self.simulator.metadata(path.rsplit('/', 1)[1])
+        if path in ['/api/v1/datapoints/query', '/api/v1/datapoints/query/tags']:
+            try:
+                body = json.loads(payload)
+            except ValueError:
+                return 400, {'errors': ['Cannot parse query']}
+            if path.endswith('/tags'):
+                return self.simulator.tags_query(body)
+            return self.simulator.query(body)
+        return 404, {'errors': ['Not found: %s' % path]}
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query).get('query', [''])[0]
+        self.respond(*self.route(query))
+
+    def do_POST(self):
+        self.respond(*self.route(self.read_body()))
+
+
+class ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(simulator, host='127.0.0.1', port=8080):
+    """ Start serving on a background thread.
+        :return: ThreadedServer; call shutdown() on it to stop.
+    """
+    class SimulatorHandler(Handler):
+        pass
+    SimulatorHandler.simulator = simulator
+    server = ThreadedServer((host, port), SimulatorHandler)
+    thr = threading.Thread(target=server.serve_forever)
+    thr.daemon = True
+    thr.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='A simulated KairosDB, for load testing tscached.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--metrics', type=int, default=100, help='number of metric names to list')
+    parser.add_argument('--cardinality', type=int, default=10, help='series per metric name')
+    parser.add_argument('--resolution', type=int, default=10000, help='ms between raw datapoints')
+    parser.add_argument('--gap-ratio', type=float, default=0.0, help='share of raw datapoints missing')
+    parser.add_argument('--latency', type=float, default=0, help='ms added to every response')
+    parser.add_argument('--latency-per-point', type=float, default=0, help='ms added per datapoint read')
+    parser.add_argument('--jitter', type=float, default=0, help='latency varies by this fraction')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of queries answered 500')
+    parser.add_argument('--timeout-rate', type=float, default=0, help='share of queries that hang first')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds a hanging query hangs for')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    synthetic = SyntheticKairos(cardinality=args.cardinality, resolution=args.resolution, gap_ratio=args.gap_ratio)
+    simulator = Simulator(synthetic, ['sim.metric.%03d' % ndx for ndx in xrange(args.metrics)],
+                          latency=args.latency, latency_per_point=args.latency_per_point, jitter=args.jitter,
+                          error_rate=args.error_rate, timeout_rate=args.timeout_rate, timeout=args.timeout,
+                          seed=args.seed)
+    server = serve(simulator, args.host, args.port)
+    print 'Simulated KairosDB listening on http://%s:%d' % (args.host, args.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
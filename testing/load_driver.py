@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+import argparse
+import random
+import threading
+import time
+
+import requests
+import simplejson as json
+
+
+"""
+    Load for tscached, shaped like dashboards: each simulated user opens a dashboard, which fires one request
+    per panel, then refreshes it on the dashboard's interval, now and then switching dashboards or time range.
+    Reports throughput, latency percentiles and the mix of X-tscached-mode values (hence the hit ratio); with
+    --kairos pointing at testing.kairos_simulator, also how much work reached the backend.
+        python -m testing.load_driver --tscached http://localhost:8008 --kairos http://localhost:8080 \\
+            --users 20 --duration 300
+"""
+
+
+HIT_MODES = ['hot', 'hot_stale', 'hot_superset', 'degraded', 'negative']  # answered without asking Kairos
+TIME_RANGES = [{'value': 1, 'unit': 'hours'}, {'value': 6, 'unit': 'hours'}, {'value': 3, 'unit': 'hours'}]
+REFRESH_INTERVALS = [10, 30, 60]  # seconds
+
+
+def make_dashboards(count, metric_names, seed=0):
+    """ Deterministic dashboards: a few panels each, mixing plain, tag-filtered and grouped queries.
+        :return: list of dict, with keys panels (list of metric dicts) and refresh (int, seconds).
+    """
+    rand = random.Random(seed)
+    dashboards = []
+    for _ in xrange(count):
+        panels = []
+        for _ in xrange(rand.randint(2, 8)):
+            metric = {'name': rand.choice(metric_names),
+                      'aggregators': [{'name': rand.choice(['avg', 'max', 'sum']), 'align_sampling': True,
+                                       'sampling': {'value': rand.choice([1, 5]), 'unit': 'minutes'}}]}
+            shape = rand.random()
+            if shape < 0.3:
+                metric['group_by'] = [{'name': 'tag', 'tags': ['host']}]
+            elif shape < 0.5:
+                metric['tags'] = {'dc': ['dc-%d' % rand.randint(0, 2)]}
+                metric['group_by'] = [{'name': 'tag', 'tags': ['host']}]
+            panels.append(metric)
+        dashboards.append({'panels': panels, 'refresh': rand.choice(REFRESH_INTERVALS)})
+    return dashboards
+
+
+class Results(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []  # seconds
+        self.modes = {}
+        self.statuses = {}
+
+    def record(self, seconds, status, mode):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.modes[mode] = self.modes.get(mode, 0) + 1
+
+    def percentile(self, fraction):
+        ordered = sorted(self.latencies)
+        if not ordered:
+            return None
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+    def summary(self, elapsed):
+        requests_made = len(self.latencies)
+        hits = sum([self.modes.get(mode, 0) for mode in HIT_MODES])
+        return {
+            'requests': requests_made,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round(requests_made / elapsed, 3) if elapsed else None,
+            'latency_ms': dict((name, round(self.percentile(fraction) * 1000, 3) if requests_made else None)
+                               for name, fraction in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)]),
+            'statuses': self.statuses,
+            'modes': self.modes,
+            'hit_ratio': round(hits / float(requests_made), 4) if requests_made else None,
+        }
+
+
+def user(url, dashboards, results, deadline, speedup, seed):
+    """ One simulated user, until the deadline. """
+    rand = random.Random(seed)
+    session = requests.Session()
+    while time.time() < deadline:
+        dashboard = rand.choice(dashboards)
+        time_range = rand.choice(TIME_RANGES)
+        for _ in xrange(rand.randint(1, 10)):  # refreshes before moving on
+            for panel in dashboard['panels']:  # a browser would fire these concurrently; close enough.
+                payload = {'start_relative': time_range, 'metrics': [panel]}
+                started = time.time()
+                try:
+                    r = session.post(url + '/api/v1/datapoints/query', data=json.dumps(payload))
+                    status, mode = r.status_code, r.headers.get('X-tscached-mode', 'none')
+                except requests.exceptions.RequestException:
+                    status, mode = 'unreachable', 'none'
+                results.record(time.time() - started, status, mode)
+            pause = dashboard['refresh'] / float(speedup)
+            if time.time() + pause >= deadline:
+                return
+            time.sleep(pause)
+
+
+def kairos_stats(url):
+    try:
+        return requests.get(url + '/simulator/stats').json()
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive tscached with dashboard-shaped load.')
+    parser.add_argument('--tscached', default='http://localhost:8008', help='base URL of tscached')
+    parser.add_argument('--kairos', help='base URL of testing.kairos_simulator, to report backend load')
+    parser.add_argument('--users', type=int, default=10, help='concurrent simulated users')
+    parser.add_argument('--dashboards', type=int, default=20)
+    parser.add_argument('--metrics', type=int, default=100, help='metric names to draw panels from')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run for')
+    parser.add_argument('--speedup', type=float, default=1, help='divide dashboard refresh intervals by this')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON summary here (default: stdout)')
+    args = parser.parse_args()
+
+    metric_names = ['sim.metric.%03d' % ndx for ndx in xrange(args.metrics)]
+    dashboards = make_dashboards(args.dashboards, metric_names, args.seed)
+    results = Results()
+    before = kairos_stats(args.kairos) if args.kairos else None
+
+    started = time.time()
+    deadline = started + args.duration
+    threads = []
+    for ndx in xrange(args.users):
+        thr = threading.Thread(target=user, args=(args.tscached.rstrip('/'), dashboards, results, deadline,
+                                                  args.speedup, args.seed + ndx))
+        thr.daemon = True
+        thr.start()
+        threads.append(thr)
+    for thr in threads:
+        thr.join()
+
+    summary = results.summary(time.time() - started)
+    if before:
+        after = kairos_stats(args.kairos)
+        if after:
+            summary['kairos'] = dict((name, after[name] - before[name])
+                                     for name in ['requests', 'queries', 'errors', 'timeouts', 'datapoints'])
+    report = json.dumps(summary, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print report
+
+
+if __name__ == '__main__':
+    main()
@@ -27,6 +27,12 @@ class MockRedis():
         self.sadd_parms.append([key, element])
         return 1
 
+    def scan_iter(self, match=None):
+        return iter([])
+
+    def hgetall(self, key):
+        return {}
+
 
 class MockRedisPipeline():
 
@@ -44,3 +50,6 @@ class MockRedisPipeline():
     def get(self, key):
         self.pipe_get_parms.append([key])
         self.pipe_get_call_count += 1
+
+    def hincrbyfloat(self, key, field, value):
+        pass
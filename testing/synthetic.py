@@ -0,0 +1,196 @@
+import copy
+import math
+import time
+
+import simplejson as json
+
+from tscached.utils import SECONDS_IN_UNIT
+
+
+"""
+    Deterministic synthetic time series, answered the way KairosDB would answer /api/v1/datapoints/query.
+    Every metric name has `cardinality` series, tagged host=host-NNN and dc=dc-N. Raw datapoints sit on
+    multiples of `resolution` (ms); a stable fraction `gap_ratio` of them is missing. The value of a point
+    depends only on (metric, series, timestamp), so overlapping or chunked queries agree with each other,
+    exactly as tscached expects of Kairos.
+    Supported: start/end absolute and relative, tag filters, group_by tag, and sampling aggregators
+    (avg, sum, min, max, count, first, last) with align_start_time or align_sampling.
+"""
+
+
+AGGREGATORS = {
+    'avg': lambda values: sum(values) / float(len(values)),
+    'sum': sum,
+    'min': min,
+    'max': max,
+    'count': len,
+    'first': lambda values: values[0],
+    'last': lambda values: values[-1],
+}
+
+
+def unit_ms(value):
+    """ {'value': 5, 'unit': 'minutes'} -> 300000 """
+    return int(int(value['value']) * SECONDS_IN_UNIT[value['unit']] * 1000)
+
+
+def mix(*numbers):
+    """ A cheap, stable integer hash. """
+    h = 2166136261
+    for n in numbers:
+        h = ((h ^ (n & 0xffffffff)) * 16777619) & 0xffffffff
+    return h
+
+
+class SyntheticKairos(object):
+
+    def __init__(self, cardinality=10, resolution=10000, gap_ratio=0.0, datacenters=3, clock=time.time):
+        """ :param cardinality: int, series per metric name.
+            :param resolution: int, ms between raw datapoints.
+            :param gap_ratio: float, 0 to 1, share of raw datapoints that are missing.
+            :param datacenters: int, distinct values of the dc tag.
+            :param clock: callable returning the current unix time, for relative time ranges.
+        """
+        self.cardinality = cardinality
+        self.resolution = resolution
+        self.gap_ratio = gap_ratio
+        self.datacenters = datacenters
+        self.clock = clock
+
+    def series(self, name):
+        """ :return: list of dict, the tags of every series of this metric. """
+        return [{'host': 'host-%03d' % ndx, 'dc': 'dc-%d' % (ndx % self.datacenters)}
+                for ndx in xrange(self.cardinality)]
+
+    def value(self, name_hash, series_ndx, ts):
+        period = 3600000.0 * (1 + series_ndx % 5)
+        noise = mix(name_hash, series_ndx, ts) % 1000 / 100.0
+        return round(50 + 40 * math.sin(ts / period * 2 * math.pi) + noise, 3)
+
+    def datapoints(self, name, series_ndx, start_ms, end_ms):
+        """ Raw datapoints of one series, from start_ms to end_ms inclusive. """
+        name_hash = mix(*[ord(c) for c in name])
+        gap_cutoff = int(self.gap_ratio * 1000)
+        ts = start_ms + (-start_ms % self.resolution)
+        points = []
+        while ts <= end_ms:
+            if not gap_cutoff or mix(name_hash, series_ndx, ts, 7) % 1000 >= gap_cutoff:
+                points.append([ts, self.value(name_hash, series_ndx, ts)])
+            ts += self.resolution
+        return points
+
+    def time_range(self, body):
+        """ :return: 2-tuple of int, (start_ms, end_ms) asked for in a query body. """
+        now_ms = int(self.clock() * 1000)
+        if body.get('start_absolute'):
+            start_ms = int(body['start_absolute'])
+        else:
+            start_ms = now_ms - unit_ms(body['start_relative'])
+        if body.get('end_absolute'):
+            end_ms = int(body['end_absolute'])
+        elif body.get('end_relative'):
+            end_ms = now_ms - unit_ms(body['end_relative'])
+        else:
+            end_ms = now_ms
+        return start_ms, end_ms
+
+    def aggregate(self, points, aggregator, start_ms):
+        sampling = aggregator.get('sampling')
+        function = AGGREGATORS.get(aggregator.get('name'))
+        if not sampling or not function:
+            return points
+        width = unit_ms(sampling)
+        origin = start_ms if aggregator.get('align_start_time') else 0
+        buckets = {}
+        for ts, value in points:
+            buckets.setdefault(ts - (ts - origin) % width, []).append(value)
+        return [[ts, function(buckets[ts])] for ts in sorted(buckets)]
+
+    def metric_result(self, metric, start_ms, end_ms):
+        """ :return: dict, one member of the 'queries' list of a Kairos response. """
+        wanted = metric.get('tags', {}) or {}
+        grouped_by = []
+        for group in metric.get('group_by', []) or []:
+            if group.get('name') == 'tag':
+                grouped_by.extend(group.get('tags', []))
+
+        groups = {}  # tuple of grouped tag values -> list of series ndx
+        all_series = self.series(metric['name'])
+        for ndx, tags in enumerate(all_series):
+            if any(tags.get(tag) not in values for tag, values in wanted.iteritems()):
+                continue
+            groups.setdefault(tuple([tags.get(tag) for tag in grouped_by]), []).append(ndx)
+
+        results = []
+        sample_size = 0
+        for group_key in sorted(groups):
+            members = groups[group_key]
+            points = []
+            for ndx in members:
+                points.extend(self.datapoints(metric['name'], ndx, start_ms, end_ms))
+            sample_size += len(points)
+            points.sort(key=lambda p: p[0])
+            for aggregator in metric.get('aggregators', []) or []:
+                points = self.aggregate(points, aggregator, start_ms)
+
+            tags = {}
+            for ndx in members:
+                for tag, value in all_series[ndx].iteritems():
+                    tags.setdefault(tag, set()).add(value)
+            group_by = [{'name': 'type', 'type': 'number'}]
+            if grouped_by:
+                group_by.insert(0, {'name': 'tag', 'tags': grouped_by, 'group': dict(zip(grouped_by, group_key))})
+            results.append({'name': metric['name'], 'group_by': group_by,
+                            'tags': dict((k, sorted(v)) for k, v in tags.iteritems()), 'values': points})
+
+        if not results:  # Kairos hands back an empty result rather than none at all.
+            results = [{'name': metric['name'], 'group_by': [], 'tags': {}, 'values': []}]
+        return {'sample_size': sample_size, 'results': results}
+
+    def tags_result(self, metric):
+        """ :return: dict, one member of the 'queries' list of a query/tags response. """
+        wanted = metric.get('tags', {}) or {}
+        tags = {}
+        for series_tags in self.series(metric['name']):
+            if any(series_tags.get(tag) not in values for tag, values in wanted.iteritems()):
+                continue
+            for tag, value in series_tags.iteritems():
+                tags.setdefault(tag, set()).add(value)
+        return {'results': [{'name': metric['name'], 'tags': dict((k, sorted(v)) for k, v in tags.iteritems()),
+                             'values': []}]}
+
+    def tags_query(self, body):
+        """ Answer a /api/v1/datapoints/query/tags request body (dict). """
+        return {'queries': [self.tags_result(metric) for metric in body.get('metrics', [])]}
+
+    def query(self, body):
+        """ Answer a /api/v1/datapoints/query request body (dict). """
+        start_ms, end_ms = self.time_range(body)
+        return {'queries': [self.metric_result(metric, start_ms, end_ms) for metric in body.get('metrics', [])]}
+
+
+class FakeResponse(object):
+    """ The parts of requests.Response that tscached reads. """
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.content = body
+        self.text = body
+
+
+class InProcessKairos(object):
+    """ Drop-in for requests.post, answering Kairos queries from a SyntheticKairos. Responses are memoized,
+        so repeated benchmark iterations time tscached rather than the generator.
+    """
+
+    def __init__(self, synthetic):
+        self.synthetic = synthetic
+        self.memo = {}
+        self.requests = 0
+
+    def __call__(self, url, data=None, headers=None, **kwargs):
+        self.requests += 1
+        if data not in self.memo:
+            body = json.loads(data)
+            self.memo[data] = json.dumps(self.synthetic.query(copy.deepcopy(body)))
+        return FakeResponse(200, self.memo[data])
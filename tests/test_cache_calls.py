@@ -1,11 +1,16 @@
 
+import datetime
+
 from freezegun import freeze_time
 import mock
+import pytest
 
 from tscached import cache_calls
 from tscached.kquery import KQuery
 from testing.mock_redis import MockRedis
 from tscached.mts import MTS
+from tscached.utils import BackendQueryFailure
+from tscached.utils import FETCH_AFTER
 
 
 @freeze_time("2016-01-01 20:00:00", tz_offset=-8)
@@ -33,3 +38,189 @@ def test_hot(m_from_cache):
     out = cache_calls.hot(redis_cli, kq, kairos_time_range)
     assert out['sample_size'] == 300
     assert len(out['results']) == 3
+
+
+@freeze_time("2016-01-01 20:00:00", tz_offset=-8)
+@mock.patch('tscached.cache_calls.write_kquery')
+@mock.patch('tscached.cache_calls.MTS.from_cache')
+def test_warm_skips_fetch_when_shared_mts_refreshed(m_from_cache, m_write):
+    redis_cli = MockRedis()
+    now_ts = int(datetime.datetime.now().strftime('%s'))
+
+    mts = MTS(redis_cli)
+    mts.redis_key = 'tscached:mts:1'
+    mts.result = {'values': [[(now_ts - 10) * 1000, 1], [now_ts * 1000, 2]]}
+    m_from_cache.return_value = [mts]
+
+    kq = KQuery(redis_cli)
+    kq.query = {'name': 'loadavg.05'}
+    kq.redis_key = 'tscached:kquery:1'
+    kq.cached_data = {'mts_keys': ['tscached:mts:1'], 'earliest_data': now_ts - 3600,
+                      'last_add_data': now_ts - 600}
+    kq.proxy_to_kairos = mock.Mock()
+
+    config = {'data': {'staleness_threshold': 10}, 'kairosdb': {'host': 'localhost', 'port': 8080}}
+    range_needed = (datetime.datetime.fromtimestamp(now_ts - 600), datetime.datetime.now(), FETCH_AFTER)
+    out = cache_calls.warm(config, redis_cli, kq, {'start_relative': {'unit': 'hours', 'value': '1'}},
+                           range_needed)
+
+    assert kq.proxy_to_kairos.call_count == 0
+    assert out['sample_size'] == 2
+    m_write.assert_called_once_with(config, redis_cli, kq, datetime.datetime.fromtimestamp(now_ts - 3600),
+                                    datetime.datetime.fromtimestamp(now_ts))
+
+
+@freeze_time("2016-01-01 20:00:00", tz_offset=-8)
+@mock.patch('tscached.cache_calls.record_tags')
+@mock.patch('tscached.cache_calls.index_kquery')
+@mock.patch('tscached.cache_calls.register_references')
+@mock.patch('tscached.cache_calls.record_size')
+def test_write_kquery_registers_references_only_when_due(m_size, m_register, m_index, m_tags):
+    redis_cli = MockRedis()
+    now_ts = int(datetime.datetime.now().strftime('%s'))
+    expiry = KQuery.expiry
+
+    def _write(cached_data):
+        kq = KQuery(redis_cli)
+        kq.query = {'name': 'loadavg.05'}
+        kq.redis_key = 'tscached:kquery:1'
+        kq.cached_data = cached_data
+        mts = MTS(redis_cli)
+        mts.redis_key = 'tscached:mts:1'
+        kq.add_mts(mts)
+        cache_calls.write_kquery({}, redis_cli, kq, datetime.datetime.fromtimestamp(now_ts - 3600), None)
+        return kq
+
+    # New, or its MTS changed: register, and remember until when.
+    for cached_data in [False, {'mts_keys': ['tscached:mts:2'], 'refs_until': now_ts + expiry * 2}]:
+        kq = _write(cached_data)
+        refs_until = now_ts + expiry + cache_calls.REFERENCE_SLACK
+        assert kq.query['refs_until'] == refs_until
+        m_register.assert_called_once_with(redis_cli, 'tscached:kquery:1', ['tscached:mts:1'], refs_until - now_ts,
+                                           now_ts)
+        m_tags.assert_called_once_with({}, redis_cli, kq, index_mts=True)
+        m_register.reset_mock()
+        m_tags.reset_mock()
+
+    # Same MTS, registered recently enough: a warm append skips the per-MTS work.
+    kq = _write({'mts_keys': ['tscached:mts:1'], 'refs_until': now_ts + expiry + 60})
+    assert kq.query['refs_until'] == now_ts + expiry + 60
+    assert m_register.call_count == 0
+    m_tags.assert_called_once_with({}, redis_cli, kq, index_mts=False)
+    assert m_size.call_count == m_index.call_count == 3
+
+    # The last registration would no longer outlive the KQuery.
+    kq = _write({'mts_keys': ['tscached:mts:1'], 'refs_until': now_ts + expiry - 60})
+    assert m_register.call_count == 1
+    assert kq.query['refs_until'] == now_ts + expiry + cache_calls.REFERENCE_SLACK
+
+
+@freeze_time("2016-01-01 20:00:00", tz_offset=-8)
+@mock.patch('tscached.cache_calls.set_negative')
+def test_cold_empty_sets_negative(m_set_negative):
+    redis_cli = MockRedis()
+    kq = KQuery(redis_cli)
+    kq.query = {'name': 'typo.metric'}
+    kq.redis_key = 'tscached:kquery:1'
+    kq.proxy_to_kairos_chunked = mock.Mock(return_value={0: {'queries': [{'results': []}]}})
+
+    config = {'chunking': {}, 'kairosdb': {'host': 'localhost', 'port': 8080}}
+    time_range = {'start_relative': {'unit': 'minutes', 'value': '10'}}
+    out = cache_calls.cold(config, redis_cli, kq, time_range)
+
+    assert out == {'results': [{'name': 'typo.metric', 'values': []}], 'sample_size': 0}
+    m_set_negative.assert_called_once_with(config, redis_cli, 'tscached:kquery:1', time_range, 'empty')
+    assert redis_cli.set_call_count == 0
+
+
+def test_within_stale_grace():
+    now = datetime.datetime(2016, 1, 1, 20, 0, 0)
+    assert cache_calls.within_stale_grace({'data': {}}, now, now) is False
+    config = {'data': {'stale_grace': 60}}
+    assert cache_calls.within_stale_grace(config, now - datetime.timedelta(seconds=30), now) is True
+    assert cache_calls.within_stale_grace(config, now - datetime.timedelta(seconds=90), now) is False
+
+
+@mock.patch('tscached.cache_calls.warm')
+def test_revalidate_in_background_single_flight(m_warm):
+    redis_cli = mock.Mock()
+    kq = KQuery(redis_cli)
+    kq.query = {'name': 'loadavg.05'}
+    kq.redis_key = 'tscached:kquery:1'
+    kq.cached_data = {'last_add_data': 1}
+
+    redis_cli.set.return_value = None  # somebody else holds the lock
+    assert cache_calls.revalidate_in_background({'data': {}}, redis_cli, kq, {}, 'range') is False
+    assert m_warm.call_count == 0
+
+    redis_cli.set.return_value = True
+    thr = cache_calls.revalidate_in_background({'data': {}}, redis_cli, kq, {}, 'range')
+    thr.join(5)
+    redis_cli.set.assert_called_with('tscached:revalidate:1', 1, nx=True, ex=60)
+    assert m_warm.call_count == 1
+    bg_kquery = m_warm.call_args[0][2]
+    assert bg_kquery is not kq
+    assert bg_kquery.query == kq.query and bg_kquery.get_key() == kq.get_key()
+    redis_cli.delete.assert_called_once_with('tscached:revalidate:1')
+
+
+@freeze_time("2016-01-01 20:00:00", tz_offset=-8)
+@mock.patch('tscached.cache_calls.revalidate_in_background')
+@mock.patch('tscached.cache_calls.warm')
+@mock.patch('tscached.cache_calls.hot')
+def test_process_cache_hit_stale(m_hot, m_warm, m_revalidate):
+    m_hot.return_value = {'results': [], 'sample_size': 0}
+    now_ts = int(datetime.datetime.now().strftime('%s'))
+    kq = KQuery(MockRedis())
+    kq.cached_data = {'earliest_data': now_ts - 3600, 'last_add_data': now_ts - 30}
+    kairos_time_range = {'start_relative': {'unit': 'minutes', 'value': '10'}}
+    config = {'data': {'staleness_threshold': 10, 'stale_grace': 60}}
+
+    assert cache_calls.process_cache_hit(config, None, kq, kairos_time_range, allow_stale=True)[1] == 'hot_stale'
+    assert m_revalidate.call_count == 1
+    assert m_warm.call_count == 0
+
+    # readahead never asks for stale data; it wants the merge done.
+    assert cache_calls.process_cache_hit(config, None, kq, kairos_time_range)[1] == 'warm_append'
+    assert m_warm.call_count == 1
+
+
+@freeze_time("2016-01-01 20:00:00", tz_offset=-8)
+@mock.patch('tscached.cache_calls.circuit.degraded')
+@mock.patch('tscached.cache_calls.warm')
+@mock.patch('tscached.cache_calls.hot')
+def test_process_cache_hit_degraded(m_hot, m_warm, m_degraded):
+    m_hot.return_value = {'results': [], 'sample_size': 0}
+    m_degraded.return_value = True
+    now_ts = int(datetime.datetime.now().strftime('%s'))
+    kq = KQuery(MockRedis())
+    kq.cached_data = {'earliest_data': now_ts - 3600, 'last_add_data': now_ts - 600}
+    kairos_time_range = {'start_relative': {'unit': 'minutes', 'value': '10'}}
+    config = {'data': {'staleness_threshold': 10}}
+
+    assert cache_calls.process_cache_hit(config, None, kq, kairos_time_range)[1] == 'degraded'
+    assert m_hot.call_count == 1
+    assert m_warm.call_count == 0
+
+
+@freeze_time("2016-01-01 20:00:00", tz_offset=-8)
+@mock.patch('tscached.cache_calls.warm')
+@mock.patch('tscached.cache_calls.hot')
+def test_process_cache_hit_partial_fallback(m_hot, m_warm):
+    m_hot.return_value = {'results': [], 'sample_size': 0}
+    m_warm.side_effect = BackendQueryFailure('KairosDB responded 500: oops')
+    now_ts = int(datetime.datetime.now().strftime('%s'))
+    kq = KQuery(MockRedis())
+    kq.cached_data = {'earliest_data': now_ts - 3600, 'last_add_data': now_ts - 600}
+    kairos_time_range = {'start_relative': {'unit': 'minutes', 'value': '10'}}
+    config = {'data': {'staleness_threshold': 10}, 'degraded': {'partial_responses': True}}
+
+    assert cache_calls.process_cache_hit(config, None, kq, kairos_time_range, allow_stale=True)[1] == 'partial'
+    assert m_hot.call_count == 1
+
+    # readahead (no allow_stale) and disabled partial_responses both still raise.
+    with pytest.raises(BackendQueryFailure):
+        cache_calls.process_cache_hit(config, None, kq, kairos_time_range)
+    with pytest.raises(BackendQueryFailure):
+        cache_calls.process_cache_hit({'data': {'staleness_threshold': 10}}, None, kq, kairos_time_range,
+                                      allow_stale=True)
@@ -0,0 +1,61 @@
+import os
+
+import mock
+import simplejson as json
+
+from tscached import capture
+from tscached.kquery import KQuery
+
+
+def make_kquery(query):
+    return next(KQuery.from_request({'metrics': [query]}, None))
+
+
+def test_entry():
+    kquery = make_kquery({'name': 'loadavg.1', 'tags': {'host': ['b', 'a']}})
+    kquery.query['mts_keys'] = ['tscached:mts:1']
+    kquery.query['last_add_data'] = 1000
+    response = {'sample_size': 5, 'results': [{'values': [[1, 2]] * 5}, {'values': []}]}
+    entry = capture.entry({'start_relative': {'value': '1', 'unit': 'hours'}}, [(kquery, 'hot', response)], 0.0125,
+                          now=12.3456)
+    assert entry == {
+        'ts': 12.346,
+        'time_range': {'start_relative': {'value': '1', 'unit': 'hours'}},
+        'elapsed_ms': 12.5,
+        'kqueries': [{'key': kquery.get_key(), 'mode': 'hot', 'series': 1, 'points': 5,
+                      'query': {'name': 'loadavg.1', 'tags': {'host': ['a', 'b']}}}],
+    }
+
+
+def test_record(tmpdir):
+    path = str(tmpdir.join('capture.jsonl'))
+    config = {'capture': {'enabled': True, 'path': path}}
+    kquery = make_kquery({'name': 'loadavg.1'})
+    assert capture.record(config, {'start_absolute': 1}, [(kquery, 'cold_miss', {})], 0.1) is True
+    assert capture.record(config, {'start_absolute': 2}, [(kquery, 'hot', {})], 0.1) is True
+
+    entries = list(capture.read_trace(path))
+    assert [e['kqueries'][0]['mode'] for e in entries] == ['cold_miss', 'hot']
+    assert entries[1]['time_range'] == {'start_absolute': 2}
+
+
+def test_record_disabled_or_unsampled(tmpdir):
+    path = str(tmpdir.join('capture.jsonl'))
+    kquery = make_kquery({'name': 'loadavg.1'})
+    assert capture.record({}, {}, [(kquery, 'hot', {})], 0.1) is False
+    assert capture.record({'capture': {'enabled': True, 'path': path}}, {}, [], 0.1) is False
+    with mock.patch('tscached.capture.random.random', return_value=0.5):
+        assert capture.record({'capture': {'enabled': True, 'path': path, 'sample_rate': 0.5}}, {},
+                              [(kquery, 'hot', {})], 0.1) is False
+    assert not os.path.exists(path)
+
+
+def test_record_never_raises(tmpdir):
+    config = {'capture': {'enabled': True, 'path': str(tmpdir.join('missing', 'capture.jsonl'))}}
+    assert capture.record(config, {}, [(make_kquery({'name': 'loadavg.1'}), 'hot', {})], 0.1) is False
+
+
+def test_read_trace_skips_malformed(tmpdir):
+    path = tmpdir.join('capture.jsonl')
+    path.write(json.dumps({'ts': 1}) + '\n' + '{"ts": 2, "kq' + '\n' + json.dumps({'ts': 3}) + '\n')
+    assert [e['ts'] for e in capture.read_trace(str(path))] == [1, 3]
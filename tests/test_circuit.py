@@ -0,0 +1,145 @@
+import threading
+import time
+
+from tscached import circuit
+from tscached.circuit import CLOSED
+from tscached.circuit import CircuitBreaker
+from tscached.circuit import HALF_OPEN
+from tscached.circuit import OPEN
+
+
+def test_stays_closed_below_min_requests():
+    breaker = CircuitBreaker(window=10, min_requests=5, failure_ratio=0.5)
+    for _ in xrange(4):
+        breaker.record(False, 0.1, now=100)
+    assert breaker.state == CLOSED
+    assert breaker.allow(now=100) is True
+
+
+def test_opens_on_failure_ratio():
+    breaker = CircuitBreaker(window=10, min_requests=4, failure_ratio=0.5, cooldown=30)
+    breaker.record(True, 0.1, now=100)
+    breaker.record(True, 0.1, now=100)
+    breaker.record(False, 0.1, now=100)
+    assert breaker.state == CLOSED
+    breaker.record(False, 0.1, now=100)
+    assert breaker.state == OPEN
+    assert breaker.is_open(now=110) is True
+    assert breaker.allow(now=110) is False
+
+
+def test_slow_requests_count_as_failures():
+    breaker = CircuitBreaker(window=2, min_requests=2, failure_ratio=1.0, slow_request=5)
+    breaker.record(True, 6, now=100)
+    breaker.record(True, 6, now=100)
+    assert breaker.state == OPEN
+
+
+def test_half_open_lets_one_trial_through():
+    breaker = CircuitBreaker(window=2, min_requests=2, failure_ratio=1.0, cooldown=30)
+    breaker.record(False, 0.1, now=100)
+    breaker.record(False, 0.1, now=100)
+    assert breaker.allow(now=131) is True
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow(now=131) is False
+
+    breaker.record(False, 0.1, now=132)  # trial failed: back to open, cooldown restarts.
+    assert breaker.state == OPEN
+    assert breaker.allow(now=150) is False
+    assert breaker.allow(now=163) is True
+
+    breaker.record(True, 0.1, now=164)
+    assert breaker.state == CLOSED
+    assert breaker.allow(now=164) is True
+
+
+def test_half_open_trial_requests():
+    breaker = CircuitBreaker(window=2, min_requests=2, failure_ratio=1.0, cooldown=30, trial_requests=3)
+    breaker.record(False, 0.1, now=100)
+    breaker.record(False, 0.1, now=100)
+    assert [breaker.allow(now=131) for _ in xrange(4)] == [True, True, True, False]
+    breaker.record(True, 0.1, now=132)  # the first to succeed closes the circuit
+    assert breaker.state == CLOSED
+
+
+def test_half_open_expires_lost_trials():
+    breaker = CircuitBreaker(window=2, min_requests=2, failure_ratio=1.0, cooldown=30)
+    breaker.record(False, 0.1, now=100)
+    breaker.record(False, 0.1, now=100)
+    assert breaker.allow(now=131) is True  # this trial never reports back
+    assert breaker.allow(now=150) is False
+    assert breaker.is_open(now=150) is True
+    assert breaker.is_open(now=161) is False
+    assert breaker.allow(now=161) is True
+    assert breaker.state == HALF_OPEN
+
+
+def test_is_open_ends_with_cooldown():
+    breaker = CircuitBreaker(window=1, min_requests=1, cooldown=30)
+    breaker.record(False, 0.1, now=100)
+    assert breaker.is_open(now=129) is True
+    assert breaker.is_open(now=130) is False  # so cached traffic sends the trial request
+
+
+def test_configure():
+    original = (circuit.breaker, circuit.in_flight, circuit.request_timeout)
+    try:
+        circuit.configure({'kairosdb': {'timeout': 12, 'max_in_flight': 3, 'queue_wait': 2,
+                                        'circuit_breaker': {'min_requests': 7, 'cooldown': 9,
+                                                            'trial_requests': 4}}})
+        assert circuit.request_timeout == 12
+        assert isinstance(circuit.in_flight, circuit.InFlightLimit)
+        assert (circuit.in_flight.limit, circuit.in_flight.wait) == (3, 2)
+        assert circuit.breaker.min_requests == 7
+        assert circuit.breaker.cooldown == 9
+        assert circuit.breaker.trial_requests == 4
+
+        circuit.configure({'kairosdb': {'circuit_breaker': {'enabled': False}}})
+        assert circuit.in_flight is None
+        for _ in xrange(100):
+            circuit.breaker.record(False, 0.1)
+        assert circuit.breaker.is_open() is False
+    finally:
+        circuit.breaker, circuit.in_flight, circuit.request_timeout = original
+
+
+def test_in_flight_limit():
+    limit = circuit.InFlightLimit(4)
+    assert limit.acquire(3) == 3
+    assert limit.acquire(2) == 0  # all or nothing
+    assert limit.acquire(1) == 1
+    limit.release(3)
+    limit.release(1)
+    assert limit.acquire(10) == 4  # never more than the limit, so a big KQuery still gets to run
+    limit.release(4)
+    assert limit.used == 0
+
+
+def test_in_flight_limit_waits():
+    limit = circuit.InFlightLimit(2, wait=5)
+    limit.acquire(2)
+    releaser = threading.Timer(0.05, limit.release, args=(2,))
+    releaser.start()
+    started = time.time()
+    assert limit.acquire(2) == 2
+    assert time.time() - started < 4
+    assert limit.acquire(1, wait=0.01) == 0
+
+
+def test_degraded():
+    original = circuit.breaker
+    try:
+        circuit.breaker = CircuitBreaker(window=1, min_requests=1)
+        assert circuit.degraded({'degraded': {'enabled': True}}) is False
+        circuit.breaker.record(False, 0.1)
+        assert circuit.degraded({'degraded': {'enabled': True}}) is True
+        assert circuit.degraded({'degraded': {'enabled': False}}) is False
+        assert circuit.degraded({}) is False
+    finally:
+        circuit.breaker = original
+
+
+def test_partial_responses():
+    assert circuit.partial_responses({'degraded': {'partial_responses': True}}) is True
+    assert circuit.partial_responses({'degraded': {}}) is False
+    assert circuit.partial_responses({}) is False
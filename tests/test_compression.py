@@ -0,0 +1,53 @@
+import zlib
+
+import pytest
+
+from tscached import compression
+from tscached.compression import accepted
+from tscached.compression import choose
+from tscached.compression import compress
+from tscached.compression import gunzip
+from tscached.compression import is_gzipped
+from tscached.compression import respond
+
+
+CONFIG = {'compression': {'enabled': True, 'encodings': ['zstd', 'gzip', 'deflate'], 'level': 6, 'min_size': 10}}
+BODY = '{"queries": [' + ', '.join(['{"results": []}'] * 50) + ']}'
+
+
+def test_accepted():
+    assert accepted('gzip, deflate;q=0.5, br') == set(['gzip', 'deflate', 'br'])
+    assert accepted('gzip;q=0, deflate') == set(['deflate'])
+    assert accepted('') == set()
+    assert accepted(None) == set()
+
+
+def test_choose():
+    assert choose(CONFIG, 'deflate, gzip') == 'gzip'
+    assert choose(CONFIG, 'deflate') == 'deflate'
+    assert choose(CONFIG, 'br') is None
+    assert choose({}, 'gzip') is None
+    assert choose(CONFIG, 'zstd') == ('zstd' if compression.zstandard else None)
+
+
+def test_compress_roundtrip():
+    gzipped = compress(BODY, 'gzip')
+    assert is_gzipped(gzipped)
+    assert gunzip(gzipped) == BODY
+    assert zlib.decompress(compress(BODY, 'deflate')) == BODY
+    assert gunzip(BODY) == BODY
+    assert compress(u'\xe9t\xe9', 'deflate') == zlib.compress('\xc3\xa9t\xc3\xa9', 6)
+    with pytest.raises(ValueError):
+        compress(BODY, 'br')
+
+
+def test_respond():
+    body, status, headers = respond(CONFIG, 'gzip', BODY, 200, {'Content-Type': 'application/json'})
+    assert status == 200
+    assert headers == {'Content-Type': 'application/json', 'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'}
+    assert gunzip(body) == BODY
+
+    assert respond(CONFIG, 'gzip', 'tiny', 200) == ('tiny', 200, {})  # under min_size
+    assert respond(CONFIG, '', BODY, 200) == (BODY, 200, {})
+    already = {'Content-Encoding': 'gzip'}
+    assert respond(CONFIG, 'gzip', 'not-really-gzip', 200, already) == ('not-really-gzip', 200, already)
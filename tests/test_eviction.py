@@ -0,0 +1,147 @@
+import mock
+import simplejson as json
+
+from tscached.eviction import KQUERY_ACCESS
+from tscached.eviction import KQUERY_HITS
+from tscached.eviction import KQUERY_SIZES
+from tscached.eviction import choose_victims
+from tscached.eviction import evict_kquery
+from tscached.eviction import get_budget_prefix
+from tscached.eviction import load_accounting
+from tscached.eviction import perform_eviction
+from tscached.eviction import record_access
+from tscached.eviction import record_hit
+from tscached.eviction import record_size
+
+
+EX_CONFIG = {'eviction': {'enabled': True, 'budgets': {'loadavg.': 100, 'loadavg.05': 50}}}
+
+
+def test_record_size():
+    redis_cli = mock.Mock()
+    record_size(redis_cli, 'tscached:kquery:WAT', 'loadavg.05', 1234)
+    redis_cli.hset.assert_called_once_with(KQUERY_SIZES, 'tscached:kquery:WAT',
+                                           json.dumps({'name': 'loadavg.05', 'bytes': 1234}))
+
+
+def test_record_hit():
+    redis_cli = mock.Mock()
+    record_hit(redis_cli, 'tscached:kquery:WAT')
+    redis_cli.hincrby.assert_called_once_with(KQUERY_HITS, 'tscached:kquery:WAT', 1)
+
+
+def test_record_access():
+    redis_cli = mock.Mock()
+    record_access(redis_cli, ['tscached:kquery:A', 'tscached:kquery:B'], now=1234.5)
+    redis_cli.hmset.assert_called_once_with(KQUERY_ACCESS, {'tscached:kquery:A': 1234, 'tscached:kquery:B': 1234})
+    record_access(redis_cli, [])
+    assert redis_cli.hmset.call_count == 1
+
+
+def test_get_budget_prefix():
+    assert get_budget_prefix(EX_CONFIG, 'loadavg.05') == 'loadavg.05'
+    assert get_budget_prefix(EX_CONFIG, 'loadavg.15') == 'loadavg.'
+    assert get_budget_prefix(EX_CONFIG, 'cpu.idle') is None
+    assert get_budget_prefix({}, 'loadavg.05') is None
+
+
+def test_choose_victims_prefix_budget():
+    entries = [
+        {'key': 'big-unpopular', 'name': 'loadavg.15', 'bytes': 80, 'hits': 0},
+        {'key': 'big-popular', 'name': 'loadavg.15', 'bytes': 80, 'hits': 100},
+        {'key': 'unbudgeted', 'name': 'cpu.idle', 'bytes': 9000, 'hits': 0},
+    ]
+    assert choose_victims(EX_CONFIG, entries) == ['big-unpopular']
+
+
+def test_choose_victims_nested_prefix_budget():
+    entries = [
+        {'key': 'a', 'name': 'loadavg.05', 'bytes': 40, 'hits': 1},
+        {'key': 'b', 'name': 'loadavg.05', 'bytes': 40, 'hits': 3},
+        {'key': 'c', 'name': 'loadavg.15', 'bytes': 90, 'hits': 0},
+    ]
+    # loadavg.05 is over its own budget; loadavg.15 alone fits under loadavg.
+    assert choose_victims(EX_CONFIG, entries) == ['a']
+
+
+def test_choose_victims_max_bytes():
+    config = {'eviction': {'max_bytes': 100}}
+    entries = [
+        {'key': 'a', 'name': 'x', 'bytes': 60, 'hits': 10},
+        {'key': 'b', 'name': 'y', 'bytes': 60, 'hits': 0},
+        {'key': 'c', 'name': 'z', 'bytes': 30, 'hits': 0},
+    ]
+    assert choose_victims(config, entries) == ['b']
+
+
+def test_load_accounting_forgets_expired():
+    redis_cli = mock.Mock()
+    redis_cli.hgetall.side_effect = [
+        {'alive': json.dumps({'name': 'x', 'bytes': 10}), 'dead': json.dumps({'name': 'y', 'bytes': 20})},
+        {'alive': '4', 'hit-only': '2'},
+        {'access-only': '1500', 'unsized': '1600'},
+    ]
+    pipeline = redis_cli.pipeline.return_value
+    pipeline.execute.side_effect = lambda: [k in ['alive', 'unsized'] for k in
+                                            [c[0][0] for c in pipeline.exists.call_args_list]]
+
+    entries = load_accounting(redis_cli)
+    assert entries == [{'key': 'alive', 'name': 'x', 'bytes': 10, 'hits': 4}]
+    forgotten = dict((c[0][0], sorted(c[0][1:])) for c in pipeline.hdel.call_args_list)
+    assert forgotten == dict((hash_key, ['access-only', 'dead', 'hit-only'])
+                             for hash_key in [KQUERY_SIZES, KQUERY_HITS, KQUERY_ACCESS])
+
+
+@mock.patch('tscached.eviction.release_references')
+def test_evict_kquery(m_release):
+    m_release.return_value = ['tscached:mts:2']
+    redis_cli = mock.Mock()
+    redis_cli.get.return_value = json.dumps({'mts_keys': ['tscached:mts:1', 'tscached:mts:2']})
+    pipeline = redis_cli.pipeline.return_value
+    pipeline.execute.return_value = [100, 30, 1, 1, 1, 1]  # STRLEN of each MTS, then the deletes
+
+    assert evict_kquery(redis_cli, 'tscached:kquery:WAT') == 30  # mts:1 is still used elsewhere
+    pipeline.delete.assert_called_once_with('tscached:kquery:WAT')
+    pipeline.hdel.assert_any_call(KQUERY_SIZES, 'tscached:kquery:WAT')
+    pipeline.hdel.assert_any_call(KQUERY_HITS, 'tscached:kquery:WAT')
+    pipeline.hdel.assert_any_call(KQUERY_ACCESS, 'tscached:kquery:WAT')
+    m_release.assert_called_once_with(redis_cli, 'tscached:kquery:WAT', ['tscached:mts:1', 'tscached:mts:2'])
+
+
+@mock.patch('tscached.eviction.evict_kquery')
+@mock.patch('tscached.eviction.load_accounting')
+def test_perform_eviction_disabled(m_load, m_evict):
+    m_load.return_value = [{'key': 'a', 'name': 'loadavg.05', 'bytes': 60, 'hits': 0}]
+    redis_cli = mock.Mock()
+    assert perform_eviction({'eviction': {'enabled': False}}, redis_cli) == []
+    assert perform_eviction({}, redis_cli) == []
+    assert m_evict.call_count == 0
+    assert m_load.call_count == 2  # but expired accounting is still forgotten
+
+
+@mock.patch('tscached.eviction.evict_kquery')
+@mock.patch('tscached.eviction.load_accounting')
+def test_perform_eviction(m_load, m_evict):
+    m_load.return_value = [{'key': 'a', 'name': 'loadavg.05', 'bytes': 60, 'hits': 0}]
+    m_evict.return_value = 60
+    redis_cli = mock.Mock()
+    assert perform_eviction(EX_CONFIG, redis_cli) == ['a']
+    m_evict.assert_called_once_with(redis_cli, 'a')
+
+
+def test_choose_victims_counts_bytes_freed():
+    config = {'eviction': {'max_bytes': 120}}
+    entries = [
+        {'key': 'a', 'name': 'x', 'bytes': 60, 'hits': 10},
+        {'key': 'b', 'name': 'y', 'bytes': 60, 'hits': 0},
+        {'key': 'c', 'name': 'z', 'bytes': 30, 'hits': 0},
+    ]
+    freed = {'b': 0, 'c': 30, 'a': 60}  # b's MTS are all shared with a
+    evicted = []
+
+    def evict(key):
+        evicted.append(key)
+        return freed[key]
+    assert choose_victims(config, entries) == ['b']  # planning alone assumes b frees its 60 bytes
+    assert choose_victims(config, entries, evict) == ['b', 'c']
+    assert evicted == ['b', 'c']
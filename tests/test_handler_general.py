@@ -0,0 +1,16 @@
+from tscached.handler_general import cached_coverage
+from tscached.kquery import KQuery
+
+
+def test_cached_coverage():
+    kquery = KQuery(None)
+    kquery.cached_data = {'earliest_data': 1000, 'last_add_data': '2000.5'}
+    assert cached_coverage(kquery) == (1000.0, 2000.5)
+
+
+def test_cached_coverage_malformed():
+    kquery = KQuery(None)
+    for cached in [False, {}, {'earliest_data': 1000}, {'earliest_data': None, 'last_add_data': 2000},
+                   {'earliest_data': 'x', 'last_add_data': 2000}]:
+        kquery.cached_data = cached
+        assert cached_coverage(kquery) is None
@@ -0,0 +1,199 @@
+import mock
+import pytest
+import redis
+import requests
+import simplejson as json
+
+from tscached import handler_meta
+from tscached.compression import compress
+from tscached.handler_meta import fresh_key
+from tscached.handler_meta import lock_key
+from tscached.handler_meta import metadata_caching
+from tscached.handler_meta import refresh_metadata
+from tscached.utils import BackendQueryFailure
+
+
+CONFIG = {'redis': {'host': 'localhost', 'port': 6379}, 'kairosdb': {'host': 'localhost', 'port': 8080},
+          'expiry': {'metricnames': 300},
+          'metadata': {'refresh_ahead': 60, 'stale_expiry': 1000, 'lock_timeout': 30, 'coalesce_wait': 0.2}}
+
+
+def kairos_response(status_code, text):
+    response = mock.Mock()
+    response.status_code = status_code
+    response.text = text
+    return response
+
+
+def test_keys():
+    assert fresh_key('tscached:metricnames') == 'tscached:meta_fresh:metricnames'
+    assert lock_key('tscached:metaquery:abc') == 'tscached:meta_lock:metaquery:abc'
+
+
+@mock.patch('tscached.handler_meta.refresh_in_background')
+@mock.patch('tscached.handler_meta.redis.StrictRedis')
+def test_metadata_caching_fresh_hit(m_redis, m_refresh):
+    m_redis.return_value.pipeline.return_value.execute.return_value = ['{"results": []}', 250]
+    assert metadata_caching(CONFIG, 'metricnames', '/api/v1/metricnames')[:2] == ('{"results": []}', 200)
+    assert m_refresh.call_count == 0
+
+
+@mock.patch('tscached.handler_meta.redis.StrictRedis')
+def test_metadata_caching_gzipped_hit(m_redis):
+    stored = compress('{"results": ["a"]}', 'gzip')
+    m_redis.return_value.pipeline.return_value.execute.return_value = [stored, 250]
+    config = dict(CONFIG, compression={'enabled': True})
+
+    content, status, headers = metadata_caching(config, 'metricnames', '/api/v1/metricnames',
+                                                accept_encoding='gzip, deflate')
+    assert content == stored
+    assert headers['Content-Encoding'] == 'gzip'
+
+    content, status, headers = metadata_caching(config, 'metricnames', '/api/v1/metricnames',
+                                                accept_encoding='deflate')
+    assert content == '{"results": ["a"]}'
+    assert 'Content-Encoding' not in headers
+
+
+@mock.patch('tscached.handler_meta.refresh_in_background')
+@mock.patch('tscached.handler_meta.redis.StrictRedis')
+def test_metadata_caching_refresh_ahead_and_stale(m_redis, m_refresh):
+    for fresh_ttl in [30, None]:  # about to expire; expired.
+        m_redis.return_value.pipeline.return_value.execute.return_value = ['{"results": []}', fresh_ttl]
+        assert metadata_caching(CONFIG, 'metricnames', '/api/v1/metricnames')[:2] == ('{"results": []}', 200)
+    assert m_refresh.call_count == 2
+    m_refresh.assert_called_with(CONFIG, m_redis.return_value, 'metricnames', 'tscached:metricnames',
+                                 '/api/v1/metricnames', None)
+
+
+@mock.patch('tscached.handler_meta.requests.get')
+@mock.patch('tscached.handler_meta.redis.StrictRedis')
+def test_metadata_caching_miss(m_redis, m_get):
+    redis_cli = m_redis.return_value
+    redis_cli.pipeline.return_value.execute.side_effect = [[None, None], [True, True], []]
+    redis_cli.set.return_value = True
+    m_get.return_value = kairos_response(200, '{"results": ["a"]}')
+
+    assert metadata_caching(CONFIG, 'metricnames', '/api/v1/metricnames')[:2] == ('{"results": ["a"]}', 200)
+    redis_cli.set.assert_called_once_with('tscached:meta_lock:metricnames', 1, nx=True, ex=30)
+    pipeline = redis_cli.pipeline.return_value
+    pipeline.set.assert_any_call('tscached:metricnames', '{"results": ["a"]}', ex=1300)
+    pipeline.set.assert_any_call('tscached:meta_fresh:metricnames', 1, ex=300)
+    redis_cli.delete.assert_called_once_with('tscached:meta_lock:metricnames')
+    pipeline.zadd.assert_called_once_with(mock.ANY, 0, 'a')
+    assert pipeline.zadd.call_args[0][0].startswith('tscached:meta_index:metricnames:building:')
+
+
+@mock.patch('tscached.handler_meta.requests.get')
+@mock.patch('tscached.handler_meta.redis.StrictRedis')
+def test_metadata_caching_miss_coalesced(m_redis, m_get):
+    redis_cli = m_redis.return_value
+    redis_cli.pipeline.return_value.execute.return_value = [None, None]
+    redis_cli.set.return_value = None  # someone else holds the lock
+    redis_cli.get.side_effect = [None, '{"results": ["b"]}']
+    redis_cli.exists.return_value = True
+
+    assert metadata_caching(CONFIG, 'metricnames', '/api/v1/metricnames')[:2] == ('{"results": ["b"]}', 200)
+    assert m_get.call_count == 0
+
+
+@mock.patch('tscached.handler_meta.requests.get')
+@mock.patch('tscached.handler_meta.redis.StrictRedis')
+def test_metadata_caching_miss_kairos_error(m_redis, m_get):
+    redis_cli = m_redis.return_value
+    redis_cli.pipeline.return_value.execute.return_value = [None, None]
+    redis_cli.set.return_value = True
+    m_get.return_value = kairos_response(500, '{"errors": ["broken"]}')
+
+    content, status = metadata_caching(CONFIG, 'metricnames', '/api/v1/metricnames')
+    assert status == 500
+    assert 'KairosDB responded 500: broken' in content
+    redis_cli.delete.assert_called_once_with('tscached:meta_lock:metricnames')
+
+
+@mock.patch('tscached.handler_meta.requests.post')
+@mock.patch('tscached.handler_meta.requests.get')
+def test_fetch_metadata_timeout(m_get, m_post):
+    m_get.return_value = m_post.return_value = kairos_response(200, '{"results": []}')
+    with mock.patch('tscached.handler_meta.circuit.request_timeout', None):
+        handler_meta.fetch_metadata(CONFIG, 'tscached:metricnames', '/api/v1/metricnames')
+    m_get.assert_called_once_with('http://localhost:8080/api/v1/metricnames', timeout=30)
+
+    with mock.patch('tscached.handler_meta.circuit.request_timeout', 10):
+        handler_meta.fetch_metadata(CONFIG, 'tscached:metaquery:abc', '/api/v1/datapoints/query/tags', '{}')
+    m_post.assert_called_once_with('http://localhost:8080/api/v1/datapoints/query/tags', data='{}', timeout=10)
+
+    with mock.patch('tscached.handler_meta.circuit.request_timeout', 60):  # capped at the lock's lifetime.
+        handler_meta.fetch_metadata(CONFIG, 'tscached:metricnames', '/api/v1/metricnames')
+    assert m_get.call_args[1]['timeout'] == 30
+
+
+@mock.patch('tscached.handler_meta.requests.get')
+def test_refresh_metadata_connection_error_leaves_value(m_get):
+    redis_cli = mock.Mock()
+    redis_cli.set.return_value = True
+    m_get.side_effect = requests.exceptions.ConnectionError('nope')
+    with pytest.raises(BackendQueryFailure):
+        refresh_metadata(CONFIG, redis_cli, 'metricnames', 'tscached:metricnames', '/api/v1/metricnames')
+    assert redis_cli.pipeline.call_count == 0  # nothing overwritten
+    redis_cli.delete.assert_called_once_with('tscached:meta_lock:metricnames')
+
+
+def test_store_metadata_compressed():
+    redis_cli = mock.Mock()
+    redis_cli.pipeline.return_value.execute.return_value = [True, True]
+    config = dict(CONFIG, compression={'store_metadata': True})
+    handler_meta.store_metadata(config, redis_cli, 'metaquery', 'tscached:metaquery:abc', '{"queries": []}')
+    redis_cli.pipeline.return_value.set.assert_any_call('tscached:metaquery:abc', compress('{"queries": []}', 'gzip'),
+                                                        ex=1300)
+
+
+def test_refresh_in_background_swallows_failure():
+    redis_cli = mock.Mock()
+    redis_cli.set.return_value = True
+    with mock.patch.object(handler_meta, 'refresh_locked', side_effect=BackendQueryFailure('down')) as m_ref:
+        thr = handler_meta.refresh_in_background(CONFIG, redis_cli, 'metricnames', 'tscached:metricnames',
+                                                 '/api/v1/metricnames')
+        thr.join(1)
+    assert m_ref.call_count == 1
+
+
+def test_refresh_in_background_only_with_lock():
+    redis_cli = mock.Mock()
+    redis_cli.set.return_value = None  # someone else is refreshing
+    with mock.patch.object(handler_meta.threading, 'Thread') as m_thread:
+        assert handler_meta.refresh_in_background(CONFIG, redis_cli, 'metricnames', 'tscached:metricnames',
+                                                  '/api/v1/metricnames') is None
+    assert m_thread.call_count == 0
+    redis_cli.set.assert_called_once_with('tscached:meta_lock:metricnames', 1, nx=True, ex=30)
+    assert redis_cli.delete.call_count == 0
+
+
+@mock.patch('tscached.handler_meta.redis.StrictRedis')
+def test_handle_metadata_search(m_redis):
+    redis_cli = m_redis.return_value
+    redis_cli.exists.return_value = True
+    redis_cli.zlexcount.return_value = 3
+    redis_cli.zrangebylex.return_value = ['loadavg.05', 'loadavg.15']
+    with handler_meta.app.test_request_context('/api/v1/metricnames/search?q=loadavg&limit=2'):
+        content, status, headers = handler_meta.handle_metadata_search('metricnames')
+    assert status == 200
+    assert json.loads(content) == {'results': ['loadavg.05', 'loadavg.15'], 'total': 3, 'offset': 0, 'limit': 2}
+    redis_cli.zrangebylex.assert_called_once_with('tscached:meta_index:metricnames', '[loadavg',
+                                                  '[loadavg\xff', start=0, num=2)
+
+    with handler_meta.app.test_request_context('/api/v1/metricnames/search?mode=regex'):
+        assert handler_meta.handle_metadata_search('metricnames')[1] == 400
+    for limit in ['0', '-5']:
+        with handler_meta.app.test_request_context('/api/v1/metricnames/search?limit=' + limit):
+            assert handler_meta.handle_metadata_search('metricnames')[1] == 400
+
+
+@mock.patch('tscached.handler_meta.metadata_caching')
+@mock.patch('tscached.handler_meta.redis.StrictRedis')
+def test_handle_metadata_search_redis_down(m_redis, m_caching):
+    m_redis.return_value.exists.side_effect = redis.exceptions.ConnectionError('nope')
+    m_caching.return_value = ('{"results": ["b.load", "a.load", "cpu"]}', 200, {})
+    with handler_meta.app.test_request_context('/api/v1/metricnames/search?q=load&mode=substring'):
+        content, status, headers = handler_meta.handle_metadata_search('metricnames')
+    assert json.loads(content)['results'] == ['a.load', 'b.load']
@@ -0,0 +1,90 @@
+import mock
+import simplejson as json
+
+from tscached import inspection
+from tscached.eviction import KQUERY_ACCESS
+from tscached.eviction import KQUERY_HITS
+from tscached.eviction import KQUERY_SIZES
+
+
+def kquery_json(name, mts_keys):
+    return json.dumps({'name': name, 'tags': {'host': ['*']}, 'mts_keys': mts_keys, 'earliest_data': 1000,
+                       'last_add_data': 2000})
+
+
+def test_gap_stats():
+    assert inspection.gap_stats([]) == {'points': 0, 'first': None, 'last': None, 'interval': None, 'gaps': 0,
+                                        'max_gap': None, 'missing': 0}
+    assert inspection.gap_stats([5000])['interval'] is None
+
+    stats = inspection.gap_stats([0, 10000, 20000, 50000, 60000, 80000])
+    assert stats == {'points': 6, 'first': 0, 'last': 80, 'interval': 10, 'gaps': 2, 'max_gap': 30,
+                     'missing': 3}
+
+
+def test_list_kqueries():
+    redis_cli = mock.Mock()
+    hashes = {
+        KQUERY_SIZES: {'a': json.dumps({'name': 'loadavg.1', 'bytes': 10}),
+                       'b': json.dumps({'name': 'loadavg.5', 'bytes': 30}),
+                       'c': json.dumps({'name': 'cpu.idle', 'bytes': 20}),
+                       'gone': json.dumps({'name': 'loadavg.15', 'bytes': 99})},
+        KQUERY_HITS: {'a': '7'},
+        KQUERY_ACCESS: {'b': '1500'},
+    }
+    cached = {'a': kquery_json('loadavg.1', ['m1']), 'b': kquery_json('loadavg.5', ['m1', 'm2']),
+              'c': kquery_json('cpu.idle', [])}
+    redis_cli.hgetall.side_effect = hashes.get
+    pipeline = redis_cli.pipeline.return_value
+    pipeline.execute.side_effect = lambda: [item for c in pipeline.get.call_args_list
+                                            for item in (cached.get(c[0][0]), 100)]
+
+    listing = inspection.list_kqueries(redis_cli)
+    assert listing['count'] == 3
+    assert listing['bytes'] == 60
+    assert listing['mts'] == 3
+    assert [kq['key'] for kq in listing['kqueries']] == ['b', 'c', 'a']
+    pipeline.hdel.assert_any_call(KQUERY_SIZES, 'gone')
+    pipeline.hdel.assert_any_call(KQUERY_HITS, 'gone')
+    pipeline.hdel.assert_any_call(KQUERY_ACCESS, 'gone')
+    assert listing['kqueries'][0] == {'key': 'b', 'name': 'loadavg.5', 'query': {'name': 'loadavg.5',
+                                      'tags': {'host': ['*']}}, 'earliest_data': 1000, 'last_add_data': 2000,
+                                      'mts': 2, 'bytes': 30, 'ttl': 100, 'hits': 0, 'last_access': 1500}
+
+    pipeline.get.reset_mock()
+    listing = inspection.list_kqueries(redis_cli, sort='hits', limit=1, name='loadavg.')
+    assert listing['count'] == 2
+    assert [kq['key'] for kq in listing['kqueries']] == ['a']
+
+
+def test_inspect_kquery():
+    redis_cli = mock.Mock()
+    mts = {'m1': json.dumps({'name': 'loadavg.1', 'tags': {'host': ['a']},
+                             'values': [[0, 1], [10000, 2], [40000, 3]]})}
+    pipeline = redis_cli.pipeline.return_value
+    pipeline.execute.side_effect = [
+        [kquery_json('loadavg.1', ['m1', 'm2']), 500, '3', '1999'],  # KQuery, its TTL, hits, last access
+        [400, -2],  # MTS TTLs
+        [mts['m1'], None],  # MTS
+    ]
+
+    details = inspection.inspect_kquery(redis_cli, 'tscached:kquery:a')
+    assert details['query'] == {'name': 'loadavg.1', 'tags': {'host': ['*']}}
+    assert details['ttl'] == 500
+    assert details['hits'] == 3
+    assert details['last_access'] == 1999
+    assert details['missing_mts'] == 1
+    assert details['points'] == 3
+    assert details['bytes'] == len(mts['m1'])
+    assert len(details['mts']) == 1
+    series = details['mts'][0]
+    assert series['key'] == 'm1'
+    assert series['ttl'] == 400
+    assert series['tags'] == {'host': ['a']}
+    assert (series['points'], series['interval'], series['gaps'], series['missing']) == (3, 10, 1, 2)
+
+
+def test_inspect_kquery_not_cached():
+    redis_cli = mock.Mock()
+    redis_cli.pipeline.return_value.execute.return_value = [None, -2, None, None]
+    assert inspection.inspect_kquery(redis_cli, 'tscached:kquery:nope') is None
@@ -0,0 +1,107 @@
+import flask
+import mock
+import pytest
+import redis
+
+from tscached import instrumentation
+
+
+@pytest.fixture(autouse=True)
+def clean_pending():
+    instrumentation.pending.clear()
+    yield
+    instrumentation.pending.clear()
+
+
+def test_field_name():
+    assert instrumentation.field_name('tscached_kqueries_total', {'mode': 'hot'}) == 'tscached_kqueries_total|mode=hot'
+    assert instrumentation.field_name('x', {'b': 1, 'a': 2}) == 'x|a=2,b=1'
+    assert instrumentation.field_name('x', {}) == 'x|'
+
+
+def test_incr():
+    instrumentation.incr('tscached_kqueries_total', mode='hot')
+    instrumentation.incr('tscached_kqueries_total', 2, mode='hot')
+    instrumentation.incr('not_a_metric')
+    assert instrumentation.pending == {'tscached_kqueries_total|mode=hot': 3}
+
+
+def test_observe_buckets_are_cumulative():
+    instrumentation.observe('tscached_readahead_seconds', 0.3)
+    pending = instrumentation.pending
+    assert 'tscached_readahead_seconds_bucket|le=0.25' not in pending
+    assert pending['tscached_readahead_seconds_bucket|le=0.5'] == 1
+    assert pending['tscached_readahead_seconds_bucket|le=60'] == 1
+    assert pending['tscached_readahead_seconds_bucket|le=+Inf'] == 1
+    assert pending['tscached_readahead_seconds_count|'] == 1
+    assert pending['tscached_readahead_seconds_sum|'] == 0.3
+
+
+def test_execute():
+    pipeline = mock.MagicMock()
+    pipeline.__len__.return_value = 4
+    pipeline.execute.return_value = [1, 2, 3, 4]
+    assert instrumentation.execute(pipeline, 'cold') == [1, 2, 3, 4]
+    assert instrumentation.pending['tscached_redis_pipeline_commands_total|caller=cold'] == 4
+    assert instrumentation.pending['tscached_redis_pipelines_total|caller=cold'] == 1
+    assert instrumentation.pending['tscached_redis_pipeline_seconds_count|caller=cold'] == 1
+
+
+def test_flush():
+    redis_cli = mock.Mock()
+    pipeline = redis_cli.pipeline.return_value
+    instrumentation.incr('tscached_kqueries_total', mode='hot')
+    assert instrumentation.flush(redis_cli, force=True) == 1
+    pipeline.hincrbyfloat.assert_called_once_with('tscached:metrics', 'tscached_kqueries_total|mode=hot', 1)
+    assert instrumentation.pending == {}
+
+    instrumentation.incr('tscached_kqueries_total', mode='hot')
+    assert instrumentation.flush(redis_cli) == 0  # too soon
+    assert instrumentation.pending == {'tscached_kqueries_total|mode=hot': 1}
+
+
+def test_flush_failure_keeps_increments():
+    redis_cli = mock.Mock()
+    redis_cli.pipeline.return_value.execute.side_effect = redis.exceptions.ConnectionError('nope')
+    instrumentation.incr('tscached_kqueries_total', mode='hot')
+    assert instrumentation.flush(redis_cli, force=True) == 0
+    assert instrumentation.pending == {'tscached_kqueries_total|mode=hot': 1}
+
+
+def test_render():
+    fields = {
+        'tscached_kqueries_total|mode=hot': '12',
+        'tscached_kqueries_total|mode=cold_miss': '3',
+        'tscached_readahead_seconds_bucket|le=0.5': '1',
+        'tscached_readahead_seconds_bucket|le=+Inf': '2',
+        'tscached_readahead_seconds_bucket|le=10': '2',
+        'tscached_readahead_seconds_sum|': '7.25',
+        'tscached_readahead_seconds_count|': '2',
+        'something_else|': '1',
+    }
+    assert instrumentation.render(fields) == '\n'.join([
+        '# HELP tscached_kqueries_total KQueries answered, by cache mode.',
+        '# TYPE tscached_kqueries_total counter',
+        'tscached_kqueries_total{mode="cold_miss"} 3',
+        'tscached_kqueries_total{mode="hot"} 12',
+        '# HELP tscached_readahead_seconds Duration of readahead runs.',
+        '# TYPE tscached_readahead_seconds histogram',
+        'tscached_readahead_seconds_bucket{le="0.5"} 1',
+        'tscached_readahead_seconds_bucket{le="10"} 2',
+        'tscached_readahead_seconds_bucket{le="+Inf"} 2',
+        'tscached_readahead_seconds_count 2',
+        'tscached_readahead_seconds_sum 7.25',
+    ]) + '\n'
+
+
+@mock.patch('tscached.instrumentation.redis.StrictRedis')
+def test_install(m_redis):
+    app = flask.Flask('test_install')
+    app.config['tscached'] = {'redis': {'host': 'localhost', 'port': 6379}}
+    app.add_url_rule('/ping', 'ping', lambda: 'pong')
+    instrumentation.install(app)
+
+    assert app.test_client().get('/ping').status_code == 200
+    assert instrumentation.pending['tscached_requests_total|endpoint=ping,status=200'] == 1
+    assert instrumentation.pending['tscached_request_seconds_count|endpoint=ping'] == 1
+    assert instrumentation.pending['tscached_response_bytes_total|endpoint=ping'] == 4
@@ -0,0 +1,39 @@
+import hashlib
+
+import pytest
+
+from tscached import keys
+from tscached.keys import canonical_json
+from tscached.keys import normalize_numbers
+
+
+def test_normalize_numbers():
+    assert normalize_numbers({'a': 60.0, 'b': [1.5, 2.0, 'x'], 'c': True}) == {'a': 60, 'b': [1.5, 2, 'x'], 'c': True}
+    assert isinstance(normalize_numbers(60.0), int)
+
+
+def test_canonical_json_is_order_independent():
+    first = {'name': 'loadavg.05', 'tags': {'host': ['a'], 'dc': ['b']}, 'aggregators': [{'value': 1.0}]}
+    second = {'aggregators': [{'value': 1}], 'tags': {'dc': ['b'], 'host': ['a']}, 'name': 'loadavg.05'}
+    assert canonical_json(first) == canonical_json(second)
+    assert canonical_json(first) == ('{"aggregators":[{"value":1}],"name":"loadavg.05",'
+                                     '"tags":{"dc":["b"],"host":["a"]}}')
+
+
+def test_configure():
+    try:
+        keys.configure({})
+        assert keys.digest('hello') == hashlib.md5('hello').hexdigest()
+
+        with pytest.raises(ValueError):
+            keys.configure({'keys': {'hash': 'no-such-hash'}})
+
+        if keys.HASHES['blake2']:
+            keys.configure({'keys': {'hash': 'blake2'}})
+            assert keys.digest('hello') != hashlib.md5('hello').hexdigest()
+        else:
+            with pytest.raises(ValueError):
+                keys.configure({'keys': {'hash': 'blake2'}})
+            assert keys.digest('hello') == hashlib.md5('hello').hexdigest()
+    finally:
+        keys.configure({})
@@ -7,8 +7,12 @@ from mock import patch
 import pytest
 
 from testing.mock_redis import MockRedis
+from tscached import circuit
+from tscached.circuit import InFlightLimit
 from tscached.kquery import KQuery
+from tscached.mts import MTS
 from tscached.utils import BackendQueryFailure
+from tscached.utils import KairosUnavailable
 
 
 def test__init__etc():
@@ -27,6 +31,58 @@ def test__init__etc():
     assert kq.key_basis() == {'wubbalubba': 'dubdub'}
 
 
+def test_clone():
+    redis_cli = MockRedis()
+    kq = KQuery(redis_cli)
+    kq.query = {'name': 'loadavg.05', 'tags': {'host': ['a']}}
+    kq.redis_key = 'tscached:kquery:WAT'
+    kq.cached_data = {'last_add_data': 1234}
+    kq.window_size = datetime.timedelta(minutes=1)
+
+    new = kq.clone()
+    assert new.redis_client is redis_cli
+    assert new.get_key() == 'tscached:kquery:WAT'
+    assert new.query == kq.query and new.query is not kq.query
+    assert new.cached_data == kq.cached_data and new.cached_data is not kq.cached_data
+    assert new.window_size == kq.window_size
+
+
+def test_key_is_normalized():
+    first = KQuery(MockRedis())
+    first.query = {'name': 'loadavg.05', 'tags': {'host': ['web2', 'web1']},
+                   'aggregators': [{'name': 'avg', 'sampling': {'value': 60, 'unit': 'minutes'}}]}
+    second = KQuery(MockRedis())
+    second.query = {'tags': {'host': ['web1', 'web2']}, 'name': 'loadavg.05', 'group_by': [],
+                    'aggregators': [{'name': 'avg', 'sampling': {'value': '1', 'unit': 'hours'}}]}
+    assert first.get_key() == second.get_key()
+    assert first.query['tags']['host'] == ['web2', 'web1']  # what goes to Kairos is untouched
+
+
+def test_get_mts_query_basis():
+    kq = KQuery(MockRedis())
+    kq.query = {'name': 'loadavg.05', 'tags': {'host': ['web2', 'web1'], 'dc': 'east'}, 'limit': '10',
+                'group_by': [{'name': 'tag', 'tags': ['host']}], 'mts_keys': ['tscached:mts:1']}
+    basis = kq.get_mts_query_basis()
+    assert basis == '{"limit":10,"tags":{"dc":["east"],"host":["web1","web2"]}}'
+    assert kq.get_mts_query_basis() is basis
+
+    kq = KQuery(MockRedis())
+    kq.query = {'name': 'loadavg.05'}
+    assert kq.get_mts_query_basis() == '{}'
+
+
+def test_total_bytes():
+    class FakeMTS():
+        def __init__(self, size):
+            self.size = size
+
+    kq = KQuery(MockRedis())
+    assert kq.total_bytes() == 0
+    kq.add_mts(FakeMTS(100))
+    kq.add_mts(FakeMTS(23))
+    assert kq.total_bytes() == 123
+
+
 def test_from_request():
     redis_cli = MockRedis()
     example_request = {
@@ -99,6 +155,7 @@ def test_proxy_to_kairos(m_query_kairos):
 
 
 @freeze_time("2016-01-01 00:00:00", tz_offset=-8)
+@patch('tscached.kquery.circuit.in_flight', InFlightLimit(4))
 @patch('tscached.kquery.query_kairos', autospec=True)
 def test_proxy_to_kairos_chunked_happy(m_query_kairos):
     m_query_kairos.return_value = {'queries': [{'name': 'first'}, {'name', 'second'}]}
@@ -114,13 +171,41 @@ def test_proxy_to_kairos_chunked_happy(m_query_kairos):
     assert m_query_kairos.call_count == 2
     expected_query = {'cache_time': 0, 'metrics': [{'hello': 'goodbye'}]}
 
+    # Chunks run on their own threads, so they may reach Kairos in either order.
+    calls = sorted(m_query_kairos.call_args_list, key=lambda c: c[0][2]['start_absolute'], reverse=True)
     expected_query['start_absolute'] = int((then - diff).strftime('%s')) * 1000
     expected_query['end_absolute'] = int((then).strftime('%s')) * 1000
-    assert m_query_kairos.call_args_list[0] == (('localhost', 8080, expected_query), {'propagate': False})
+    assert calls[0] == (('localhost', 8080, expected_query), {'propagate': False, 'reserved': True})
 
     expected_query['start_absolute'] = int((then - diff - diff).strftime('%s')) * 1000
     expected_query['end_absolute'] = int((then - diff).strftime('%s')) * 1000
-    assert m_query_kairos.call_args_list[1] == (('localhost', 8080, expected_query), {'propagate': False})
+    assert calls[1] == (('localhost', 8080, expected_query), {'propagate': False, 'reserved': True})
+    assert circuit.in_flight.used == 0  # every slot given back
+
+
+@patch('tscached.kquery.query_kairos', autospec=True)
+def test_proxy_to_kairos_chunked_takes_room_for_all_chunks(m_query_kairos):
+    m_query_kairos.return_value = {'queries': []}
+    kq = KQuery(MockRedis())
+    kq.query = {'hello': 'goodbye'}
+    then = datetime.datetime.fromtimestamp(1234567890)
+    diff = datetime.timedelta(minutes=30)
+    time_ranges = [(then - diff, then), (then - diff - diff, then - diff)]
+
+    limit = InFlightLimit(3)
+    with patch('tscached.kquery.circuit.in_flight', limit):
+        limit.acquire(2)  # only one slot left: not enough for both chunks.
+        with pytest.raises(KairosUnavailable):
+            kq.proxy_to_kairos_chunked('localhost', 8080, time_ranges)
+        assert m_query_kairos.call_count == 0
+
+        limit.release(2)
+        assert len(kq.proxy_to_kairos_chunked('localhost', 8080, time_ranges)) == 2
+        assert limit.used == 0
+
+    m_query_kairos.return_value = {'error': 'circuit is open', 'status_code': 503, 'unavailable': True}
+    with pytest.raises(KairosUnavailable):
+        kq.proxy_to_kairos_chunked('localhost', 8080, time_ranges)
 
 
 @freeze_time("2016-01-01 00:00:00", tz_offset=-8)
@@ -133,14 +218,18 @@ def test_proxy_to_kairos_chunked_raises_except(m_query_kairos):
     then = datetime.datetime.fromtimestamp(1234567890)
     diff = datetime.timedelta(minutes=30)
     time_ranges = [(then - diff, then), (then - diff - diff, then - diff)]
-    with pytest.raises(BackendQueryFailure):
+    with pytest.raises(BackendQueryFailure) as e:
         kq.proxy_to_kairos_chunked('localhost', 8080, time_ranges)
+    assert 'some error message' in e.value.message
+    assert not isinstance(e.value, KairosUnavailable)
 
 
 @freeze_time("2016-01-01 00:00:00", tz_offset=-8)
 def test_upsert():
 
     class FakeMTS():
+        result = None
+
         def get_key(self):
             return 'rick-and-morty'
 
@@ -161,3 +250,35 @@ def test_upsert():
     assert redis_cli.get_call_count == 0
     assert kq.query['last_add_data'] == 1234569890
     assert kq.query['earliest_data'] == 1234567890
+
+
+def test_upsert_stores_mts_groups():
+    kq = KQuery(MockRedis())
+    kq.query = {'name': 'loadavg.05', 'group_by': [{'name': 'tag', 'tags': ['host']}]}
+    hosts = {}
+    for host in ['web1', 'web2']:
+        mts = MTS(MockRedis())
+        mts.result = {'name': 'loadavg.05', 'values': [[789, 10]],
+                      'group_by': [{'name': 'tag', 'tags': ['host'], 'group': {'host': host}}]}
+        kq.add_mts(mts)
+        hosts[mts.get_key()] = host
+    kq.upsert(datetime.datetime.fromtimestamp(1234567890), None)
+    assert len(kq.query['mts_groups']) == 2
+    for mts_key, groups in zip(kq.query['mts_keys'], kq.query['mts_groups']):
+        assert groups == {'host': hosts[mts_key]}
+
+
+@patch('tscached.kquery.query_kairos', autospec=True)
+def test_proxy_to_kairos_chunked_timeout(m_query_kairos):
+    def _slow(*args, **kwargs):
+        time.sleep(1)
+        return {'queries': []}
+    m_query_kairos.side_effect = _slow
+
+    kq = KQuery(MockRedis())
+    kq.query = {'hello': 'goodbye'}
+    then = datetime.datetime.fromtimestamp(1234567890)
+    diff = datetime.timedelta(minutes=30)
+    time_ranges = [(then - diff, then), (then - diff - diff, then - diff)]
+    with pytest.raises(BackendQueryFailure):
+        kq.proxy_to_kairos_chunked('localhost', 8080, time_ranges, timeout=0.05)
@@ -0,0 +1,78 @@
+import mock
+import pytest
+
+from tscached.meta_index import build_index
+from tscached.meta_index import glob_escape
+from tscached.meta_index import search_index
+from tscached.meta_index import search_list
+from tscached.meta_index import SUBSTRING
+
+
+def test_build_index():
+    redis_cli = mock.Mock()
+    pipeline = redis_cli.pipeline.return_value
+    assert build_index(redis_cli, 'metricnames', '{"results": ["b", "a", "\\u00e9t\\u00e9"]}', 600) == 3
+    building = pipeline.zadd.call_args[0][0]
+    assert building.startswith('tscached:meta_index:metricnames:building:')
+    pipeline.zadd.assert_called_once_with(building, 0, 'b', 0, 'a', 0, '\xc3\xa9t\xc3\xa9')
+    pipeline.rename.assert_called_once_with(building, 'tscached:meta_index:metricnames')
+    pipeline.expire.assert_called_once_with('tscached:meta_index:metricnames', 600)
+
+
+def test_build_index_unique_building_keys():
+    redis_cli = mock.Mock()
+    pipeline = redis_cli.pipeline.return_value
+    build_index(redis_cli, 'metricnames', '{"results": ["a"]}', 600)
+    build_index(redis_cli, 'metricnames', '{"results": ["a"]}', 600)
+    first, second = [call[0][0] for call in pipeline.zadd.call_args_list]
+    assert first != second
+
+
+def test_search_index_limit():
+    with pytest.raises(ValueError):
+        search_index(mock.Mock(), 'metricnames', 'load', limit=0)
+
+
+def test_build_index_empty():
+    redis_cli = mock.Mock()
+    assert build_index(redis_cli, 'tagnames', '{"results": []}', 600) == 0
+    redis_cli.pipeline.return_value.delete.assert_any_call('tscached:meta_index:tagnames')
+
+
+def test_search_index_prefix():
+    redis_cli = mock.Mock()
+    redis_cli.zlexcount.return_value = 5
+    redis_cli.zrangebylex.return_value = ['loadavg.05']
+    assert search_index(redis_cli, 'metricnames', 'load', limit=1, offset=2) == (['loadavg.05'], 5)
+    redis_cli.zrangebylex.assert_called_once_with('tscached:meta_index:metricnames', '[load', '[load\xff',
+                                                  start=2, num=1)
+
+    search_index(redis_cli, 'metricnames', '')
+    redis_cli.zlexcount.assert_called_with('tscached:meta_index:metricnames', '-', '+')
+
+
+def test_search_index_substring():
+    redis_cli = mock.Mock()
+    redis_cli.zscan_iter.return_value = iter([('c.load', 0), ('a.load', 0), ('b.load', 0)])
+    assert search_index(redis_cli, 'metricnames', 'lo*', SUBSTRING, limit=2, offset=1) == (['b.load', 'c.load'], 3)
+    redis_cli.zscan_iter.assert_called_once_with('tscached:meta_index:metricnames', match='*lo\\**', count=1000)
+
+    # ZSCAN can return a member twice.
+    redis_cli.zscan_iter.return_value = iter([('b.load', 0), ('a.load', 0), ('b.load', 0)])
+    assert search_index(redis_cli, 'metricnames', 'load', SUBSTRING) == (['a.load', 'b.load'], 2)
+
+
+def test_search_index_missing():
+    redis_cli = mock.Mock()
+    redis_cli.exists.return_value = False
+    assert search_index(redis_cli, 'metricnames', 'load') is None
+
+
+def test_glob_escape():
+    assert glob_escape('a*b?[c]\\') == 'a\\*b\\?\\[c\\]\\\\'
+
+
+def test_search_list():
+    values = ['cpu.user', 'loadavg.05', 'loadavg.01', 'mem.load']
+    assert search_list(values, 'loadavg', limit=1) == (['loadavg.01'], 2)
+    assert search_list(values, 'load', SUBSTRING) == (['loadavg.01', 'loadavg.05', 'mem.load'], 3)
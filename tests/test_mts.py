@@ -8,7 +8,12 @@ import simplejson as json
 
 from testing.mock_redis import MockRedis
 from tscached.kquery import KQuery
+from tscached.keys import canonical_json
+from tscached.mts import hashable_for
+from tscached.mts import key_basis_for
+from tscached.mts import query_basis_for
 from tscached.mts import MTS
+from tscached.mts import MTSHandle
 
 
 INITIAL_MTS_DATA = [
@@ -19,14 +24,21 @@ INITIAL_MTS_DATA = [
 MTS_CARDINALITY = {
                     'tags': {'ecosystem': ['dev'], 'hostname': ['dev1']},
                     'group_by': {'name': 'tag', 'tags': ['habitat']},
-                    'aggregators': {
-                                    'name': 'sum',
-                                    'align_sampling': True,
-                                    'sampling': {'value': 10, 'unit': 'seconds'}
-                                   },
+                    'aggregators': [{
+                                     'name': 'sum',
+                                     'align_sampling': True,
+                                     'sampling': {'value': 10, 'unit': 'seconds'}
+                                    }],
                     'name': 'loadavg.05'
                   }
 
+# its key basis: name and group from the result, the rest from the query.
+MTS_CARDINALITY_BASIS = {
+                         'name': 'loadavg.05',
+                         'group_by': MTS_CARDINALITY['group_by'],
+                         'query': {'tags': MTS_CARDINALITY['tags'], 'aggregators': MTS_CARDINALITY['aggregators']}
+                        }
+
 
 def test_from_result():
     """ Test from_result """
@@ -47,6 +59,90 @@ def test_from_result():
     assert redis_cli.set_call_count == 0 and redis_cli.get_call_count == 0
 
 
+def test_handles_from_result():
+    redis_cli = MockRedis()
+    results = {'results': [{'name': 'loadavg.05', 'group_by': [{'name': 'tag', 'tags': ['host']}],
+                            'tags': {'host': ['web1']}, 'values': [[1000, 1]]},
+                           {'name': 'loadavg.05', 'group_by': [{'name': 'tag', 'tags': ['host']}],
+                            'tags': {'host': ['web2']}, 'values': []}]}
+    kq = KQuery(redis_cli)
+    kq.query = {'name': 'loadavg.05', 'tags': {'host': ['web1', 'web2']}}
+    ret_vals = MTS.handles_from_result(results, kq)
+    assert isinstance(ret_vals, GeneratorType)
+    handles = list(ret_vals)
+    assert len(handles) == 2
+    assert all(isinstance(h, MTSHandle) for h in handles)
+    assert not hasattr(handles[0], '__dict__')
+    assert handles[0].result is results['results'][0]
+
+    # Handles must derive exactly the key a full MTS would.
+    full = list(MTS.from_result(results, redis_cli, kq))
+    assert handles[0].get_key() == full[0].get_key()
+    assert handles[1].get_key() == full[1].get_key()
+    assert redis_cli.set_call_count == 0 and redis_cli.get_call_count == 0
+
+
+def test_handle_extend_and_materialize():
+    redis_cli = MockRedis()
+    first = MTSHandle({'name': 'loadavg.05', 'values': [[1000, 1]]}, {}, '{}')
+    second = MTSHandle({'name': 'loadavg.05', 'values': [[2000, 2]]}, {}, '{}')
+    first.extend(second)
+    assert first.result['values'] == [[1000, 1], [2000, 2]]
+
+    first.result['tags'] = {'host': ['web1']}
+    first.extend(MTSHandle({'name': 'loadavg.05', 'values': [[3000, 3]], 'tags': {'host': ['web2'], 'dc': ['east']}},
+                           {}, '{}'))
+    assert first.result['tags'] == {'host': ['web1', 'web2'], 'dc': ['east']}
+
+    mts = first.materialize(redis_cli)
+    assert isinstance(mts, MTS)
+    assert mts.result is first.result
+    assert mts.redis_client is redis_cli
+    assert mts.get_key() == first.get_key()
+
+
+def test_hashable_for_matches_canonical_basis():
+    query_mask = {'name': 'loadavg.05', 'tags': {'host': ['web2', 'web1'], 'dc': ['east']},
+                  'aggregators': [{'name': 'avg', 'sampling': {'value': 1.0, 'unit': 'minutes'}}]}
+    result = {'name': 'loadavg.05', 'group_by': [{'name': 'tag', 'tags': ['host']}],
+              'tags': {'host': ['web1']}, 'values': []}
+    expected = canonical_json(key_basis_for(result, query_mask))
+    assert hashable_for(result, canonical_json(query_basis_for(query_mask))) == expected
+    assert hashable_for({'name': 'loadavg.05'}, '{}') == canonical_json({'name': 'loadavg.05', 'query': {}})
+
+
+def test_make_key_is_order_independent():
+    first = MTS(MockRedis())
+    first.query_mask = {'tags': {'host': ['web1'], 'dc': ['east']},
+                        'aggregators': [{'name': 'avg', 'align_start_time': True}]}
+    first.result = {'name': 'loadavg.05'}
+    second = MTS(MockRedis())
+    second.query_mask = {'aggregators': [{'align_start_time': True, 'name': 'avg'}],
+                         'tags': {'dc': ['east'], 'host': ['web1']}}
+    second.result = {'name': 'loadavg.05'}
+    assert first.get_key() == second.get_key()
+    assert first.get_key().startswith('tscached:mts:')
+
+
+def test_make_key_depends_on_query_fields():
+    """ Kairos results don't echo aggregators back, so they must come from the query. """
+    base = {'name': 'loadavg.05', 'aggregators': [{'name': 'sum', 'sampling': {'value': 10, 'unit': 'seconds'}}]}
+    variants = [base, dict(base, aggregators=[{'name': 'max', 'sampling': {'value': 5, 'unit': 'minutes'}}]),
+                dict(base, limit=10), dict(base, order='desc'), dict(base, exclude_tags=True)]
+    keys = set()
+    for query_mask in variants:
+        mts = MTS(MockRedis())
+        mts.query_mask = query_mask
+        mts.result = {'name': 'loadavg.05', 'values': []}
+        keys.add(mts.get_key())
+    assert len(keys) == len(variants)
+
+    mts = MTS(MockRedis())
+    mts.query_mask = dict(base, mts_keys=['tscached:mts:1'], earliest_data=1, last_add_data=2)  # bookkeeping
+    mts.result = {'name': 'loadavg.05', 'values': []}
+    assert mts.get_key() in keys
+
+
 def test_from_cache():
     redis_cli = MockRedis()
     keys = ['key1', 'key2', 'key3']
@@ -68,11 +164,11 @@ def test_key_basis_simple():
     mts = MTS(MockRedis())
     mts.query_mask = MTS_CARDINALITY
     mts.result = MTS_CARDINALITY
-    assert mts.key_basis() == MTS_CARDINALITY
+    assert mts.key_basis() == MTS_CARDINALITY_BASIS
 
 
 def test_key_basis_removes_bad_data():
-    """ should remove data not in tags, group_by, aggregators, name. see below for query masking."""
+    """ should remove data not in name, group_by and the query's fields. see below for query masking."""
     mts = MTS(MockRedis())
     cardinality_with_bad_data = copy.deepcopy(MTS_CARDINALITY)
     cardinality_with_bad_data = copy.deepcopy(MTS_CARDINALITY)
@@ -80,7 +176,7 @@ def test_key_basis_removes_bad_data():
 
     mts.query_mask = MTS_CARDINALITY
     mts.result = cardinality_with_bad_data
-    assert mts.key_basis() == MTS_CARDINALITY
+    assert mts.key_basis() == MTS_CARDINALITY_BASIS
 
 
 def test_key_basis_does_query_masking():
@@ -91,8 +187,8 @@ def test_key_basis_does_query_masking():
     mts.query_mask = {'tags': {'ecosystem': ['dev']}}
     mts.result = MTS_CARDINALITY
     basis = mts.key_basis()
-    assert 'ecosystem' in basis['tags']
-    assert 'hostname' not in basis['tags']
+    assert 'ecosystem' in basis['query']['tags']
+    assert 'hostname' not in basis['query']['tags']
 
 
 def test_key_basis_no_unset_keys():
@@ -102,7 +198,7 @@ def test_key_basis_no_unset_keys():
     del mts_cardinality['group_by']
     mts.result = mts_cardinality
     mts.query_mask = mts_cardinality
-    assert mts.key_basis() == mts_cardinality
+    assert mts.key_basis() == {'name': 'loadavg.05', 'query': MTS_CARDINALITY_BASIS['query']}
     assert 'group_by' not in mts.key_basis().keys()
 
 
@@ -174,6 +270,25 @@ def test_merge_at_end_one_overlap():
     assert mts.result['values'][-3:] == [[799, 9001], [800, 21], [801, 22]]
 
 
+def test_merge_unions_tags_only_when_merged():
+    mts = MTS(MockRedis())
+    mts.key_basis = lambda: 'some-key-goes-here'
+    new_mts = MTS(MockRedis())
+
+    mts.result = {'values': copy.deepcopy(INITIAL_MTS_DATA), 'tags': {'host': ['web1']}}
+    new_mts.result = {'values': [[801, 22]], 'tags': {'host': ['web2']}}
+    mts.merge_at_end(new_mts)
+    assert mts.result['tags'] == {'host': ['web1', 'web2']}
+
+    new_mts.result = {'values': [[700, 22]], 'tags': {'host': ['web3']}}
+    mts.merge_at_beginning(new_mts)
+    assert mts.result['tags'] == {'host': ['web1', 'web2', 'web3']}
+
+    new_mts.result = {'values': [[100, 1]], 'tags': {'host': ['web4']}}  # far too much overlap: not merged
+    mts.merge_at_end(new_mts)
+    assert mts.result['tags'] == {'host': ['web1', 'web2', 'web3']}
+
+
 def test_merge_at_end_replaces_when_existing_data_is_short():
     """ if we can't iterate over the cached data, and it's out of order, we replace it. """
     mts = MTS(MockRedis())
@@ -334,3 +449,26 @@ def test_build_response_yes_trim_efficient_not_ok(m_conforms, m_efficient, m_rob
     assert m_efficient.call_count == 0
     assert m_robust.call_args_list[0][0] == (datetime.datetime.fromtimestamp(1234567880), None)
     assert m_robust.call_args_list[1][0] == (datetime.datetime.fromtimestamp(1234567880), None)
+
+
+def test_serialize_tracks_size():
+    mts = MTS(MockRedis())
+    mts.result = {'name': 'loadavg.05', 'values': [[789, 10]]}
+    serialized = mts.serialize()
+    assert json.loads(serialized) == mts.result
+    assert mts.size == len(serialized)
+
+
+def test_from_cache_tracks_size():
+    redis_cli = mock.Mock()
+    redis_cli.pipeline.return_value.execute.return_value = ['{"values": [[789, 10]]}']
+    values = list(MTS.from_cache(['key1'], redis_cli))
+    assert values[0].size == len('{"values": [[789, 10]]}')
+
+
+def test_from_cache_keeps_lists():
+    redis_cli = mock.Mock()
+    redis_cli.pipeline.return_value.execute.return_value = ['{"values": [[789, 10], [790, 1.5]]}']
+    values = list(MTS.from_cache(['key1'], redis_cli))
+    assert values[0].result['values'] == [[789, 10], [790, 1.5]]
+    assert isinstance(values[0].result['values'], list)
@@ -0,0 +1,60 @@
+import simplejson as json
+
+from testing.mock_redis import MockRedis
+from tscached.negative import REASON_EMPTY
+from tscached.negative import REASON_ERROR
+from tscached.negative import get_negative
+from tscached.negative import negative_key
+from tscached.negative import set_negative
+
+
+def test_negative_key():
+    assert negative_key('tscached:kquery:deadbeef') == 'tscached:negative:deadbeef'
+
+
+HOUR = {'start_relative': {'value': '1', 'unit': 'hours'}}
+WEEK = {'start_relative': {'value': '1', 'unit': 'weeks'}}
+
+
+def test_get_negative_miss():
+    redis_cli = MockRedis()
+    redis_cli.get = lambda key: None
+    assert get_negative(redis_cli, 'tscached:kquery:deadbeef', HOUR) is None
+
+
+def test_get_negative_hit():
+    redis_cli = MockRedis()
+    redis_cli.get = lambda key: json.dumps({'reason': 'empty', 'time_range': HOUR})
+    assert get_negative(redis_cli, 'tscached:kquery:deadbeef', HOUR) == {'reason': 'empty', 'time_range': HOUR}
+
+
+def test_get_negative_other_time_range():
+    redis_cli = MockRedis()
+    assert get_negative(redis_cli, 'tscached:kquery:deadbeef', HOUR) is None  # entry without a range
+    assert redis_cli.get_parms == [['tscached:negative:deadbeef']]
+    redis_cli.get = lambda key: json.dumps({'reason': 'empty', 'time_range': HOUR})
+    assert get_negative(redis_cli, 'tscached:kquery:deadbeef', WEEK) is None
+
+
+def test_set_negative_defaults():
+    redis_cli = MockRedis()
+    assert set_negative({}, redis_cli, 'tscached:kquery:deadbeef', HOUR, REASON_EMPTY) is True
+    assert redis_cli.set_parms[0][0] == 'tscached:negative:deadbeef'
+    assert json.loads(redis_cli.set_parms[0][1]) == {'reason': 'empty', 'time_range': HOUR}
+    assert redis_cli.set_parms[0][2] == {'ex': 60}
+
+
+def test_set_negative_error_with_message():
+    redis_cli = MockRedis()
+    config = {'negative_cache': {'error_expiry': 5}}
+    assert set_negative(config, redis_cli, 'tscached:kquery:deadbeef', HOUR, REASON_ERROR, 'oops') is True
+    assert redis_cli.set_parms[0][0] == 'tscached:negative:deadbeef'
+    assert json.loads(redis_cli.set_parms[0][1]) == {'reason': 'error', 'time_range': HOUR, 'message': 'oops'}
+    assert redis_cli.set_parms[0][2] == {'ex': 5}
+
+
+def test_set_negative_disabled():
+    redis_cli = MockRedis()
+    config = {'negative_cache': {'empty_expiry': 0}}
+    assert set_negative(config, redis_cli, 'tscached:kquery:deadbeef', HOUR, REASON_EMPTY) is False
+    assert redis_cli.set_call_count == 0
@@ -0,0 +1,55 @@
+from tscached.normalize import normalize_aggregator
+from tscached.normalize import normalize_number
+from tscached.normalize import normalize_query
+from tscached.normalize import normalize_sampling
+from tscached.normalize import normalize_tags
+
+
+def test_normalize_number():
+    assert normalize_number('1') == 1 and isinstance(normalize_number('1'), int)
+    assert normalize_number(1.0) == 1 and isinstance(normalize_number(1.0), int)
+    assert normalize_number('0.5') == 0.5
+    assert normalize_number('wat') == 'wat'
+    assert normalize_number(True) is True
+
+
+def test_normalize_sampling():
+    assert normalize_sampling({'value': 60, 'unit': 'minutes'}) == {'value': 1, 'unit': 'hours'}
+    assert normalize_sampling({'value': '3600', 'unit': 'Seconds'}) == {'value': 1, 'unit': 'hours'}
+    assert normalize_sampling({'value': 90, 'unit': 'seconds'}) == {'value': 90, 'unit': 'seconds'}
+    assert normalize_sampling({'value': 0.5, 'unit': 'minutes'}) == {'value': 30, 'unit': 'seconds'}
+    assert normalize_sampling({'value': 14, 'unit': 'days'}) == {'value': 2, 'unit': 'weeks'}
+    assert normalize_sampling({'value': 12, 'unit': 'months'}) == {'value': 12, 'unit': 'months'}
+
+
+def test_normalize_tags():
+    assert normalize_tags({'host': ['web2', 'web1', 'web2'], 'port': [8080], 'dc': 'east'}) == \
+        {'host': ['web1', 'web2'], 'port': ['8080'], 'dc': ['east']}
+    assert normalize_tags(None) == {}
+
+
+def test_normalize_aggregator():
+    agg = {'name': 'div', 'divisor': '2', 'align_start_time': False, 'align_end_time': True}
+    assert normalize_aggregator(agg) == {'name': 'div', 'divisor': 2, 'align_end_time': True}
+
+
+def test_normalize_query_equivalent_spellings():
+    first = {'name': 'loadavg.05', 'tags': {'host': ['web1', 'web2']},
+             'aggregators': [{'name': 'avg', 'sampling': {'value': 1, 'unit': 'hours'}}]}
+    second = {'name': 'loadavg.05', 'tags': {'host': ['web2', 'web1']}, 'group_by': [], 'order': 'asc',
+              'exclude_tags': False,
+              'aggregators': [{'name': 'avg', 'align_end_time': False,
+                               'sampling': {'value': '60', 'unit': 'minutes'}}]}
+    assert normalize_query(first) == normalize_query(second)
+
+
+def test_normalize_query_keeps_meaning():
+    query = {'name': 'loadavg.05', 'order': 'desc', 'limit': '10',
+             'group_by': [{'name': 'tag', 'tags': ['host', 'dc']}],
+             'aggregators': [{'name': 'avg'}, {'name': 'sum'}]}
+    normalized = normalize_query(query)
+    assert normalized['order'] == 'desc'
+    assert normalized['limit'] == 10
+    assert normalized['group_by'] == [{'name': 'tag', 'tags': ['dc', 'host']}]
+    assert [a['name'] for a in normalized['aggregators']] == ['avg', 'sum']
+    assert query['group_by'][0]['tags'] == ['host', 'dc']  # input untouched
@@ -0,0 +1,130 @@
+import sys
+import threading
+
+import mock
+import pytest
+import redis
+import simplejson as json
+
+from tscached import profiler
+
+
+CONFIG = {'redis': {'host': 'localhost', 'port': 6379},
+          'profiler': {'enabled': True, 'interval': 0.001, 'max_duration': 5}}
+
+
+@pytest.fixture(autouse=True)
+def no_profiler_running():
+    profiler.stop()
+    yield
+    profiler.stop()
+
+
+def blocked_in_here(started, release):
+    started.set()
+    release.wait()
+
+
+def test_collapse():
+    def inner():
+        return profiler.collapse(sys._getframe())
+    stack = inner()
+    assert stack.endswith('test_collapse (test_profiler.py);inner (test_profiler.py)')
+    assert profiler.collapse(sys._getframe(), max_depth=1) == 'test_collapse (test_profiler.py)'
+
+
+def test_sample_sees_other_threads():
+    started, release = threading.Event(), threading.Event()
+    thr = threading.Thread(target=blocked_in_here, args=(started, release))
+    thr.start()
+    started.wait()
+    try:
+        prof = profiler.Profiler()
+        prof.sample()
+        prof.sample()
+    finally:
+        release.set()
+        thr.join()
+    assert prof.samples == 2
+    # it may still be on its way into release.wait() for the first sample, so count samples, not stacks.
+    stacks = [stack for stack in prof.stacks if 'blocked_in_here (test_profiler.py)' in stack]
+    assert sum([prof.stacks[stack] for stack in stacks]) == 2
+    assert not [stack for stack in prof.stacks if 'sample (profiler.py)' in stack]  # but not its own
+
+
+def test_sample_max_stacks():
+    prof = profiler.Profiler(max_stacks=1)
+    prof.stacks = {'a;b': 3}
+    prof.sample()
+    assert prof.stacks['a;b'] == 3
+    assert prof.stacks[profiler.TRUNCATED] >= 1
+    assert len(prof.stacks) == 2
+
+
+def test_run_is_bounded():
+    finished = []
+    prof = profiler.Profiler(interval=0.001, duration=0.02)
+    prof.start(on_finish=finished.append)
+    prof.thread.join(5)
+    assert finished == [prof]
+    assert prof.samples >= 1
+    assert not prof.summary()['running']
+
+
+def test_start_disabled():
+    assert profiler.start({'profiler': {'enabled': False}}) == (None, mock.ANY)
+    assert profiler.running == {}
+
+
+@mock.patch('tscached.profiler.redis.StrictRedis')
+def test_start_stop(m_redis):
+    prof, message = profiler.start(CONFIG, duration=600)
+    assert prof.duration == 5  # capped at max_duration
+    assert profiler.start(CONFIG)[0] is prof  # one run per worker at a time
+    assert 'Already' in profiler.start(CONFIG)[1]
+    assert profiler.stop() is prof
+    assert profiler.running == {}
+    assert profiler.stop() is None
+    pipeline = m_redis.return_value.pipeline.return_value
+    assert pipeline.execute.call_count == 1
+    pipeline.hset.assert_called_once_with(profiler.PROFILES_KEY, profiler.worker_name(), mock.ANY)
+
+
+def test_save():
+    redis_client = mock.MagicMock()
+    prof = profiler.Profiler()
+    prof.stacks = {'a;b': 2}
+    assert profiler.save(redis_client, prof, 300) is True
+    pipeline = redis_client.pipeline.return_value
+    key = profiler.PROFILE_KEY % profiler.worker_name()
+    pipeline.delete.assert_called_once_with(key)
+    pipeline.hmset.assert_called_once_with(key, {'a;b': 2})
+    pipeline.expire.assert_any_call(key, 300)
+
+    pipeline.execute.side_effect = redis.exceptions.RedisError('down')
+    assert profiler.save(redis_client, prof, 300) is False
+
+
+def test_status():
+    redis_client = mock.MagicMock()
+    redis_client.hgetall.return_value = {'otherhost:1': json.dumps({'samples': 10})}
+    assert profiler.status(redis_client) == {'otherhost:1': {'samples': 10}}
+
+    profiler.running['profiler'] = profiler.Profiler()
+    try:
+        assert profiler.status(redis_client)[profiler.worker_name()]['running'] is True
+    finally:
+        profiler.running.clear()
+
+    redis_client.hgetall.side_effect = redis.exceptions.RedisError('down')
+    assert profiler.status(redis_client) == {}
+
+
+def test_collapsed():
+    redis_client = mock.MagicMock()
+    stored = {profiler.PROFILE_KEY % 'h:1': {'a;b': '2', 'a;c': '5'},
+              profiler.PROFILE_KEY % 'h:2': {'a;b': '4'}}
+    redis_client.hgetall.side_effect = lambda key: stored.get(key, {})
+    assert profiler.collapsed(redis_client, ['h:1', 'h:2']) == 'a;b 6\na;c 5\n'
+    assert profiler.collapsed(redis_client, ['h:2']) == 'a;b 4\n'
+    assert profiler.collapsed(redis_client, ['h:3']) == ''
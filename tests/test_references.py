@@ -0,0 +1,77 @@
+import datetime
+
+import mock
+
+from testing.mock_redis import MockRedis
+from tscached.mts import MTS
+from tscached.references import collect_orphans
+from tscached.references import mts_key_for
+from tscached.references import refreshed_elsewhere
+from tscached.references import refs_key
+from tscached.references import register_references
+from tscached.references import release_references
+
+
+def test_refs_key_roundtrip():
+    assert refs_key('tscached:mts:deadbeef') == 'tscached:mts_refs:deadbeef'
+    assert mts_key_for('tscached:mts_refs:deadbeef') == 'tscached:mts:deadbeef'
+
+
+def test_register_references_extends_to_longest_referrer():
+    redis_cli = mock.Mock()
+    pipeline = redis_cli.pipeline.return_value
+    # mts:1 has a referrer living longer than us; mts:2 is ours alone.
+    pipeline.execute.side_effect = [[1, ['1100', '5000'], 1, ['1100']], []]
+
+    register_references(redis_cli, 'tscached:kquery:WAT', ['tscached:mts:1', 'tscached:mts:2'], 100,
+                        now=1000)
+    pipeline.hset.assert_any_call('tscached:mts_refs:1', 'tscached:kquery:WAT', 1100)
+    pipeline.hset.assert_any_call('tscached:mts_refs:2', 'tscached:kquery:WAT', 1100)
+    assert pipeline.expire.call_args_list == [
+        (('tscached:mts:1', 4000), {}), (('tscached:mts_refs:1', 4000), {}),
+        (('tscached:mts:2', 100), {}), (('tscached:mts_refs:2', 100), {}),
+    ]
+
+
+def test_register_references_nothing_to_do():
+    redis_cli = mock.Mock()
+    register_references(redis_cli, 'tscached:kquery:WAT', [], 100)
+    assert redis_cli.pipeline.call_count == 0
+
+
+def test_release_references_deletes_orphans_only():
+    redis_cli = mock.Mock()
+    redis_cli.pipeline.return_value.execute.return_value = [1, 0, 1, 2]
+
+    orphans = release_references(redis_cli, 'tscached:kquery:WAT', ['tscached:mts:1', 'tscached:mts:2'])
+    assert orphans == ['tscached:mts:1']
+    redis_cli.delete.assert_called_once_with('tscached:mts:1', 'tscached:mts_refs:1')
+
+
+def test_collect_orphans():
+    redis_cli = mock.Mock()
+    redis_cli.scan_iter.return_value = iter(['tscached:mts_refs:1', 'tscached:mts_refs:2'])
+    redis_cli.hgetall.side_effect = [
+        {'tscached:kquery:gone': '5000', 'tscached:kquery:old': '10'},
+        {'tscached:kquery:gone': '5000', 'tscached:kquery:live': '5000'},
+    ]
+    alive = {'tscached:kquery:gone': False, 'tscached:kquery:old': True, 'tscached:kquery:live': True}
+    pipeline = redis_cli.pipeline.return_value
+    pipeline.execute.side_effect = lambda: [alive[c[0][0]] for c in pipeline.exists.call_args_list[-2:]]
+
+    assert collect_orphans(redis_cli, now=1000) == 1
+    redis_cli.delete.assert_called_once_with('tscached:mts:1', 'tscached:mts_refs:1')
+    redis_cli.hdel.assert_called_once_with('tscached:mts_refs:2', 'tscached:kquery:gone')
+
+
+def _mts_ending_at(end_ts):
+    mts = MTS(MockRedis())
+    mts.result = {'values': [[(end_ts - 10) * 1000, 1], [end_ts * 1000, 2]]}
+    return mts
+
+
+def test_refreshed_elsewhere():
+    end_needed = datetime.datetime.fromtimestamp(1000)
+    assert refreshed_elsewhere([_mts_ending_at(995), _mts_ending_at(1000)], end_needed, 10) == 995
+    assert refreshed_elsewhere([_mts_ending_at(980), _mts_ending_at(1000)], end_needed, 10) is False
+    assert refreshed_elsewhere([], end_needed, 10) is False
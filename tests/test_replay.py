@@ -0,0 +1,74 @@
+import mock
+import requests
+
+from tscached import replay
+
+
+CONFIG = {'data': {'staleness_threshold': 10}, 'chunking': {'chunk_length': 1800, 'max_chunks': 6}}
+QUERY = {'name': 'loadavg.1', 'aggregators': [{'name': 'avg', 'sampling': {'value': 1, 'unit': 'minutes'}}]}
+
+
+def entry(ts, key='tscached:kquery:a', hours=1):
+    return {'ts': ts, 'time_range': {'start_relative': {'value': hours, 'unit': 'hours'}},
+            'kqueries': [{'key': key, 'mode': 'hot', 'query': dict(QUERY)}]}
+
+
+def test_request_for():
+    assert replay.request_for(entry(1)) == {'start_relative': {'value': 1, 'unit': 'hours'}, 'metrics': [QUERY]}
+
+
+def test_hit_ratio():
+    assert replay.hit_ratio({}) is None
+    assert replay.hit_ratio({'hot': 3, 'cold_miss': 1}) == 0.75
+    assert replay.hit_ratio({'hot_superset': 1, 'warm_append': 1}) == 0.5
+
+
+def test_simulate():
+    trace = [
+        entry(1000000),  # cold, 2 chunks
+        entry(1000005),  # hot: within staleness_threshold
+        entry(1000100),  # warm: a window behind
+        entry(1000100, key='tscached:kquery:b'),  # cold
+        entry(1000100 + 10800 + 1),  # expired: cold again
+        entry(1000100 + 10800 + 2, hours=2),  # needs earlier, and (one second) later, data: 4 chunks
+    ]
+    result = replay.simulate(CONFIG, trace)
+    assert result['modes'] == {'cold_miss': 3, 'hot': 1, 'warm_append': 1, 'cold_overwrite': 1}
+    assert result['kairos_requests'] == 2 + 1 + 2 + 2 + 4
+    assert result['hit_ratio'] == round(1 / 6.0, 4)
+
+
+def test_captured_modes():
+    trace = [entry(1), entry(2)]
+    trace[1]['kqueries'][0]['mode'] = 'cold_miss'
+    assert replay.captured_modes(trace) == {'hot': 1, 'cold_miss': 1}
+
+
+def response_with(headers):
+    response = mock.Mock()
+    response.status_code = 200
+    response.headers = headers
+    return response
+
+
+def test_response_modes():
+    assert replay.response_modes(response_with({'X-tscached-mode': 'mixed', 'X-tscached-modes': 'hot,cold_miss'}),
+                                 2) == ['hot', 'cold_miss']
+    assert replay.response_modes(response_with({'X-tscached-mode': 'hot'}), 2) == ['hot', 'hot']
+    assert replay.response_modes(response_with({}), 1) == ['none']
+    assert replay.response_modes(None, 2) == ['none', 'none']
+
+
+@mock.patch('tscached.replay.requests.Session')
+def test_replay_live_counts_kqueries(m_session):
+    trace = [entry(1), entry(2)]
+    trace[0]['kqueries'].append(dict(trace[0]['kqueries'][0], key='tscached:kquery:b'))
+    m_session.return_value.post.side_effect = [
+        response_with({'X-tscached-mode': 'mixed', 'X-tscached-modes': 'hot,cold_miss'}),
+        requests.exceptions.ConnectionError('nope'),
+    ]
+    out = replay.replay_live(trace, 'http://localhost:8008', speed=1000, concurrency=1)
+    assert out['modes'] == {'hot': 1, 'cold_miss': 1, 'none': 1}
+    assert out['statuses'] == {200: 1, 'unreachable': 1}
+    assert out['hit_ratio'] == 0.3333
+    assert sum(out['modes'].values()) == sum(replay.captured_modes(trace).values())  # both count KQueries
@@ -189,11 +189,14 @@ def test_perform_readahead_redis_error(m_process, m_from_cache, m_release_leader
     assert m_process.call_count == 0
 
 
+@mock.patch('tscached.shadow.references.collect_orphans')
+@mock.patch('tscached.shadow.eviction.perform_eviction')
 @mock.patch('tscached.shadow.become_leader')
 @mock.patch('tscached.shadow.release_leader')
 @mock.patch('tscached.shadow.kquery.KQuery.from_cache')
 @mock.patch('tscached.shadow.cache_calls.process_cache_hit')
-def test_perform_readahead_backend_error(m_process, m_from_cache, m_release_leader, m_become_leader):
+def test_perform_readahead_backend_error(m_process, m_from_cache, m_release_leader, m_become_leader, m_evict,
+                                         m_collect):
     redis_cli = MockRedis()
 
     def _smem(_):
@@ -208,9 +211,13 @@ def test_perform_readahead_backend_error(m_process, m_from_cache, m_release_lead
         kqueries.append(kq)
     m_from_cache.return_value = kqueries
     m_process.side_effect = BackendQueryFailure('OOPS!')
+    m_evict.return_value = []
 
     assert perform_readahead({}, redis_cli) is None
     assert m_become_leader.call_count == 1
     assert m_release_leader.call_count == 1
     assert m_from_cache.call_count == 1
     assert m_process.call_count == 1
+    # budgets and orphans are still taken care of.
+    m_evict.assert_called_once_with({}, redis_cli)
+    m_collect.assert_called_once_with(redis_cli)
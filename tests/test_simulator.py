@@ -0,0 +1,70 @@
+from tscached import simulator
+
+
+CONFIG = {'data': {'staleness_threshold': 10}, 'chunking': {'chunk_length': 1800, 'max_chunks': 6}}
+QUERY = {'name': 'loadavg.1', 'aggregators': [{'name': 'avg', 'sampling': {'value': 1, 'unit': 'minutes'}}]}
+
+
+def entry(ts, key='tscached:kquery:a', hours=1, series=2, points=7200):
+    """ By default, 2 series with a point every second. """
+    return {'ts': ts, 'time_range': {'start_relative': {'value': hours, 'unit': 'hours'}},
+            'kqueries': [{'key': key, 'mode': 'hot', 'query': dict(QUERY), 'series': series, 'points': points}]}
+
+
+def test_simulate_load_and_memory():
+    result = simulator.simulate(CONFIG, [entry(1000000), entry(1000005), entry(1000100)])
+    assert result['modes'] == {'cold_miss': 1, 'hot': 1, 'warm_append': 1}
+    assert result['kairos_requests'] == 3
+    # cold: 2 series * 3600s; warm: 2 series * 160s (100s behind, plus one 60s window for the aggregator).
+    assert result['points_fetched'] == 7200 + 320
+    held = 3600 + 100 - 1  # the earliest chunk starts a second late
+    assert result['final_bytes'] == 2 * (simulator.BYTES_PER_SERIES + held * simulator.BYTES_PER_POINT)
+    assert result['peak_bytes'] == result['final_bytes']
+
+
+def test_simulate_expiry():
+    config = simulator.with_param(CONFIG, 'model.kquery_expiry', 60)
+    trace = [entry(1000000), entry(1000061), entry(1000200, key='tscached:kquery:b', points=0)]
+    result = simulator.simulate(config, trace)
+    assert result['modes'] == {'cold_miss': 3}
+    assert result['final_bytes'] == 2 * simulator.BYTES_PER_SERIES  # a expired; b holds no points
+    assert result['peak_bytes'] > result['final_bytes']
+
+
+def test_simulate_stale_grace():
+    config = simulator.with_param(CONFIG, 'data.stale_grace', 300)
+    result = simulator.simulate(config, [entry(1000000), entry(1000100)])
+    assert result['modes'] == {'cold_miss': 1, 'hot_stale': 1}
+    assert result['kairos_requests'] == 3
+    assert result['hit_ratio'] == 0.5
+
+
+def test_simulate_mts_ttl_trim():
+    config = simulator.with_param(CONFIG, 'model.mts_gc_expiry', 4000)
+    config = simulator.with_param(config, 'model.mts_expiry', 3600)
+    result = simulator.simulate(config, [entry(1000000), entry(1000500)])
+    assert result['modes'] == {'cold_miss': 1, 'warm_append': 1}
+    assert result['final_bytes'] == 2 * (simulator.BYTES_PER_SERIES + 3600 * simulator.BYTES_PER_POINT)
+
+
+def test_with_param():
+    config = simulator.with_param(CONFIG, 'chunking.chunk_length', 60)
+    assert config['chunking'] == {'chunk_length': 60, 'max_chunks': 6}
+    assert CONFIG['chunking']['chunk_length'] == 1800
+    assert simulator.with_param({}, 'top', 1) == {'top': 1}
+
+
+def test_parse_sweep():
+    assert simulator.parse_sweep(['chunking.chunk_length=1800,3600', 'data.stale_grace=0,1.5']) == [
+        ('chunking.chunk_length', [1800, 3600]), ('data.stale_grace', [0, 1.5])]
+
+
+def test_sweep_and_table():
+    trace = [entry(1000000, hours=3), entry(1000100, hours=3)]
+    rows = simulator.sweep(CONFIG, trace, [('chunking.chunk_length', [1800, 3600])])
+    assert [params for params, _ in rows] == [{'chunking.chunk_length': 1800}, {'chunking.chunk_length': 3600}]
+    assert [result['kairos_requests'] for _, result in rows] == [6 + 1, 3 + 1]
+
+    table = simulator.format_table(rows).split('\n')
+    assert table[0].split() == ['chunking.chunk_length', 'hit_ratio', 'kairos_reqs', 'points', 'peak_MB', 'final_MB']
+    assert table[1].split()[:3] == ['1800', '0.0', '7']
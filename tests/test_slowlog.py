@@ -0,0 +1,92 @@
+import mock
+import redis
+import simplejson as json
+
+from tscached import slowlog
+from tscached import timing
+from tscached.kquery import KQuery
+
+
+CONFIG = {'slow_query_log': {'enabled': True, 'threshold': 0.5, 'max_entries': 10}}
+
+
+def make_kquery(name):
+    return next(KQuery.from_request({'metrics': [{'name': name}]}, None))
+
+
+def make_timings(*totals_ms):
+    timings = timing.Timings()
+    for ndx, total_ms in enumerate(totals_ms):
+        timings.begin_kquery('tscached:kquery:%d' % ndx)
+        timings.add(timing.KAIROS, total_ms / 1000.0)
+        timings.note('range_needed', [100, 200, 'append'])
+        timings.note('chunks', [[100, 200]])
+        timings.end_kquery('warm_append')
+        timings.kqueries[-1]['total_ms'] = total_ms
+    return timings
+
+
+def test_entry():
+    kquery = make_kquery('loadavg.1')
+    response = {'sample_size': 5, 'results': [{'values': [[1, 2]] * 5}, {'values': []}]}
+    entry = slowlog.entry({'start_absolute': 1}, kquery, 'warm_append', response, make_timings(750).kqueries[0],
+                          now=12.3456)
+    assert entry == {
+        'ts': 12.346,
+        'key': kquery.get_key(),
+        'mode': 'warm_append',
+        'query': {'name': 'loadavg.1'},
+        'time_range': {'start_absolute': 1},
+        'range_needed': [100, 200, 'append'],
+        'chunks': [[100, 200]],
+        'kairos_chunks_ms': None,
+        'mts': 2,
+        'points': 5,
+        'total_ms': 750,
+        'phases_ms': {timing.KAIROS: 750.0},
+    }
+
+
+def test_record_only_slow():
+    redis_client = mock.MagicMock()
+    kqueries = [(make_kquery('fast'), 'hot', {}), (make_kquery('slow'), 'warm_append', {})]
+    assert slowlog.record(CONFIG, redis_client, {}, kqueries, make_timings(20, 600)) == 1
+    pipeline = redis_client.pipeline.return_value
+    assert pipeline.lpush.call_count == 1
+    assert json.loads(pipeline.lpush.call_args[0][1])['query'] == {'name': 'slow'}
+    pipeline.ltrim.assert_called_once_with(slowlog.SLOWLOG_KEY, 0, 9)
+
+    redis_client.reset_mock()
+    assert slowlog.record(CONFIG, redis_client, {}, kqueries, make_timings(20, 30)) == 0
+    assert redis_client.pipeline.call_count == 0
+
+
+def test_record_disabled():
+    redis_client = mock.MagicMock()
+    kqueries = [(make_kquery('slow'), 'cold_miss', {})]
+    assert slowlog.record({}, redis_client, {}, kqueries, make_timings(5000)) == 0
+    assert redis_client.pipeline.call_count == 0
+
+
+def test_record_redis_error():
+    redis_client = mock.MagicMock()
+    redis_client.pipeline.return_value.execute.side_effect = redis.exceptions.RedisError('down')
+    kqueries = [(make_kquery('slow'), 'cold_miss', {})]
+    assert slowlog.record(CONFIG, redis_client, {}, kqueries, make_timings(5000)) == 0
+
+
+def test_record_never_raises():
+    redis_client = mock.MagicMock()
+    kqueries = [(make_kquery('slow'), 'cold_miss', {})]
+    timings = make_timings(5000)
+    del timings.kqueries[0]['phases']
+    assert slowlog.record(CONFIG, redis_client, {}, kqueries, timings) == 0
+    assert slowlog.record(CONFIG, redis_client, {}, kqueries, None) == 0
+    assert redis_client.pipeline.call_count == 0
+
+
+def test_read():
+    redis_client = mock.MagicMock()
+    redis_client.lrange.return_value = [json.dumps({'key': 'b'}), json.dumps({'key': 'a'})]
+    assert slowlog.read(redis_client, 2) == [{'key': 'b'}, {'key': 'a'}]
+    redis_client.lrange.assert_called_once_with(slowlog.SLOWLOG_KEY, 0, 1)
@@ -0,0 +1,152 @@
+import datetime
+
+from freezegun import freeze_time
+import mock
+import simplejson as json
+
+from tscached import superset
+from tscached.kquery import KQuery
+from tscached.mts import MTS
+from tscached.superset import choose_mts_keys
+from tscached.superset import covers
+from tscached.superset import find_superset
+from tscached.superset import index_key
+from tscached.superset import index_kquery
+from tscached.superset import selects
+from tscached.superset import serve_from_superset
+
+
+GROUP_BY_HOST = [{'name': 'tag', 'tags': ['host']}]
+CONFIG = {'superset': {'enabled': True}, 'data': {'staleness_threshold': 10}}
+
+
+def make_result(host, values):
+    return {'name': 'loadavg.05', 'tags': {'host': [host], 'dc': ['east']}, 'values': values,
+            'group_by': [{'name': 'tag', 'tags': ['host'], 'group': {'host': host}}]}
+
+
+def test_index_key_ignores_tags_and_bookkeeping():
+    base = {'name': 'loadavg.05', 'group_by': GROUP_BY_HOST}
+    cached = dict(base, tags={}, mts_keys=['x'], earliest_data=1, last_add_data=2)
+    assert index_key(base) == index_key(dict(base, tags={'host': ['web1']})) == index_key(cached)
+    assert index_key(base).startswith('tscached:superset:')
+    assert index_key(base) != index_key(dict(base, aggregators=[{'name': 'sum'}]))
+
+
+def test_index_kquery():
+    redis_cli = mock.Mock()
+    kq = KQuery(redis_cli)
+    kq.redis_key = 'tscached:kquery:WAT'
+    kq.query = {'name': 'loadavg.05'}
+    index_kquery(CONFIG, redis_cli, kq)  # no tag grouper
+    assert redis_cli.pipeline.call_count == 0
+
+    kq.query['group_by'] = GROUP_BY_HOST
+    index_kquery({}, redis_cli, kq)  # disabled
+    assert redis_cli.pipeline.call_count == 0
+
+    index_kquery(CONFIG, redis_cli, kq)
+    pipeline = redis_cli.pipeline.return_value
+    pipeline.sadd.assert_called_once_with(index_key(kq.query), 'tscached:kquery:WAT')
+    pipeline.expire.assert_called_once_with(index_key(kq.query), kq.expiry)
+
+
+def test_covers():
+    grouped = {'group_by': GROUP_BY_HOST}
+    assert covers(dict(grouped, tags={}), dict(grouped, tags={'host': ['web1']}))
+    assert covers(dict(grouped, tags={'host': ['web1', 'web2']}), dict(grouped, tags={'host': ['web2']}))
+    assert not covers(dict(grouped, tags={'host': ['web1']}), dict(grouped, tags={'host': ['web3']}))
+    # Same filter on an ungrouped tag is fine; a narrower one is not.
+    assert covers(dict(grouped, tags={'dc': ['east']}), dict(grouped, tags={'dc': ['east'], 'host': ['web1']}))
+    assert not covers(dict(grouped, tags={}), dict(grouped, tags={'dc': ['east']}))
+    # The cached query may not be more restrictive than the request.
+    assert not covers(dict(grouped, tags={'dc': ['east']}), dict(grouped, tags={'host': ['web1']}))
+
+
+def test_selects():
+    assert selects(make_result('web1', []), {'host': ['web1', 'web2']})
+    assert not selects(make_result('web3', []), {'host': ['web1', 'web2']})
+    assert selects(make_result('web1', []), {'dc': ['east']})
+    assert not selects(make_result('web1', []), {'dc': ['west']})
+
+
+def test_find_superset_drops_expired_members():
+    redis_cli = mock.Mock()
+    redis_cli.smembers.return_value = set(['tscached:kquery:gone', 'tscached:kquery:super'])
+    cached = {'name': 'loadavg.05', 'group_by': GROUP_BY_HOST, 'mts_keys': []}
+    stored = {'tscached:kquery:gone': None, 'tscached:kquery:super': json.dumps(cached)}
+    pipeline = redis_cli.pipeline.return_value
+    pipeline.execute.side_effect = lambda: [stored[c[0][0]] for c in pipeline.get.call_args_list]
+
+    kq = KQuery(redis_cli)
+    kq.query = {'name': 'loadavg.05', 'group_by': GROUP_BY_HOST, 'tags': {'host': ['web1']}}
+    found = find_superset(redis_cli, kq)
+    assert found.redis_key == 'tscached:kquery:super'
+    redis_cli.srem.assert_called_once_with(index_key(kq.query), 'tscached:kquery:gone')
+
+
+def test_find_superset_needs_tag_grouper():
+    redis_cli = mock.Mock()
+    kq = KQuery(redis_cli)
+    kq.query = {'name': 'loadavg.05', 'tags': {'host': ['web1']}}
+    assert find_superset(redis_cli, kq) is None
+    assert redis_cli.smembers.call_count == 0
+
+
+@freeze_time("2016-01-01 20:00:00", tz_offset=-8)
+@mock.patch('tscached.superset.MTS.from_cache')
+@mock.patch('tscached.superset.find_superset')
+def test_serve_from_superset(m_find, m_from_cache):
+    now_ts = int(datetime.datetime.now().strftime('%s'))
+    redis_cli = mock.Mock()
+    cached = KQuery(redis_cli)
+    cached.redis_key = 'tscached:kquery:super'
+    cached.query = {'name': 'loadavg.05', 'group_by': GROUP_BY_HOST, 'mts_keys': ['a', 'b'],
+                    'earliest_data': now_ts - 7200, 'last_add_data': now_ts}
+    m_find.return_value = cached
+
+    mts_list = []
+    for key, host in [('a', 'web1'), ('b', 'web2')]:
+        mts = MTS(redis_cli)
+        mts.redis_key = key
+        mts.result = make_result(host, [[(now_ts - 60) * 1000, 1], [now_ts * 1000, 2]])
+        mts_list.append(mts)
+    m_from_cache.side_effect = lambda keys, client: iter(mts_list)
+
+    kq = KQuery(redis_cli)
+    kq.query = {'name': 'loadavg.05', 'group_by': GROUP_BY_HOST, 'tags': {'host': ['web2']}}
+    time_range = {'start_relative': {'value': '1', 'unit': 'hours'}}
+
+    out = serve_from_superset(CONFIG, redis_cli, kq, time_range)
+    assert out['sample_size'] == 2
+    assert [r['group_by'][0]['group']['host'] for r in out['results']] == ['web2']
+
+    # Not HOT: the superset doesn't reach back far enough.
+    assert serve_from_superset(CONFIG, redis_cli, kq, {'start_relative': {'value': '3', 'unit': 'hours'}}) is None
+
+    # No matching MTS: let Kairos decide.
+    kq.query['tags'] = {'host': ['web3']}
+    assert serve_from_superset(CONFIG, redis_cli, kq, time_range) is None
+
+    # With group values stored alongside mts_keys, only the selected MTS are loaded.
+    cached.query['mts_groups'] = [{'host': 'web1'}, {'host': 'web2'}]
+    m_from_cache.side_effect = lambda keys, client: iter([mts_list[['a', 'b'].index(key)] for key in keys])
+    kq.query['tags'] = {'host': ['web2']}
+    out = serve_from_superset(CONFIG, redis_cli, kq, time_range)
+    assert m_from_cache.call_args[0][0] == ['b']
+    assert [r['group_by'][0]['group']['host'] for r in out['results']] == ['web2']
+
+    assert serve_from_superset({}, redis_cli, kq, time_range) is None
+    assert superset.enabled(CONFIG)
+
+
+def test_choose_mts_keys():
+    cached = {'tags': {'dc': ['east']}, 'mts_keys': ['a', 'b', 'c'],
+              'mts_groups': [{'host': 'web1'}, {'host': 'web2'}, {}]}
+    assert choose_mts_keys(cached, {'host': ['web2']}) == (['b', 'c'], set(['c']))
+    assert choose_mts_keys(cached, {'host': ['web1', 'web2'], 'dc': ['east']}) == (['a', 'b', 'c'], set(['c']))
+    assert choose_mts_keys(cached, {}) == (['a', 'b', 'c'], set())
+
+    # Written before groups were stored: load and check them all.
+    del cached['mts_groups']
+    assert choose_mts_keys(cached, {'host': ['web2']}) == (['a', 'b', 'c'], set(['a', 'b', 'c']))
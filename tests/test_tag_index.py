@@ -0,0 +1,112 @@
+import mock
+import simplejson as json
+
+from tscached.kquery import KQuery
+from tscached.mts import MTS
+from tscached.tag_index import answer_tags_query
+from tscached.tag_index import COVERAGE_PREFIX
+from tscached.tag_index import find_coverage
+from tscached.tag_index import record_tags
+from tscached.tag_index import TAG_INDEX_PREFIX
+
+
+CONFIG = {'tag_index': {'enabled': True, 'max_age': 300}}
+GROUP_BY_HOST = [{'name': 'tag', 'tags': ['host']}]
+NOW = 1451707200
+
+
+def series_entry(host, dc):
+    return json.dumps({'tags': {'host': [host], 'dc': [dc]},
+                       'group_by': [{'name': 'tag', 'tags': ['host'], 'group': {'host': host}}]})
+
+
+def coverage_entry(last, tags=None, mts_keys=None):
+    return json.dumps({'tags': tags or {}, 'group_by': GROUP_BY_HOST, 'earliest': NOW - 3600, 'last': last,
+                       'mts_keys': mts_keys or ['tscached:mts:1', 'tscached:mts:2']})
+
+
+def test_record_tags():
+    redis_cli = mock.Mock()
+    kq = KQuery(redis_cli)
+    kq.redis_key = 'tscached:kquery:WAT'
+    kq.query = {'name': 'loadavg.05', 'group_by': GROUP_BY_HOST, 'earliest_data': 100, 'last_add_data': 200}
+    mts = MTS(redis_cli)
+    mts.redis_key = 'tscached:mts:1'
+    mts.result = {'name': 'loadavg.05', 'tags': {'host': ['web1']}, 'group_by': GROUP_BY_HOST, 'values': []}
+    kq.add_mts(mts)
+
+    record_tags({}, redis_cli, kq)
+    assert redis_cli.pipeline.call_count == 0
+
+    record_tags(CONFIG, redis_cli, kq)
+    pipeline = redis_cli.pipeline.return_value
+    pipeline.hset.assert_any_call(TAG_INDEX_PREFIX + 'loadavg.05', 'tscached:mts:1',
+                                  json.dumps({'tags': {'host': ['web1']}, 'group_by': GROUP_BY_HOST}))
+    coverage = json.loads(pipeline.hset.call_args_list[-1][0][2])
+    assert coverage == {'tags': {}, 'group_by': GROUP_BY_HOST, 'earliest': 100, 'last': 200,
+                        'mts_keys': ['tscached:mts:1']}
+    pipeline.expire.assert_any_call(COVERAGE_PREFIX + 'loadavg.05', kq.expiry)
+
+    # Coverage only: the MTS' tags were indexed recently enough.
+    pipeline.reset_mock()
+    record_tags(CONFIG, redis_cli, kq, index_mts=False)
+    assert pipeline.hset.call_count == 1
+    assert json.loads(pipeline.hset.call_args[0][2])['mts_keys'] == ['tscached:mts:1']
+
+
+def test_find_coverage_forgets_aged_entries():
+    redis_cli = mock.Mock()
+    redis_cli.hgetall.return_value = {
+        'tscached:kquery:old': coverage_entry(NOW - 1000, mts_keys=['tscached:mts:1', 'tscached:mts:3']),
+        'tscached:kquery:new': coverage_entry(NOW - 10),
+    }
+    found = find_coverage(CONFIG, redis_cli, {'name': 'loadavg.05', 'tags': {'host': 'web1'}}, NOW - 600, NOW)
+    assert found['last'] == NOW - 10
+    redis_cli.hdel.assert_any_call(COVERAGE_PREFIX + 'loadavg.05', 'tscached:kquery:old')
+    redis_cli.hdel.assert_any_call(TAG_INDEX_PREFIX + 'loadavg.05', 'tscached:mts:3')
+
+
+def test_find_coverage_requires_range_and_covering_filter():
+    redis_cli = mock.Mock()
+    redis_cli.hgetall.return_value = {'tscached:kquery:new': coverage_entry(NOW - 10)}
+    assert find_coverage(CONFIG, redis_cli, {'name': 'loadavg.05'}, NOW - 7200, NOW) is None
+    # dc is not grouped on, so the cached MTS can't tell us which hosts are in dc east.
+    assert find_coverage(CONFIG, redis_cli, {'name': 'loadavg.05', 'tags': {'dc': ['east']}}, NOW - 600,
+                         NOW) is None
+
+
+def test_find_coverage_respects_end():
+    redis_cli = mock.Mock()
+    redis_cli.hgetall.return_value = {'tscached:kquery:new': coverage_entry(NOW - 10)}
+    metric = {'name': 'loadavg.05'}
+    assert find_coverage(CONFIG, redis_cli, metric, NOW - 600, NOW, end=NOW - 300) is None
+    assert find_coverage(CONFIG, redis_cli, metric, NOW - 600, NOW, end=NOW)['last'] == NOW - 10
+
+
+def test_answer_tags_query():
+    redis_cli = mock.Mock()
+    redis_cli.hgetall.return_value = {'tscached:kquery:new': coverage_entry(NOW - 10)}
+    redis_cli.hmget.return_value = [series_entry('web1', 'east'), series_entry('web2', 'west')]
+    payload = {'start_absolute': (NOW - 600) * 1000,
+               'metrics': [{'name': 'loadavg.05', 'tags': {'host': ['web2', 'web3']}}]}
+
+    assert answer_tags_query(CONFIG, redis_cli, payload, NOW) == {
+        'queries': [{'results': [{'name': 'loadavg.05', 'tags': {'host': ['web2'], 'dc': ['west']}, 'values': []}]}]
+    }
+    redis_cli.hmget.assert_called_once_with(TAG_INDEX_PREFIX + 'loadavg.05', ['tscached:mts:1', 'tscached:mts:2'])
+
+
+def test_answer_tags_query_falls_back():
+    redis_cli = mock.Mock()
+    payload = {'start_absolute': (NOW - 600) * 1000, 'metrics': [{'name': 'loadavg.05'}]}
+    assert answer_tags_query({}, redis_cli, payload, NOW) is None
+    assert answer_tags_query(CONFIG, redis_cli, {'metrics': [{'name': 'loadavg.05'}]}, NOW) is None
+
+    redis_cli.hgetall.return_value = {'tscached:kquery:new': coverage_entry(NOW - 10)}
+    redis_cli.hmget.return_value = [series_entry('web1', 'east'), None]  # index incomplete
+    assert answer_tags_query(CONFIG, redis_cli, payload, NOW) is None
+
+    redis_cli.hmget.return_value = [series_entry('web1', 'east'), series_entry('web2', 'west')]
+    assert answer_tags_query(CONFIG, redis_cli, payload, NOW) is not None
+    ended = dict(payload, end_absolute=(NOW - 300) * 1000)  # the cached KQuery saw data past the end
+    assert answer_tags_query(CONFIG, redis_cli, ended, NOW) is None
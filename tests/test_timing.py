@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+
+from tscached import timing
+
+
+@pytest.fixture(autouse=True)
+def clean_timing():
+    timing.stop()
+    yield
+    timing.stop()
+
+
+def test_phase_without_collector_is_noop():
+    assert timing.current() is None
+    with timing.phase(timing.PLAN):
+        pass
+    timing.note('x', 1)
+    assert timing.current() is None
+
+
+def test_phase_accumulates():
+    timings = timing.start()
+    assert timing.current() is timings
+    with timing.phase(timing.PLAN):
+        pass
+    with timing.phase(timing.KAIROS):
+        pass
+    with timing.phase(timing.PLAN):
+        pass
+    assert timings.order == [timing.PLAN, timing.KAIROS]
+    assert timings.totals[timing.PLAN][1] == 2
+    assert timings.totals[timing.KAIROS][1] == 1
+
+
+def test_phase_records_on_exception():
+    timings = timing.start()
+    with pytest.raises(ValueError):
+        with timing.phase(timing.MERGE):
+            raise ValueError()
+    assert timings.totals[timing.MERGE][1] == 1
+
+
+def test_collector_is_per_thread():
+    timings = timing.start()
+    seen = []
+    thr = threading.Thread(target=lambda: seen.append(timing.current()))
+    thr.start()
+    thr.join()
+    assert seen == [None]
+    assert timing.current() is timings
+
+
+def test_kquery_breakdown():
+    timings = timing.start()
+    timings.add(timing.SERIALIZE, 0.5)  # outside of any KQuery
+    timings.begin_kquery('tscached:kquery:a')
+    timings.add(timing.CACHE_LOOKUP, 0.001)
+    timings.add(timing.CACHE_LOOKUP, 0.002)
+    timing.note('kairos_chunks_ms', [1.0, 2.0])
+    timings.end_kquery('hot')
+    timings.begin_kquery('tscached:kquery:b')
+    timings.add(timing.KAIROS, 0.25)
+    timings.end_kquery('cold_miss')
+
+    payload = timings.debug_payload()
+    assert [entry.pop('total_ms') >= 0 for entry in payload['kqueries']] == [True, True]
+    assert payload['phases'][timing.CACHE_LOOKUP] == {'ms': 3.0, 'count': 2}
+    assert payload['phases'][timing.SERIALIZE] == {'ms': 500.0, 'count': 1}
+    assert payload['kqueries'] == [
+        {'key': 'tscached:kquery:a', 'mode': 'hot', 'phases': {timing.CACHE_LOOKUP: 3.0},
+         'kairos_chunks_ms': [1.0, 2.0]},
+        {'key': 'tscached:kquery:b', 'mode': 'cold_miss', 'phases': {timing.KAIROS: 250.0}},
+    ]
+    assert payload['total_ms'] >= 0
+
+
+def test_server_timing():
+    timings = timing.start()
+    timings.add(timing.CACHE_LOOKUP, 0.0012)
+    timings.add(timing.KAIROS, 0.5)
+    header = timings.server_timing()
+    parts = header.split(', ')
+    assert parts[0] == 'cache_lookup;dur=1.2'
+    assert parts[1] == 'kairos;dur=500.0'
+    assert parts[2].startswith('total;dur=')
+
+
+def test_debug_requested():
+    config = {'timing': {'debug': True}}
+    assert timing.debug_requested(config, {'X-tscached-debug': '1'}) is True
+    assert timing.debug_requested(config, {'X-tscached-debug': 'TRUE'}) is True
+    assert timing.debug_requested(config, {}) is False
+    assert timing.debug_requested({}, {'X-tscached-debug': '1'}) is False
+    assert timing.debug_requested({'timing': {'debug': False}}, {'X-tscached-debug': '1'}) is False
+
+
+def test_server_timing_enabled():
+    assert timing.server_timing_enabled({'timing': {'server_timing': True}}) is True
+    assert timing.server_timing_enabled({}) is False
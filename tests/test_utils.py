@@ -1,4 +1,5 @@
 import datetime
+from mock import Mock
 from mock import patch
 import pytest
 import simplejson as json
@@ -6,7 +7,10 @@ import simplejson as json
 from freezegun import freeze_time
 import requests
 
+from tscached import utils
+from tscached.compression import gunzip
 from tscached.utils import BackendQueryFailure
+from tscached.utils import configure_requests
 from tscached.utils import FETCH_AFTER
 from tscached.utils import FETCH_ALL
 from tscached.utils import FETCH_BEFORE
@@ -16,6 +20,7 @@ from tscached.utils import get_chunked_time_ranges
 from tscached.utils import get_needed_absolute_time_range
 from tscached.utils import get_range_needed
 from tscached.utils import populate_time_range
+from tscached.utils import KairosUnavailable
 from tscached.utils import query_kairos
 
 
@@ -31,23 +36,112 @@ def test_get_timedelta():
     assert get_timedelta({'value': '1', 'unit': 'years'}).total_seconds() == 31536000
 
 
+@patch('tscached.utils.circuit.request_timeout', None)
 @patch('tscached.utils.requests.post', autospec=True)
 def test_query_kairos(mock_post):
     class Shim(object):
-        text = '{"hello": true}'
+        content = '{"hello": true}'
         status_code = 200
     mock_post.return_value = Shim()
 
     assert query_kairos('localhost', 8080, {'goodbye': False}) == {'hello': True}
     assert mock_post.call_count == 1
     mock_post.assert_called_once_with('http://localhost:8080/api/v1/datapoints/query',
-                                      data='{"goodbye": false}')
+                                      data='{"goodbye": false}', headers={'Accept-Encoding': 'gzip'})
+
+
+@patch('tscached.utils.circuit.request_timeout', 7)
+@patch('tscached.utils.requests.post', autospec=True)
+def test_query_kairos_passes_timeout(mock_post):
+    class Shim(object):
+        content = '{"hello": true}'
+        status_code = 200
+    mock_post.return_value = Shim()
+
+    query_kairos('localhost', 8080, {'goodbye': False})
+    mock_post.assert_called_once_with('http://localhost:8080/api/v1/datapoints/query',
+                                      data='{"goodbye": false}', headers={'Accept-Encoding': 'gzip'}, timeout=7)
+
+
+@patch('tscached.utils.gzip_requests_over', 10)
+@patch('tscached.utils.circuit.request_timeout', None)
+@patch('tscached.utils.requests.post', autospec=True)
+def test_query_kairos_gzips_large_bodies(mock_post):
+    class Shim(object):
+        content = '{"hello": true}'
+        status_code = 200
+    mock_post.return_value = Shim()
+
+    query_kairos('localhost', 8080, {'goodbye': False})
+    kwargs = mock_post.call_args[1]
+    assert kwargs['headers'] == {'Accept-Encoding': 'gzip', 'Content-Encoding': 'gzip'}
+    assert gunzip(kwargs['data']) == '{"goodbye": false}'
+
+    query_kairos('localhost', 8080, {})  # small enough to go as-is
+    assert mock_post.call_args[1] == {'data': '{}', 'headers': {'Accept-Encoding': 'gzip'}}
+
+
+def test_configure_requests():
+    try:
+        configure_requests({'kairosdb': {'gzip_requests_over': 4096}})
+        assert utils.gzip_requests_over == 4096
+    finally:
+        configure_requests({})
+    assert utils.gzip_requests_over is None
+
+
+@patch('tscached.utils.circuit.breaker')
+@patch('tscached.utils.requests.post', autospec=True)
+def test_query_kairos_circuit_open(mock_post, m_breaker):
+    m_breaker.allow.return_value = False
+    with pytest.raises(BackendQueryFailure):
+        query_kairos('localhost', 8080, {'goodbye': False})
+    result = query_kairos('localhost', 8080, {'goodbye': False}, propagate=False)
+    assert result['status_code'] == 503
+    assert mock_post.call_count == 0
+
+
+@patch('tscached.utils.circuit.in_flight')
+@patch('tscached.utils.requests.post', autospec=True)
+def test_query_kairos_sheds_load(mock_post, m_in_flight):
+    m_in_flight.acquire.return_value = 0
+    result = query_kairos('localhost', 8080, {'goodbye': False}, propagate=False)
+    assert result['status_code'] == 503
+    assert result['unavailable'] is True
+    assert mock_post.call_count == 0
+    assert m_in_flight.release.call_count == 0
+    with pytest.raises(KairosUnavailable):
+        query_kairos('localhost', 8080, {'goodbye': False})
+
+
+@patch('tscached.utils.circuit.in_flight')
+@patch('tscached.utils.requests.post', autospec=True)
+def test_query_kairos_reserved(mock_post, m_in_flight):
+    mock_post.return_value = Mock(status_code=200, content='{}')
+    query_kairos('localhost', 8080, {'goodbye': False}, reserved=True)
+    assert m_in_flight.acquire.call_count == 0
+    assert m_in_flight.release.call_count == 0
+
+
+@patch('tscached.utils.circuit.breaker')
+@patch('tscached.utils.circuit.in_flight')
+@patch('tscached.utils.requests.post', autospec=True)
+def test_query_kairos_sheds_load_before_using_a_trial(mock_post, m_in_flight, m_breaker):
+    m_in_flight.acquire.return_value = False
+    query_kairos('localhost', 8080, {'goodbye': False}, propagate=False)
+    assert m_breaker.allow.call_count == 0
+
+    m_in_flight.acquire.return_value = True
+    m_breaker.allow.return_value = False
+    assert query_kairos('localhost', 8080, {'goodbye': False}, propagate=False)['status_code'] == 503
+    assert m_in_flight.release.call_count == 1
+    assert mock_post.call_count == 0
 
 
 @patch('tscached.utils.requests.post', autospec=True)
 def test_query_kairos_backend_gives_non_200(mock_post):
     class Shim(object):
-        text = '{"errors": ["whatever", "lol"]}'
+        content = '{"errors": ["whatever", "lol"]}'
         status_code = 500
     mock_post.return_value = Shim()
     with pytest.raises(BackendQueryFailure):
@@ -58,7 +152,7 @@ def test_query_kairos_backend_gives_non_200(mock_post):
 @patch('tscached.utils.requests.post', autospec=True)
 def test_query_kairos_backend_gives_non_200_no_propagate(mock_post):
     class Shim(object):
-        text = '{"errors": ["whatever", "lol"]}'
+        content = '{"errors": ["whatever", "lol"]}'
         status_code = 500
     mock_post.return_value = Shim()
     result = query_kairos('localhost', 8080, {'goodbye': False}, propagate=False)
@@ -193,6 +287,14 @@ def test_get_chunked_time_ranges_last_2h15m():
     assert results[4][1] == now - datetime.timedelta(minutes=120)
 
 
+def test_get_chunked_time_ranges_given_now():
+    kairos_timing = {'start_relative': {'unit': 'hours', 'value': '1'}}
+    now = datetime.datetime(2016, 1, 1, 12, 0, 0)
+    results = get_chunked_time_ranges({'chunking': {'chunk_length': 1800}}, kairos_timing, now)
+    assert results == [(now - datetime.timedelta(minutes=30, seconds=-1), now),
+                       (now - datetime.timedelta(minutes=60, seconds=-1), now - datetime.timedelta(minutes=30))]
+
+
 def test_get_chunked_time_ranges_last_1h_clock_drift():
     """ Most tests have time frozen, so the clock doesn't drift during execution.
         This one purposely does not. It could flake if it takes over 2s to execute.
@@ -4,6 +4,10 @@ import sys
 from flask import Flask
 import yaml
 
+from tscached import circuit
+from tscached import instrumentation
+from tscached import keys
+from tscached.utils import configure_requests
 from tscached.utils import setup_logging
 
 
@@ -22,6 +26,9 @@ except:
 try:
     with open(config_filename, 'r') as config_file:
         app.config['tscached'] = yaml.load(config_file.read())['tscached']
+    circuit.configure(app.config['tscached'])
+    keys.configure(app.config['tscached'])
+    configure_requests(app.config['tscached'])
 except IOError:
     logging.error('Webapp only: Could not read config file: %s.' % config_filename)
 
@@ -29,6 +36,8 @@ except IOError:
 if not app.debug:
     setup_logging()
 
+instrumentation.install(app)
+
 
 import tscached.handler_general
 import tscached.handler_maintenance
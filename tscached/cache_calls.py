@@ -1,10 +1,21 @@
 import datetime
 import logging
+import threading
+import time
 
 import redis
-import simplejson as json
 
+from tscached import circuit
+from tscached import instrumentation
+from tscached import timing
+from tscached.eviction import record_size
 from tscached.mts import MTS
+from tscached.negative import REASON_EMPTY
+from tscached.negative import set_negative
+from tscached.references import refreshed_elsewhere
+from tscached.references import register_references
+from tscached.superset import index_kquery
+from tscached.tag_index import record_tags
 from tscached.utils import BackendQueryFailure
 from tscached.utils import FETCH_AFTER
 from tscached.utils import FETCH_ALL
@@ -14,15 +25,59 @@ from tscached.utils import get_range_needed
 from tscached.utils import get_needed_absolute_time_range
 
 
-def process_cache_hit(config, redis_client, kquery, kairos_time_range):
+# Each registration of a KQuery's MTS references runs this far past the KQuery's own expiry, so that it only
+# has to be redone this often; see write_kquery.
+REFERENCE_SLACK = 1800  # seconds
+
+
+def write_kquery(config, redis_client, kquery, start_time, end_time):
+    """ Upsert a KQuery, then do its bookkeeping: size accounting, MTS references, superset and tag indexes.
+        Registering references and indexing tags cost a few Redis commands per MTS, so they are only redone
+        when the KQuery's MTS changed, or the deadline last registered for it would no longer outlive it.
+        :param config: dict, 'tscached' level from config file.
+        :param redis_client: redis.StrictRedis
+        :param kquery: kquery.KQuery object; related_mts hold its MTS.
+        :param start_time: datetime.datetime, see KQuery.upsert.
+        :param end_time: datetime.datetime, see KQuery.upsert.
+        :return: void
+        :raise: redis.exceptions.RedisError
+    """
+    now = int(time.time())
+    previous = getattr(kquery, 'cached_data', None) or {}
+    mts_keys = set([mts.get_key() for mts in kquery.related_mts])
+    refresh = (mts_keys != set(previous.get('mts_keys', [])) or
+               previous.get('refs_until', 0) < now + kquery.expiry)
+    kquery.refs_until = now + kquery.expiry + REFERENCE_SLACK if refresh else previous['refs_until']
+    kquery.upsert(start_time, end_time)
+
+    record_size(redis_client, kquery.get_key(), kquery.query.get('name'), kquery.total_bytes())
+    if refresh:
+        register_references(redis_client, kquery.get_key(), kquery.query.get('mts_keys', []),
+                            kquery.refs_until - now, now)
+    index_kquery(config, redis_client, kquery)
+    record_tags(config, redis_client, kquery, index_mts=refresh)
+
+
+def empty_response(kquery):
+    """ Hand back the expected query with no values, as Kairos would for a query that matched nothing.
+        :param kquery: kquery.KQuery object
+        :return: dict, with keys sample_size (int) and results (list of dicts).
+    """
+    kquery.query['values'] = []
+    return {'results': [kquery.query], 'sample_size': 0}
+
+
+def process_cache_hit(config, redis_client, kquery, kairos_time_range, allow_stale=False):
     """ KQuery found in cache. Decide whether to return solely cached data or to update cached data.
         If cached data should be updated, figure out how to do it.
         :param config: 'tscached' level from config file.
         :param redis_client: redis.StrictRedis
         :param kquery: kquery.KQuery object
         :param kairos_time_range: dict, time range straight from the HTTP request payload
+        :param allow_stale: bool, may we answer from cache alone: revalidating appends in the background,
+                            and falling back to the cached portion if KairosDB fails?
         :return: 2-tuple: (dict: kquery resp to be added to HTTP resp, str: type of cache operation)
-        :raise: utils.BackendQueryFailure, if a Kairos lookup failed.
+        :raise: utils.BackendQueryFailure, if a Kairos lookup failed (and no fallback was allowed).
     """
     # this relies on KQuery.get_cached() having a side effect. it must be called before this function.
     kq_result = kquery.cached_data
@@ -33,23 +88,95 @@ def process_cache_hit(config, redis_client, kquery, kairos_time_range):
         start_cache = None
         end_cache = None
 
-    start_request, end_request = get_needed_absolute_time_range(kairos_time_range)
-    staleness_threshold = config['data']['staleness_threshold']
+    with timing.phase(timing.PLAN):
+        start_request, end_request = get_needed_absolute_time_range(kairos_time_range)
+        staleness_threshold = config['data']['staleness_threshold']
 
-    range_needed = get_range_needed(start_request, end_request, start_cache,
-                                    end_cache, staleness_threshold, kquery.window_size)
+        range_needed = get_range_needed(start_request, end_request, start_cache,
+                                        end_cache, staleness_threshold, kquery.window_size)
+    if range_needed:
+        timing.note('range_needed', [int(range_needed[0].strftime('%s')), int(range_needed[1].strftime('%s')),
+                                     range_needed[2]])
     if not range_needed:  # hot cache
         return hot(redis_client, kquery, kairos_time_range), 'hot'
-    else:
-        merge_method = range_needed[2]
+    elif circuit.degraded(config):  # Kairos is unwell; whatever we have will have to do.
+        logging.info('KQuery needs KairosDB data, but the circuit is open: serving cached data only')
+        return hot(redis_client, kquery, kairos_time_range), 'degraded'
+
+    merge_method = range_needed[2]
+    if merge_method not in [FETCH_ALL, FETCH_BEFORE, FETCH_AFTER]:
+        raise BackendQueryFailure("Received unsupported range_needed value: %s" % range_needed[2])
+
+    if allow_stale and merge_method == FETCH_AFTER and within_stale_grace(config, end_cache):
+        revalidate_in_background(config, redis_client, kquery, kairos_time_range, range_needed)
+        return hot(redis_client, kquery, kairos_time_range), 'hot_stale'
+
+    try:
         if merge_method == FETCH_ALL:  # warm, but data doesn't support merging.
             logging.info('Odd COLD scenario: data exists.')
             return cold(config, redis_client, kquery, kairos_time_range), 'cold_overwrite'
-        elif merge_method in [FETCH_BEFORE, FETCH_AFTER]:  # warm, merging supported.
+        else:  # warm, merging supported.
             mode = 'warm_' + merge_method
             return warm(config, redis_client, kquery, kairos_time_range, range_needed), mode
-        else:
-            raise BackendQueryFailure("Received unsupported range_needed value: %s" % range_needed[2])
+    except BackendQueryFailure as e:
+        if not (allow_stale and circuit.partial_responses(config)):
+            raise
+        # Better the part of the range we have than a failed dashboard (and its retries).
+        logging.error('BackendQueryFailure, serving cached data only: %s' % e.message)
+        return hot(redis_client, kquery, kairos_time_range), 'partial'
+
+
+def within_stale_grace(config, end_cache, now=None):
+    """ Is cached data recent enough to be served as-is while it is revalidated in the background?
+        :param config: 'tscached' level from config file.
+        :param end_cache: datetime.datetime, latest data known by the KQuery.
+        :param now: datetime.datetime, optional. set to remove drift in time during execution.
+        :return: boolean
+    """
+    grace = config['data'].get('stale_grace', 0)
+    if not grace:
+        return False
+    if not now:
+        now = datetime.datetime.now()
+    return (now - end_cache) <= datetime.timedelta(seconds=grace)
+
+
+def revalidate_in_background(config, redis_client, kquery, kairos_time_range, range_needed):
+    """ Run a WARM merge on another thread. Single-flighted per KQuery via a short-lived Redis lock,
+        so many workers serving the same stale KQuery cause only one Kairos fetch.
+        :param config: 'tscached' level from config file.
+        :param redis_client: redis.StrictRedis
+        :param kquery: kquery.KQuery object, get_cached was already called.
+        :param kairos_time_range: dict, time range straight from the HTTP request payload
+        :param range_needed: 3-tuple, as returned by utils.get_range_needed
+        :return: threading.Thread if a revalidation was started; False if one is already running.
+    """
+    lock_key = kquery.get_key().replace('tscached:kquery:', 'tscached:revalidate:', 1)
+    timeout = config['data'].get('revalidate_timeout', 60)
+    try:
+        if not redis_client.set(lock_key, 1, nx=True, ex=timeout):
+            logging.debug('Revalidation already in flight: %s' % kquery.get_key())
+            return False
+    except redis.exceptions.RedisError as e:
+        logging.error('RedisError: ' + e.message)
+        return False
+
+    def _revalidate(bg_kquery):
+        try:
+            warm(config, redis_client, bg_kquery, kairos_time_range, range_needed)
+        except BackendQueryFailure as e:
+            logging.error('Revalidation BackendQueryFailure: %s' % e.message)
+        finally:
+            try:
+                redis_client.delete(lock_key)
+            except redis.exceptions.RedisError as e:
+                logging.error('RedisError: ' + e.message)
+
+    # The foreground request keeps using (and serializing) its own KQuery; give the thread a copy.
+    thr = threading.Thread(target=_revalidate, args=(kquery.clone(),))
+    thr.daemon = True
+    thr.start()
+    return thr
 
 
 def cold(config, redis_client, kquery, kairos_time_range):
@@ -60,55 +187,65 @@ def cold(config, redis_client, kquery, kairos_time_range):
         :param kairos_time_range: dict, time range from HTTP request payload
         :return: dict, with keys sample_size (int) and results (list of dicts).
     """
-    chunked_ranges = get_chunked_time_ranges(config, kairos_time_range)
-    results = kquery.proxy_to_kairos_chunked(config['kairosdb']['host'], config['kairosdb']['port'],
-                                             chunked_ranges)
+    with timing.phase(timing.PLAN):
+        chunked_ranges = get_chunked_time_ranges(config, kairos_time_range)
+    timing.note('chunks', [[int(start.strftime('%s')), int(end.strftime('%s'))] for start, end in chunked_ranges])
+    with timing.phase(timing.KAIROS):
+        results = kquery.proxy_to_kairos_chunked(config['kairosdb']['host'], config['kairosdb']['port'],
+                                                 chunked_ranges, config['chunking'].get('thread_timeout', 30))
     logging.info('KQuery is COLD - using %d chunks' % len(results))
 
     # Merge everything together as they come out - in chunked order - from the result.
+    # Per-series handles are cheap; a full MTS is only materialized once per unique series.
     mts_lookup = {}
-    ndx = len(results) - 1  # Results come out newest to eldest, so count backwards.
-    while ndx >= 0:
-        for mts in MTS.from_result(results[ndx]['queries'][0], redis_client, kquery):
-
-            # Almost certainly a null result. Empty data should not be included in mts_lookup.
-            if not mts.result or len(mts.result['values']) == 0:
-                logging.debug('cache_calls.cold: got an empty chunked mts response')
-                continue
-
-            if not mts_lookup.get(mts.get_key()):
-                mts_lookup[mts.get_key()] = mts
-            else:
-                # So, we could use merge_at_end, but it throws away beginning/ending values because of
-                # partial windowing. But since we force align_start_time, we don't have that worry here.
-                mts_lookup[mts.get_key()].result['values'] += mts.result['values']
-        ndx -= 1
+    with timing.phase(timing.MERGE):
+        ndx = len(results) - 1  # Results come out newest to eldest, so count backwards.
+        while ndx >= 0:
+            for handle in MTS.handles_from_result(results[ndx]['queries'][0], kquery):
+
+                # Almost certainly a null result. Empty data should not be included in mts_lookup.
+                if not handle.result or len(handle.result['values']) == 0:
+                    logging.debug('cache_calls.cold: got an empty chunked mts response')
+                    continue
+
+                if not mts_lookup.get(handle.get_key()):
+                    mts_lookup[handle.get_key()] = handle
+                else:
+                    # So, we could use merge_at_end, but it throws away beginning/ending values because of
+                    # partial windowing. But since we force align_start_time, we don't have that worry here.
+                    mts_lookup[handle.get_key()].extend(handle)
+            ndx -= 1
 
     # Accumulate the full KQuery response as the Redis operations are being queued up.
     response_kquery = {'results': [], 'sample_size': 0}
     pipeline = redis_client.pipeline()
-    for mts in mts_lookup.values():
-        kquery.add_mts(mts)
-        pipeline.set(mts.get_key(), json.dumps(mts.result), ex=mts.expiry)
-        logging.debug('Cold: Writing %d points to MTS: %s' % (len(mts.result['values']), mts.get_key()))
-        response_kquery = mts.build_response(kairos_time_range, response_kquery, trim=False)
+    with timing.phase(timing.BUILD_RESPONSE):
+        for handle in mts_lookup.values():
+            mts = handle.materialize(redis_client)
+            kquery.add_mts(mts)
+            pipeline.set(mts.get_key(), mts.serialize(), ex=mts.expiry)
+            logging.debug('Cold: Writing %d points to MTS: %s' % (len(mts.result['values']), mts.get_key()))
+            response_kquery = mts.build_response(kairos_time_range, response_kquery, trim=False)
 
-    # Handle a fully empty set of MTS. Bail out before we upsert.
+    # Handle a fully empty set of MTS. Bail out before we upsert, leaving only a short-lived negative entry.
     if len(mts_lookup) == 0:
-        kquery.query['values'] = []
-        response_kquery['results'].append(kquery.query)
         logging.info('Received probable incorrect query; no results. Not caching!')
-        return response_kquery
+        try:
+            set_negative(config, redis_client, kquery.get_key(), kairos_time_range, REASON_EMPTY)
+        except redis.exceptions.RedisError as e:
+            logging.error('RedisError: ' + e.message)
+        return empty_response(kquery)
 
     # Execute the MTS Redis pipeline, then set the KQuery to its full new value.
     try:
-        result = pipeline.execute()
-        success_count = len(filter(lambda x: x is True, result))
-        logging.info("MTS write pipeline: %d of %d successful" % (success_count, len(result)))
-
-        start_time = chunked_ranges[-1][0]
-        end_time = chunked_ranges[0][1]
-        kquery.upsert(start_time, end_time)
+        with timing.phase(timing.CACHE_WRITE):
+            result = instrumentation.execute(pipeline, 'cold')
+            success_count = len(filter(lambda x: x is True, result))
+            logging.info("MTS write pipeline: %d of %d successful" % (success_count, len(result)))
+
+            start_time = chunked_ranges[-1][0]
+            end_time = chunked_ranges[0][1]
+            write_kquery(config, redis_client, kquery, start_time, end_time)
     except redis.exceptions.RedisError as e:
         # We want to eat this Redis exception, because in a catastrophe this becones a straight proxy.
         logging.error('RedisError: ' + e.message)
@@ -120,13 +257,15 @@ def hot(redis_client, kquery, kairos_time_range):
     """ Hot / Hit """
     logging.info("KQuery is HOT")
     response_kquery = {'results': [], 'sample_size': 0}
-    for mts in MTS.from_cache(kquery.cached_data.get('mts_keys', []), redis_client):
-        response_kquery = mts.build_response(kairos_time_range, response_kquery)
+    with timing.phase(timing.CACHE_LOOKUP):
+        cached_mts = list(MTS.from_cache(kquery.cached_data.get('mts_keys', []), redis_client))
+    with timing.phase(timing.BUILD_RESPONSE):
+        for mts in cached_mts:
+            response_kquery = mts.build_response(kairos_time_range, response_kquery)
 
     # Handle a fully empty set of MTS: hand back the expected query with no values.
     if len(response_kquery['results']) == 0:
-        kquery.query['values'] = []
-        response_kquery['results'].append(kquery.query)
+        return empty_response(kquery)
     return response_kquery
 
 
@@ -142,15 +281,6 @@ def warm(config, redis_client, kquery, kairos_time_range, range_needed):
     logging.info('KQuery is WARM')
 
     expected_resolution = config['data'].get('expected_resolution', 10000)
-
-    time_dict = {
-                    'start_absolute': int(range_needed[0].strftime('%s')) * 1000 - expected_resolution,
-                    'end_absolute': int(range_needed[1].strftime('%s')) * 1000,
-                }
-
-    new_kairos_result = kquery.proxy_to_kairos(config['kairosdb']['host'], config['kairosdb']['port'],
-                                               time_dict)
-
     response_kquery = {'results': [], 'sample_size': 0}
 
     # Initial KQuery, and each MTS, can be slightly different on start/end. We need to get the min/max.
@@ -160,44 +290,77 @@ def warm(config, redis_client, kquery, kairos_time_range, range_needed):
     cached_mts = {}  # redis key to MTS
     # pull in cached MTS, put them in a lookup table
     # TODO expected_resolution should be passed in
-    for mts in MTS.from_cache(kquery.cached_data.get('mts_keys', []), redis_client):
-        kquery.add_mts(mts)  # we want to write these back eventually
-        cached_mts[mts.get_key()] = mts
+    with timing.phase(timing.CACHE_LOOKUP):
+        for mts in MTS.from_cache(kquery.cached_data.get('mts_keys', []), redis_client):
+            kquery.add_mts(mts)  # we want to write these back eventually
+            cached_mts[mts.get_key()] = mts
+
+    # MTS may be shared with other KQueries. If one of those already appended the data we're after,
+    # there is nothing left to fetch: serve what we have and just move our own end time forward.
+    if range_needed[2] == FETCH_AFTER:
+        shared_end = refreshed_elsewhere(cached_mts.values(), range_needed[1],
+                                         config['data']['staleness_threshold'])
+        if shared_end:
+            logging.info('KQuery is WARM, but its MTS were already refreshed elsewhere')
+            for mts in cached_mts.values():
+                response_kquery = mts.build_response(kairos_time_range, response_kquery)
+            try:
+                write_kquery(config, redis_client, kquery, min(start_times),
+                             datetime.datetime.fromtimestamp(shared_end))
+            except redis.exceptions.RedisError as e:
+                logging.error('RedisError: ' + e.message)
+            return response_kquery
+
+    time_dict = {
+                    'start_absolute': int(range_needed[0].strftime('%s')) * 1000 - expected_resolution,
+                    'end_absolute': int(range_needed[1].strftime('%s')) * 1000,
+                }
+    timing.note('chunks', [[time_dict['start_absolute'] / 1000, time_dict['end_absolute'] / 1000]])
+
+    with timing.phase(timing.KAIROS):
+        new_kairos_result = kquery.proxy_to_kairos(config['kairosdb']['host'], config['kairosdb']['port'],
+                                                   time_dict)
 
     # loop over newly returned MTS. if they already existed, merge/write. if not, just write.
     pipeline = redis_client.pipeline()
-    for mts in MTS.from_result(new_kairos_result['queries'][0], redis_client, kquery):
+    for mts in MTS.handles_from_result(new_kairos_result['queries'][0], kquery):
         old_mts = cached_mts.get(mts.get_key())
 
         if not old_mts:  # This MTS just started reporting and isn't yet in the cache (cold behavior).
+            mts = mts.materialize(redis_client)
             kquery.add_mts(mts)
-            pipeline.set(mts.get_key(), json.dumps(mts.result), ex=mts.expiry)
-            response_kquery = mts.build_response(kairos_time_range, response_kquery, trim=False)
+            pipeline.set(mts.get_key(), mts.serialize(), ex=mts.expiry)
+            with timing.phase(timing.BUILD_RESPONSE):
+                response_kquery = mts.build_response(kairos_time_range, response_kquery, trim=False)
         else:
             if range_needed[2] == FETCH_AFTER:
                 end_times.append(range_needed[1])
-                old_mts.merge_at_end(mts)
+                with timing.phase(timing.MERGE):
+                    old_mts.merge_at_end(mts)
 
-                # This seems the only case where too-old data should be removed.
-                expiry = old_mts.ttl_expire()
+                    # This seems the only case where too-old data should be removed.
+                    expiry = old_mts.ttl_expire()
                 if expiry:
                     start_times.append(expiry)
 
             elif range_needed[2] == FETCH_BEFORE:
                 start_times.append(range_needed[0])
-                old_mts.merge_at_beginning(mts)
+                with timing.phase(timing.MERGE):
+                    old_mts.merge_at_beginning(mts)
             else:
                 logging.error("WARM is not equipped for this range_needed attrib: %s" % range_needed[2])
                 return response_kquery
 
-            pipeline.set(old_mts.get_key(), json.dumps(old_mts.result), ex=old_mts.expiry)
-            response_kquery = old_mts.build_response(kairos_time_range, response_kquery)
+            pipeline.set(old_mts.get_key(), old_mts.serialize(), ex=old_mts.expiry)
+            with timing.phase(timing.BUILD_RESPONSE):
+                response_kquery = old_mts.build_response(kairos_time_range, response_kquery)
     try:
-        result = pipeline.execute()
-        success_count = len(filter(lambda x: x is True, result))
-        logging.info("MTS write pipeline: %d of %d successful" % (success_count, len(result)))
+        with timing.phase(timing.CACHE_WRITE):
+            result = instrumentation.execute(pipeline, 'warm')
+            success_count = len(filter(lambda x: x is True, result))
+            logging.info("MTS write pipeline: %d of %d successful" % (success_count, len(result)))
 
-        kquery.upsert(min(start_times), max(end_times))
+            write_kquery(config, redis_client, kquery, min(start_times), max(end_times))
     except redis.exceptions.RedisError as e:
         # Sneaky edge case where Redis fails after reading but before writing. Still return data!
         logging.error('RedisError: ' + e.message)
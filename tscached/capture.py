@@ -0,0 +1,114 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import simplejson as json
+
+from tscached.normalize import normalize_query
+from tscached.superset import BOOKKEEPING_FIELDS
+
+
+"""
+    Traffic capture, for tuning cache policy offline (see tscached.replay).
+    When enabled, handle_query appends one JSON line per HTTP request to the configured file: when it came
+    in, its time range, and for each KQuery its key, normalized query, the cache mode it was served with and
+    the size of its response (series and datapoints), which tscached.simulator uses to estimate load.
+    Each line goes out in a single write to a file opened O_APPEND, so uwsgi workers can share one file.
+"""
+
+
+HIT_MODES = ['hot', 'hot_stale', 'hot_superset', 'degraded', 'negative']  # served without asking Kairos
+
+lock = threading.Lock()
+handle = {}  # 'pid', 'path', 'fd' of this process' open capture file
+
+
+def enabled(config):
+    return config.get('capture', {}).get('enabled', False)
+
+
+def query_of(kquery):
+    """ :return: dict, the KQuery's query as the client sent it (normalized), without our bookkeeping. """
+    return normalize_query(dict((k, v) for k, v in kquery.query.iteritems() if k not in BOOKKEEPING_FIELDS))
+
+
+def entry(time_range, kqueries, elapsed, now=None):
+    """ One line of a capture file.
+        :param time_range: dict, the request's time range; see utils.populate_time_range.
+        :param kqueries: list of 3-tuples (kquery.KQuery, str cache mode, dict KQuery response).
+        :param elapsed: float, seconds spent handling the request.
+        :param now: float, unix timestamp; optional, for testing.
+        :return: dict
+    """
+    return {
+        'ts': round(now or time.time(), 3),
+        'time_range': time_range,
+        'elapsed_ms': round(elapsed * 1000, 3),
+        'kqueries': [{'key': kquery.get_key(), 'mode': mode, 'query': query_of(kquery),
+                      'series': len([r for r in response.get('results', []) if r.get('values')]),
+                      'points': response.get('sample_size', 0)}
+                     for kquery, mode, response in kqueries],
+    }
+
+
+def open_capture_file(path):
+    """ :return: int, a file descriptor for appending; reopened after a fork, or a change of path. """
+    if handle.get('pid') != os.getpid() or handle.get('path') != path:
+        if handle.get('pid') == os.getpid():
+            os.close(handle['fd'])
+        handle['fd'] = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        handle['pid'] = os.getpid()
+        handle['path'] = path
+    return handle['fd']
+
+
+def record(config, time_range, kqueries, elapsed):
+    """ Capture one request, if capturing is enabled (and this request is sampled). Never raises.
+        :param config: dict, 'tscached' level from config file.
+        :param time_range: dict, the request's time range.
+        :param kqueries: list of 3-tuples (kquery.KQuery, str cache mode, dict KQuery response).
+        :param elapsed: float, seconds spent handling the request.
+        :return: boolean, whether a line was written.
+    """
+    capture_config = config.get('capture', {})
+    if not enabled(config) or not kqueries:
+        return False
+    if random.random() >= capture_config.get('sample_rate', 1.0):
+        return False
+    try:
+        line = json.dumps(entry(time_range, kqueries, elapsed), separators=(',', ':')) + '\n'
+        with lock:
+            os.write(open_capture_file(capture_config['path']), line)
+    except (OSError, IOError, KeyError) as e:
+        logging.error('Capture failed: %s' % e)
+        return False
+    return True
+
+
+def read_trace(path):
+    """ Generator: the entries of a capture file, oldest first. Malformed lines (say, a torn last line) are skipped.
+        :param path: str
+    """
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logging.error('Skipping malformed capture line: %s' % line[:100])
+
+
+def load_trace(path):
+    """ :return: list of dict, capture entries in time order (workers append concurrently, so nearly sorted). """
+    return sorted(read_trace(path), key=lambda e: e['ts'])
+
+
+def hit_ratio(modes):
+    """ :param modes: dict, cache mode -> count.
+        :return: float, the share served without asking Kairos; None if there is nothing to judge.
+    """
+    total = sum(modes.values())
+    if not total:
+        return None
+    return round(sum([modes.get(mode, 0) for mode in HIT_MODES]) / float(total), 4)
@@ -0,0 +1,189 @@
+import collections
+import logging
+import threading
+import time
+
+
+"""
+    Protection for KairosDB, and for ourselves when KairosDB is unwell. Per worker process we keep:
+    - a circuit breaker over the most recent Kairos requests. Errors and slow responses both count as
+      failures; too many of them open the circuit and further requests fail fast until a cooldown passes.
+    - a cap on concurrent in-flight Kairos requests, taken a KQuery (all of its chunks) at a time. A KQuery
+      that finds no room waits a bounded time (queue_wait) for it, then is shed.
+    Both are configured once at startup, via configure(), from the 'kairosdb' section of the config.
+"""
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, window=20, min_requests=10, failure_ratio=0.5, slow_request=10, cooldown=30,
+                 trial_requests=1):
+        """ :param window: int, how many recent requests to judge the backend by.
+            :param min_requests: int, never open the circuit on fewer observations than this.
+            :param failure_ratio: float, open the circuit at or above this share of failures.
+            :param slow_request: float, seconds; slower requests count as failures.
+            :param cooldown: float, seconds to stay open before letting trial requests through. Also how long
+                             to wait on trial requests before giving up on them and trying again.
+            :param trial_requests: int, requests let through in HALF_OPEN; enough for all chunks of one query.
+        """
+        self.min_requests = min_requests
+        self.failure_ratio = failure_ratio
+        self.slow_request = slow_request
+        self.cooldown = cooldown
+        self.trial_requests = trial_requests
+
+        self.outcomes = collections.deque(maxlen=window)  # True for success
+        self.state = CLOSED
+        self.opened_at = None
+        self.half_opened_at = None
+        self.trials = 0  # requests let through since going HALF_OPEN
+        self.lock = threading.Lock()
+
+    def allow(self, now=None):
+        """ May a request go to Kairos right now? In HALF_OPEN, only trial_requests are let through; if none of
+            them has reported back within the cooldown (it was lost, say), a new round of trials starts.
+            :param now: float, unix timestamp; optional, for testing.
+            :return: boolean
+        """
+        if not now:
+            now = time.time()
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if ((self.state == OPEN and now - self.opened_at >= self.cooldown) or
+                    (self.state == HALF_OPEN and now - self.half_opened_at >= self.cooldown)):
+                logging.info('Circuit breaker: HALF_OPEN, sending trial requests to KairosDB')
+                self.state = HALF_OPEN
+                self.half_opened_at = now
+                self.trials = 1
+                return True
+            if self.state == HALF_OPEN and self.trials < self.trial_requests:
+                self.trials += 1
+                return True
+            return False
+
+    def record(self, success, duration, now=None):
+        """ Account for one finished Kairos request.
+            :param success: bool, did Kairos answer without a server-side error?
+            :param duration: float, seconds the request took.
+            :param now: float, unix timestamp; optional, for testing.
+            :return: void
+        """
+        if not now:
+            now = time.time()
+        success = success and duration < self.slow_request
+        with self.lock:
+            if self.state == HALF_OPEN:
+                if success:
+                    logging.info('Circuit breaker: CLOSED, KairosDB has recovered')
+                    self.state = CLOSED
+                    self.outcomes.clear()
+                else:
+                    self.trip(now)
+                return
+
+            self.outcomes.append(success)
+            failures = self.outcomes.count(False)
+            if (self.state == CLOSED and len(self.outcomes) >= self.min_requests and
+                    failures >= self.failure_ratio * len(self.outcomes)):
+                self.trip(now)
+
+    def trip(self, now):
+        """ Open the circuit. Caller holds the lock. """
+        logging.error('Circuit breaker: OPEN, failing KairosDB requests fast for %ds' % self.cooldown)
+        self.state = OPEN
+        self.opened_at = now
+        self.outcomes.clear()
+
+    def is_open(self, now=None):
+        """ Is the backend currently considered unavailable? Not once the cooldown is over: the next request
+            should go to Kairos, as a trial.
+            :param now: float, unix timestamp; optional, for testing.
+            :return: boolean
+        """
+        if not now:
+            now = time.time()
+        if self.state == OPEN:
+            return now - self.opened_at < self.cooldown
+        if self.state == HALF_OPEN:
+            return now - self.half_opened_at < self.cooldown
+        return False
+
+
+class InFlightLimit(object):
+    """ A counting semaphore that hands out several slots at once, so that a chunked KQuery gets room for all
+        of its chunks or for none: taking them one by one, two KQueries could each end up holding half.
+    """
+
+    def __init__(self, limit, wait=0):
+        """ :param limit: int, most requests in flight at once.
+            :param wait: float, seconds acquire() waits for room by default.
+        """
+        self.limit = limit
+        self.wait = wait
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, count=1, wait=None):
+        """ Take count slots (at most limit), waiting up to wait seconds for them.
+            :return: int, the number of slots taken, to be released later; 0 if there was no room in time.
+        """
+        count = min(count, self.limit)
+        deadline = time.time() + (self.wait if wait is None else wait)
+        with self.cond:
+            while self.used + count > self.limit:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return 0
+                self.cond.wait(remaining)
+            self.used += count
+            return count
+
+    def release(self, count=1):
+        with self.cond:
+            self.used -= count
+            self.cond.notify_all()
+
+
+breaker = CircuitBreaker()
+in_flight = None  # InFlightLimit, if concurrency is limited
+request_timeout = None  # seconds, passed to requests
+
+
+def configure(config):
+    """ (Re)build the breaker and concurrency limit from config. Call once per process at startup.
+        :param config: dict, 'tscached' level from config file.
+        :return: void
+    """
+    global breaker, in_flight, request_timeout
+    kairos_config = config.get('kairosdb', {})
+
+    breaker_config = kairos_config.get('circuit_breaker', {})
+    if breaker_config.get('enabled', True):
+        breaker = CircuitBreaker(window=breaker_config.get('window', 20),
+                                 min_requests=breaker_config.get('min_requests', 10),
+                                 failure_ratio=breaker_config.get('failure_ratio', 0.5),
+                                 slow_request=breaker_config.get('slow_request', 10),
+                                 cooldown=breaker_config.get('cooldown', 30),
+                                 trial_requests=breaker_config.get('trial_requests', 1))
+    else:
+        breaker = CircuitBreaker(min_requests=float('inf'))
+
+    max_in_flight = kairos_config.get('max_in_flight')
+    in_flight = InFlightLimit(max_in_flight, kairos_config.get('queue_wait', 5)) if max_in_flight else None
+    request_timeout = kairos_config.get('timeout')
+
+
+def degraded(config):
+    """ Should we answer from cache alone, without asking Kairos to fill in the gaps? """
+    return config.get('degraded', {}).get('enabled', False) and breaker.is_open()
+
+
+def partial_responses(config):
+    """ Should KairosDB failures fall back to cached data, and not fail a whole multi-KQuery request? """
+    return config.get('degraded', {}).get('partial_responses', False)
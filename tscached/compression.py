@@ -0,0 +1,121 @@
+import logging
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional: pip install zstandard
+    zstandard = None
+
+
+"""
+    HTTP response compression, negotiated from the client's Accept-Encoding header, plus helpers for
+    keeping values gzipped in Redis. Supported encodings are gzip, deflate and, if the zstandard package is
+    installed, zstd. Configured from the 'compression' section of the config.
+"""
+
+
+GZIP = 'gzip'
+DEFLATE = 'deflate'
+ZSTD = 'zstd'
+
+GZIP_MAGIC = '\x1f\x8b'
+DEFAULT_ENCODINGS = [ZSTD, GZIP, DEFLATE]  # our preference, best first
+
+
+def available(encoding):
+    if encoding == ZSTD:
+        return zstandard is not None
+    return encoding in [GZIP, DEFLATE]
+
+
+def accepted(accept_encoding):
+    """ Parse an Accept-Encoding header.
+        :param accept_encoding: str, e.g. 'gzip, deflate;q=0.5, br'
+        :return: set of str, encodings the client accepts (q > 0).
+    """
+    encodings = set()
+    for part in (accept_encoding or '').split(','):
+        pieces = [p.strip() for p in part.split(';')]
+        if not pieces[0]:
+            continue
+        q = 1.0
+        for param in pieces[1:]:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0
+        if q > 0:
+            encodings.add(pieces[0].lower())
+    return encodings
+
+
+def choose(config, accept_encoding):
+    """ The encoding to respond with, or None to send the body as-is.
+        :param config: dict, 'tscached' level from config file.
+        :param accept_encoding: str, the client's Accept-Encoding header.
+        :return: str or None
+    """
+    compression_config = config.get('compression', {})
+    if not compression_config.get('enabled', False):
+        return None
+    client = accepted(accept_encoding)
+    for encoding in compression_config.get('encodings', DEFAULT_ENCODINGS):
+        if (encoding in client or '*' in client) and available(encoding):
+            return encoding
+    return None
+
+
+def compress(data, encoding, level=6):
+    """ :param data: str
+        :param encoding: str, one of GZIP, DEFLATE, ZSTD.
+        :param level: int, compression level.
+        :return: str, compressed data.
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    if encoding == GZIP:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    elif encoding == DEFLATE:
+        return zlib.compress(data, level)
+    elif encoding == ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError('Unsupported encoding: %s' % encoding)
+
+
+def is_gzipped(data):
+    return bool(data) and data[:2] == GZIP_MAGIC
+
+
+def gunzip(data):
+    """ Undo compress(data, GZIP). Data that isn't gzipped is returned untouched. """
+    if not is_gzipped(data):
+        return data
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def respond(config, accept_encoding, body, status, headers=None):
+    """ Compress a Flask response, if the client accepts it and the body is large enough to be worth it.
+        Bodies that already carry a Content-Encoding are left alone.
+        :param config: dict, 'tscached' level from config file.
+        :param accept_encoding: str, the client's Accept-Encoding header.
+        :param body: str
+        :param status: int, HTTP status code.
+        :param headers: dict, or None.
+        :return: 3-tuple (body, status, headers), as Flask handlers return.
+    """
+    headers = dict(headers or {})
+    encoding = choose(config, accept_encoding)
+    min_size = config.get('compression', {}).get('min_size', 1024)
+    if not encoding or 'Content-Encoding' in headers or len(body) < min_size:
+        return body, status, headers
+
+    try:
+        body = compress(body, encoding, config['compression'].get('level', 6))
+    except Exception as e:  # a response sent uncompressed beats none at all.
+        logging.error('Compression (%s) failed: %s' % (encoding, e))
+        return body, status, headers
+    headers['Content-Encoding'] = encoding
+    headers['Vary'] = 'Accept-Encoding'
+    return body, status, headers
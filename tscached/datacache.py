@@ -2,6 +2,7 @@ import logging
 
 import simplejson as json
 
+from keys import canonical_json
 from utils import create_key
 
 
@@ -45,8 +46,8 @@ class DataCache(object):
         return self.redis_key
 
     def make_key(self):
-        """ Create a key. """
-        hashable = json.dumps(self.key_basis())
+        """ Create a key, independent of dict ordering in the basis. """
+        hashable = canonical_json(self.key_basis())
         self.redis_key = create_key(hashable, self.cache_type)
 
     def key_basis(self):
@@ -0,0 +1,202 @@
+import logging
+import time
+
+import simplejson as json
+
+from tscached.references import release_references
+
+
+KQUERY_SIZES = 'tscached:kquery_sizes'
+KQUERY_HITS = 'tscached:kquery_hits'
+KQUERY_ACCESS = 'tscached:kquery_access'
+
+
+def record_size(redis_client, kquery_key, metric_name, num_bytes):
+    """ Remember how many bytes of MTS data a KQuery holds. Works on pipelines too.
+        :param redis_client: redis.StrictRedis or a pipeline derived from one.
+        :param kquery_key: str, usually tscached:kquery:HASH
+        :param metric_name: str, the metric queried for; used to look up per-prefix budgets.
+        :param num_bytes: int, total serialized size of the KQuery's MTS.
+        :return: void
+    """
+    redis_client.hset(KQUERY_SIZES, kquery_key, json.dumps({'name': metric_name, 'bytes': num_bytes}))
+
+
+def record_hit(redis_client, kquery_key):
+    """ Count a cache hit against a KQuery, so popular entries survive eviction.
+        :param redis_client: redis.StrictRedis
+        :param kquery_key: str, usually tscached:kquery:HASH
+        :return: void
+        :raise: redis.exceptions.RedisError
+    """
+    redis_client.hincrby(KQUERY_HITS, kquery_key, 1)
+
+
+def record_access(redis_client, kquery_keys, now=None):
+    """ Remember when KQueries were last asked for by a client; for cache inspection.
+        :param redis_client: redis.StrictRedis
+        :param kquery_keys: list of str, usually tscached:kquery:HASH
+        :param now: float, unix timestamp; optional, for testing.
+        :return: void
+        :raise: redis.exceptions.RedisError
+    """
+    if kquery_keys:
+        now = int(now or time.time())
+        redis_client.hmset(KQUERY_ACCESS, dict((key, now) for key in kquery_keys))
+
+
+def get_budget_prefix(config, metric_name):
+    """ Which configured budget does this metric fall into? The longest matching prefix wins.
+        :param config: dict, 'tscached' level from config file.
+        :param metric_name: str
+        :return: str prefix, or None if no budget applies.
+    """
+    best = None
+    for prefix in config.get('eviction', {}).get('budgets', {}) or {}:
+        if metric_name.startswith(prefix) and (best is None or len(prefix) > len(best)):
+            best = prefix
+    return best
+
+
+def eviction_score(num_bytes, hits):
+    """ Bigger is less valuable: large entries that are rarely read go first. """
+    return num_bytes / float(hits + 1)
+
+
+def evict_kquery(redis_client, kquery_key):
+    """ Delete a KQuery and forget its accounting. Its MTS are deleted unless another KQuery uses them.
+        :param redis_client: redis.StrictRedis
+        :param kquery_key: str, usually tscached:kquery:HASH
+        :return: int, bytes freed: the size of the KQuery's MTS that were deleted.
+        :raise: redis.exceptions.RedisError
+    """
+    mts_keys = []
+    cached = redis_client.get(kquery_key)
+    if cached:
+        mts_keys = json.loads(cached).get('mts_keys', [])
+
+    pipeline = redis_client.pipeline()
+    for mts_key in mts_keys:
+        pipeline.strlen(mts_key)
+    pipeline.delete(kquery_key)
+    pipeline.hdel(KQUERY_SIZES, kquery_key)
+    pipeline.hdel(KQUERY_HITS, kquery_key)
+    pipeline.hdel(KQUERY_ACCESS, kquery_key)
+    sizes = dict(zip(mts_keys, pipeline.execute()))
+
+    orphans = release_references(redis_client, kquery_key, mts_keys)
+    freed = sum([sizes[mts_key] or 0 for mts_key in orphans])
+    logging.info('Evicted KQuery %s (%d of %d MTS removed, %d bytes)' %
+                 (kquery_key, len(orphans), len(mts_keys), freed))
+    return freed
+
+
+def forget_accounting(redis_client, keys):
+    """ Drop KQueries that no longer exist from the size, hit and access hashes.
+        :param redis_client: redis.StrictRedis
+        :param keys: list of str, KQuery keys.
+        :return: void
+        :raise: redis.exceptions.RedisError
+    """
+    if not keys:
+        return
+    pipeline = redis_client.pipeline()
+    pipeline.hdel(KQUERY_SIZES, *keys)
+    pipeline.hdel(KQUERY_HITS, *keys)
+    pipeline.hdel(KQUERY_ACCESS, *keys)
+    pipeline.execute()
+    logging.debug('Eviction: forgot accounting for %d expired KQueries' % len(keys))
+
+
+def load_accounting(redis_client):
+    """ Read size/hit accounting for every live KQuery. Forgets entries that have already expired,
+        including those only the hit or access hashes still mention.
+        :param redis_client: redis.StrictRedis
+        :return: list of dicts with keys key, name, bytes, hits.
+        :raise: redis.exceptions.RedisError
+    """
+    sizes = redis_client.hgetall(KQUERY_SIZES)
+    hits = redis_client.hgetall(KQUERY_HITS)
+    access = redis_client.hgetall(KQUERY_ACCESS)
+    keys = list(set(sizes) | set(hits) | set(access))
+
+    pipeline = redis_client.pipeline()
+    for key in keys:
+        pipeline.exists(key)
+    alive = pipeline.execute()
+
+    entries = []
+    expired = []
+    for ndx in xrange(len(keys)):
+        if not alive[ndx]:
+            expired.append(keys[ndx])
+            continue
+        if keys[ndx] not in sizes:  # its size is recorded along with its next write.
+            continue
+        info = json.loads(sizes[keys[ndx]])
+        entries.append({'key': keys[ndx], 'name': info.get('name') or '', 'bytes': info.get('bytes', 0),
+                        'hits': int(hits.get(keys[ndx], 0))})
+
+    forget_accounting(redis_client, expired)
+    return entries
+
+
+def choose_victims(config, entries, evict=None):
+    """ Decide which KQueries to drop so that every budget is respected.
+        First each per-prefix budget is enforced, then the overall max_bytes.
+        Given evict, each victim is evicted as it is chosen, and budgets count down by the bytes that actually
+        freed: a KQuery whose MTS are all shared frees nothing, so more victims are taken. Shared MTS are
+        accounted to every KQuery using them, so this errs towards evicting too much rather than too little.
+        :param config: dict, 'tscached' level from config file.
+        :param entries: list of dicts, as returned by load_accounting.
+        :param evict: function, KQuery key -> int bytes freed; optional. Without it, accounted bytes are assumed.
+        :return: list of str, KQuery keys to evict. Least valuable first.
+    """
+    eviction_config = config.get('eviction', {})
+    ordered = sorted(entries, key=lambda e: eviction_score(e['bytes'], e['hits']), reverse=True)
+    victims = []
+    chosen = set()  # the same keys, for membership tests
+
+    def _take(entry):
+        victims.append(entry['key'])
+        chosen.add(entry['key'])
+        return evict(entry['key']) if evict else entry['bytes']
+
+    usage = {}
+    for entry in ordered:
+        prefix = get_budget_prefix(config, entry['name'])
+        if prefix is not None:
+            usage[prefix] = usage.get(prefix, 0) + entry['bytes']
+
+    budgets = eviction_config.get('budgets', {}) or {}
+    for entry in ordered:
+        prefix = get_budget_prefix(config, entry['name'])
+        if prefix is not None and usage[prefix] > budgets[prefix]:
+            usage[prefix] -= _take(entry)
+
+    max_bytes = eviction_config.get('max_bytes')
+    if max_bytes:
+        total = sum([e['bytes'] for e in ordered if e['key'] not in chosen])
+        for entry in ordered:
+            if total <= max_bytes:
+                break
+            if entry['key'] not in chosen:
+                total -= _take(entry)
+    return victims
+
+
+def perform_eviction(config, redis_client):
+    """ Run one eviction pass, if configured to. Accounting for expired KQueries is forgotten either way,
+        since it is kept whether or not eviction is enabled.
+        :param config: dict, 'tscached' level from config file.
+        :param redis_client: redis.StrictRedis
+        :return: list of str, the evicted KQuery keys.
+        :raise: redis.exceptions.RedisError
+    """
+    entries = load_accounting(redis_client)
+    if not config.get('eviction', {}).get('enabled'):
+        return []
+
+    victims = choose_victims(config, entries, lambda kquery_key: evict_kquery(redis_client, kquery_key))
+    logging.info('Eviction: %d of %d KQueries evicted' % (len(victims), len(entries)))
+    return victims
@@ -6,11 +6,25 @@ from flask import request
 import redis
 
 from tscached import app
+from tscached import capture
+from tscached import circuit
+from tscached import compression
+from tscached import instrumentation
+from tscached import slowlog
+from tscached import timing
 from tscached.cache_calls import cold
+from tscached.cache_calls import empty_response
 from tscached.cache_calls import process_cache_hit
+from tscached.eviction import record_access
+from tscached.eviction import record_hit
 from tscached.kquery import KQuery
+from tscached.negative import REASON_ERROR
+from tscached.negative import get_negative
+from tscached.negative import set_negative
 from tscached.shadow import process_for_readahead
+from tscached.superset import serve_from_superset
 from tscached.utils import BackendQueryFailure
+from tscached.utils import KairosUnavailable
 from tscached.utils import populate_time_range
 
 
@@ -29,6 +43,17 @@ def handle_healthcheck():
     return ('', 204)
 
 
+def cached_coverage(kquery):
+    """ :param kquery: kquery.KQuery, get_cached was already called.
+        :return: 2-tuple of float (earliest, latest), unix seconds; None if the cached entry doesn't say.
+    """
+    cached = kquery.cached_data or {}
+    try:
+        return float(cached['earliest_data']), float(cached['last_add_data'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
 @app.route('/api/v1/datapoints/query', methods=['POST', 'GET'])
 def handle_query():
     try:
@@ -42,41 +67,122 @@ def handle_query():
         return json.dumps({'error': err}), 500
 
     config = app.config['tscached']
+    timings = timing.start()
 
     logging.info('Query')
     redis_client = redis.StrictRedis(host=config['redis']['host'], port=config['redis']['port'])
     kairos_time_range = populate_time_range(payload)
     ret_data = {'queries': []}
     overall_cache_mode = None
+    partial = circuit.partial_responses(config)
+    failures = []  # error messages of KQueries answered with no data at all
+    coverage = []  # (earliest, latest) of KQueries answered from cache alone
+    served = []  # (KQuery, cache mode, response), for traffic capture
 
     # HTTP request may contain one or more kqueries
     for kquery in KQuery.from_request(payload, redis_client):
+        timings.begin_kquery(kquery.get_key())
+        kq_result = None
         try:
             # get whatever is in redis for this kquery
-            kq_result = kquery.get_cached()
+            with timing.phase(timing.CACHE_LOOKUP):
+                kq_result = kquery.get_cached()
 
             # readahead shadow load support
             process_for_readahead(config, redis_client, kquery.get_key(), request.referrer,
                                   request.headers)
             if kq_result:
-                kq_resp, cache_mode = process_cache_hit(config, redis_client, kquery, kairos_time_range)
+                record_hit(redis_client, kquery.get_key())
+                kq_resp, cache_mode = process_cache_hit(config, redis_client, kquery, kairos_time_range,
+                                                        allow_stale=True)
             else:
-                kq_resp = cold(config, redis_client, kquery, kairos_time_range)
-                cache_mode = 'cold_miss'
+                # Before going COLD, check whether this exact KQuery recently came back empty or broken.
+                with timing.phase(timing.CACHE_LOOKUP):
+                    negative = get_negative(redis_client, kquery.get_key(), kairos_time_range)
+                # Failing that, a cached query that groups by tag may already hold the MTS we're filtering for.
+                with timing.phase(timing.SUPERSET):
+                    superset_resp = None if negative else serve_from_superset(config, redis_client, kquery,
+                                                                              kairos_time_range)
+                if negative and negative['reason'] == REASON_ERROR:
+                    logging.error('Negative HIT, BackendQueryFailure: %s' % negative.get('message'))
+                    if not partial:
+                        return json.dumps({'error': negative.get('message')}), 500
+                    failures.append(negative.get('message'))
+                    kq_resp = empty_response(kquery)
+                    cache_mode = 'failed'
+                elif negative:
+                    kq_resp = empty_response(kquery)
+                    cache_mode = 'negative'
+                elif superset_resp:
+                    kq_resp = superset_resp
+                    cache_mode = 'hot_superset'
+                else:
+                    kq_resp = cold(config, redis_client, kquery, kairos_time_range)
+                    cache_mode = 'cold_miss'
         except BackendQueryFailure as e:
-            # KairosDB is broken so we fail fast.
+            # KairosDB is broken so we fail fast. Remember that briefly, so retries don't pile on.
+            # Negative entries are only consulted on a miss, so there's no point writing one for a cached KQuery;
+            # nor when Kairos wasn't even asked (circuit open, load shed), which says nothing about the query.
             logging.error('BackendQueryFailure: %s' % e.message)
-            return json.dumps({'error': e.message}), 500
+            if not kq_result and not isinstance(e, KairosUnavailable):
+                try:
+                    set_negative(config, redis_client, kquery.get_key(), kairos_time_range, REASON_ERROR, e.message)
+                except redis.exceptions.RedisError as re:
+                    logging.error('RedisError: ' + re.message)
+            if not partial:
+                return json.dumps({'error': e.message}), 500
+            # Only this KQuery fails; the rest of the request carries on.
+            failures.append(e.message)
+            kq_resp = empty_response(kquery)
+            cache_mode = 'failed'
         except redis.exceptions.RedisError as e:
             # Redis is broken, so we pretend it's a cache miss. This will eat any further exceptions.
             logging.error('RedisError: ' + e.message)
             kq_resp = cold(config, redis_client, kquery, kairos_time_range)
             cache_mode = 'cold_proxy'
         ret_data['queries'].append(kq_resp)
+        instrumentation.incr('tscached_kqueries_total', mode=cache_mode)
+        timings.end_kquery(cache_mode)
+        instrumentation.observe('tscached_kquery_seconds', timings.kqueries[-1]['total_ms'] / 1000.0, mode=cache_mode)
+        served.append((kquery, cache_mode, kq_resp))
+        covered = cached_coverage(kquery) if cache_mode in ['degraded', 'partial'] else None
+        if covered:  # a malformed cache entry served as-is simply doesn't count.
+            coverage.append(covered)
 
         if not overall_cache_mode:
             overall_cache_mode = cache_mode
         elif cache_mode != overall_cache_mode:
             overall_cache_mode = 'mixed'
 
-    return json.dumps(ret_data), 200, {'Content-Type': 'application/json', 'X-tscached-mode': overall_cache_mode}
+    try:
+        record_access(redis_client, [kquery.get_key() for kquery, _, _ in served])
+    except redis.exceptions.RedisError as e:
+        logging.error('RedisError: ' + e.message)
+    capture.record(config, kairos_time_range, served, timings.elapsed())
+    slowlog.record(config, redis_client, kairos_time_range, served, timings)
+    if failures and len(failures) == len(ret_data['queries']):
+        return json.dumps({'error': ', '.join(failures)}), 500
+
+    if timing.debug_requested(config, request.headers):
+        ret_data['tscached_debug'] = timings.debug_payload()
+    with timing.phase(timing.SERIALIZE):
+        body = json.dumps(ret_data)
+
+    headers = {'Content-Type': 'application/json', 'X-tscached-mode': overall_cache_mode,
+               'X-tscached-modes': ','.join([mode for _, mode, _ in served])}  # per KQuery, in order
+    if coverage:
+        # The range (unix seconds) for which every KQuery served from cache alone is complete.
+        headers['X-tscached-covered-range'] = '%d-%d' % (max([c[0] for c in coverage]),
+                                                         min([c[1] for c in coverage]))
+    if failures:
+        headers['X-tscached-failed-queries'] = str(len(failures))
+    with timing.phase(timing.SERIALIZE):
+        response = compression.respond(config, request.headers.get('Accept-Encoding'), body, 200, headers)
+    if timing.server_timing_enabled(config):
+        response[2]['Server-Timing'] = timings.server_timing()
+    return response
+
+
+@app.teardown_request
+def stop_timing(exc):
+    timing.stop()
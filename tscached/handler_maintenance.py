@@ -6,7 +6,11 @@ import simplejson as json
 
 from tscached import VERSION
 from tscached import app
+from tscached import inspection
+from tscached import instrumentation
+from tscached import profiler
 from tscached import shadow
+from tscached import slowlog
 
 
 @app.route('/api/maintenance/flushall', methods=['GET'])
@@ -36,6 +40,125 @@ def handle_flushall():
     return json.dumps({'message': message}), 200
 
 
+@app.route('/api/maintenance/profiler/<any(start, stop, status):action>', methods=['GET'])
+def handle_profiler(action):
+    """ Sample the stacks of the worker that serves this request; see tscached.profiler.
+        start takes an optional duration=<seconds>; stop waits for the results to be stored.
+        Workers are picked by uwsgi, so which one is profiled is in the response; a run always ends by itself.
+        :return: 200 response, dict with keys 'message', 'worker' and 'profiles' (worker -> latest run).
+    """
+    config = app.config['tscached']
+    redis_client = redis.StrictRedis(host=config['redis']['host'], port=config['redis']['port'])
+    if action == 'start':
+        try:
+            duration = float(request.args.get('duration', 0)) or None
+        except ValueError:
+            return json.dumps({'message': 'duration must be a number of seconds.'}), 400
+        message = profiler.start(config, duration)[1]
+    elif action == 'stop':
+        stopped = profiler.stop()
+        message = 'Stopped; %d samples stored.' % stopped.samples if stopped else 'Not profiling this worker.'
+    else:
+        message = 'Profiles stored, by worker.'
+    return json.dumps({'message': message, 'worker': profiler.worker_name(),
+                       'profiles': profiler.status(redis_client)}), 200
+
+
+@app.route('/api/maintenance/profiler/collapsed', methods=['GET'])
+def handle_profiler_collapsed():
+    """ Stored stack samples, summed over workers, ready for flamegraph.pl.
+        worker=<host:pid> (repeatable) picks workers; the default is every worker with a stored profile.
+        :return: 200 text/plain response, one 'frame;frame;... count' line per stack.
+    """
+    config = app.config['tscached']
+    redis_client = redis.StrictRedis(host=config['redis']['host'], port=config['redis']['port'])
+    workers = request.args.getlist('worker') or sorted(profiler.status(redis_client))
+    try:
+        text = profiler.collapsed(redis_client, workers)
+    except redis.exceptions.RedisError as e:
+        logging.error('RedisError: ' + e.message)
+        return json.dumps({'error': 'Could not read profiles from Redis: %s' % e.message}), 500
+    return text, 200, {'Content-Type': 'text/plain'}
+
+
+@app.route('/api/maintenance/slowlog', methods=['GET'])
+def handle_slowlog():
+    """ The slow-query log, newest first; count=<n> limits how many entries (default 100).
+        :return: 200 response, dict with key 'entries' (list of dict); see tscached.slowlog.
+    """
+    config = app.config['tscached']
+    redis_client = redis.StrictRedis(host=config['redis']['host'], port=config['redis']['port'])
+    try:
+        count = int(request.args.get('count', 100))
+    except ValueError:
+        return json.dumps({'message': 'count must be an integer.'}), 400
+    if count <= 0:
+        return json.dumps({'message': 'count must be positive.'}), 400
+    try:
+        entries = slowlog.read(redis_client, count)
+    except redis.exceptions.RedisError as e:
+        logging.error('RedisError: ' + e.message)
+        return json.dumps({'error': 'Could not read the slow-query log from Redis: %s' % e.message}), 500
+    return json.dumps({'entries': entries}), 200
+
+
+@app.route('/api/maintenance/kqueries', methods=['GET'])
+def handle_list_kqueries():
+    """ Cached KQueries, with coverage, MTS count, bytes, TTL, hits and last access; see tscached.inspection.
+        sort=<bytes|mts|hits|last_access|ttl> (default bytes, descending), limit=<n> (default 100),
+        name=<metric name prefix>.
+        :return: 200 response, dict with totals and key 'kqueries' (list of dict).
+    """
+    config = app.config['tscached']
+    redis_client = redis.StrictRedis(host=config['redis']['host'], port=config['redis']['port'])
+    sort = request.args.get('sort', 'bytes')
+    if sort not in inspection.SORTS:
+        return json.dumps({'message': 'sort must be one of: %s' % ', '.join(inspection.SORTS)}), 400
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return json.dumps({'message': 'limit must be an integer.'}), 400
+    if limit < 0:
+        return json.dumps({'message': 'limit must not be negative.'}), 400
+    try:
+        listing = inspection.list_kqueries(redis_client, sort, limit, request.args.get('name'))
+    except redis.exceptions.RedisError as e:
+        logging.error('RedisError: ' + e.message)
+        return json.dumps({'error': 'Could not read KQueries from Redis: %s' % e.message}), 500
+    return json.dumps(listing), 200
+
+
+@app.route('/api/maintenance/kqueries/<kquery_key>', methods=['GET'])
+def handle_inspect_kquery(kquery_key):
+    """ One KQuery (by its full key, tscached:kquery:HASH) and its MTS, with per-series points and gaps.
+        :return: 200 response, dict; 404 if the KQuery is not cached.
+    """
+    config = app.config['tscached']
+    redis_client = redis.StrictRedis(host=config['redis']['host'], port=config['redis']['port'])
+    try:
+        details = inspection.inspect_kquery(redis_client, kquery_key)
+    except redis.exceptions.RedisError as e:
+        logging.error('RedisError: ' + e.message)
+        return json.dumps({'error': 'Could not read KQuery from Redis: %s' % e.message}), 500
+    if not details:
+        return json.dumps({'message': 'Not cached: %s' % kquery_key}), 404
+    return json.dumps(details), 200
+
+
 @app.route('/version', methods=['GET'])
 def handle_version():
     return VERSION, 200
+
+
+@app.route('/metrics', methods=['GET'])
+def handle_metrics():
+    """ Prometheus scrape endpoint. Totals are across every worker that has flushed to this Redis. """
+    config = app.config['tscached']
+    redis_client = redis.StrictRedis(host=config['redis']['host'], port=config['redis']['port'])
+    instrumentation.flush(redis_client, force=True)
+    try:
+        fields = redis_client.hgetall(instrumentation.METRICS_KEY)
+    except redis.exceptions.RedisError as e:
+        logging.error('RedisError: ' + e.message)
+        return json.dumps({'error': 'Could not read metrics from Redis: %s' % e.message}), 500
+    return instrumentation.render(fields), 200, {'Content-Type': 'text/plain; version=0.0.4'}
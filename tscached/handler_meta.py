@@ -1,4 +1,6 @@
 import logging
+import threading
+import time
 
 from flask import request
 import redis
@@ -6,6 +8,11 @@ import requests
 import simplejson as json
 
 from tscached import app
+from tscached import circuit
+from tscached import compression
+from tscached import meta_index
+from tscached.tag_index import answer_tags_query
+from tscached.utils import BackendQueryFailure
 from tscached.utils import create_key
 
 
@@ -16,82 +23,293 @@ from tscached.utils import create_key
 """
 
 
-def metadata_caching(config, name, endpoint, post_data=None):
-    """ Encapsulate stupid-simple cache logic for Kairos "metadata" endpoints.
+def fresh_key(redis_key):
+    """ tscached:metricnames -> tscached:meta_fresh:metricnames. Exists while the value is fresh. """
+    return redis_key.replace('tscached:', 'tscached:meta_fresh:', 1)
+
+
+def lock_key(redis_key):
+    """ tscached:metricnames -> tscached:meta_lock:metricnames. Held by whoever is refreshing the value. """
+    return redis_key.replace('tscached:', 'tscached:meta_lock:', 1)
+
+
+def fetch_metadata(config, redis_key, endpoint, post_data=None):
+    """ Ask Kairos for a metadata endpoint.
+        :param config: nested dict loaded from the 'tscached' section of a yaml file.
+        :param redis_key: str, for log and error messages.
+        :param endpoint: str, the corresponding kairosdb endpoint.
+        :param post_data: None or str. overrides default GET proxy behavior.
+        :return: requests.Response, with a 2xx status.
+        :raise: BackendQueryFailure
+    """
+    url = 'http://%s:%s%s' % (config['kairosdb']['host'], config['kairosdb']['port'], endpoint)
+    # Never outlive the refresh lock, or a second refresh could start while this one still waits on Kairos.
+    timeout = config.get('metadata', {}).get('lock_timeout', 30)
+    if circuit.request_timeout:
+        timeout = min(timeout, circuit.request_timeout)
+    try:
+        if post_data:
+            kairos_result = requests.post(url, data=post_data, timeout=timeout)
+        else:
+            kairos_result = requests.get(url, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        logging.error('BackendQueryFailure: %s' % e.message)
+        raise BackendQueryFailure('Could not connect to KairosDB: %s' % e.message)
+
+    if kairos_result.status_code / 100 != 2:
+        # propagate the kairos message to the user along with its error code.
+        value = json.loads(kairos_result.text)
+        value_message = ', '.join(value.get('errors', ['No message given']))
+        message = 'Meta Endpoint: %s: KairosDB responded %d: %s' % (redis_key, kairos_result.status_code,
+                                                                    value_message)
+        raise BackendQueryFailure(message)
+    return kairos_result
+
+
+def store_metadata(config, redis_client, name, redis_key, text):
+    """ Cache a metadata response. The value outlives its freshness marker by metadata.stale_expiry, so it
+        can still be served (while being refreshed) after it has gone stale, or while KairosDB is failing.
+        :return: void
+        :raise: redis.exceptions.RedisError
+    """
+    expiry = config['expiry'].get(name, 300)  # 5 minute default
+    stale_expiry = config.get('metadata', {}).get('stale_expiry', 86400)
+    value = text
+    if config.get('compression', {}).get('store_metadata', False):
+        value = compression.compress(text, compression.GZIP)  # served as-is to clients accepting gzip
+    pipeline = redis_client.pipeline()
+    pipeline.set(redis_key, value, ex=expiry + stale_expiry)
+    pipeline.set(fresh_key(redis_key), 1, ex=expiry)
+    set_result = pipeline.execute()
+    if not all(set_result):
+        logging.error('Meta Endpoint: %s: Cache SET failed: %s' % (redis_key, set_result))
+
+    if name in meta_index.INDEXED and redis_key == 'tscached:' + name:
+        meta_index.build_index(redis_client, name, text, expiry + stale_expiry)
+
+
+def take_refresh_lock(config, redis_client, redis_key):
+    """ Claim the right to refresh a metadata value, for metadata.lock_timeout seconds at most.
+        :return: boolean, whether to go ahead; True also if Redis is down (refresh unlocked rather than not at all).
+    """
+    lock_timeout = config.get('metadata', {}).get('lock_timeout', 30)
+    try:
+        return bool(redis_client.set(lock_key(redis_key), 1, nx=True, ex=lock_timeout))
+    except redis.exceptions.RedisError as e:
+        logging.error('RedisError: ' + e.message)
+        return True
+
+
+def refresh_locked(config, redis_client, name, redis_key, endpoint, post_data=None):
+    """ Fetch and cache a metadata endpoint, then release the refresh lock. Call only holding it.
+        :return: str, the new value.
+        :raise: BackendQueryFailure
+    """
+    try:
+        text = fetch_metadata(config, redis_key, endpoint, post_data).text
+        try:
+            store_metadata(config, redis_client, name, redis_key, text)
+        except redis.exceptions.RedisError as e:
+            # Eat the Redis exception - turns these endpoints into straight proxies.
+            logging.error('RedisError: ' + e.message)
+        return text
+    finally:
+        try:
+            redis_client.delete(lock_key(redis_key))
+        except redis.exceptions.RedisError as e:
+            logging.error('RedisError: ' + e.message)
+
+
+def refresh_metadata(config, redis_client, name, redis_key, endpoint, post_data=None):
+    """ Fetch and cache a metadata endpoint, unless another worker is already doing so.
+        :return: str, the new value; or None if the refresh was left to someone else.
+        :raise: BackendQueryFailure
+    """
+    if not take_refresh_lock(config, redis_client, redis_key):
+        return None
+    return refresh_locked(config, redis_client, name, redis_key, endpoint, post_data)
+
+
+def refresh_in_background(config, redis_client, name, redis_key, endpoint, post_data=None):
+    """ refresh_metadata on another thread. Errors are logged; the stale value stays in place.
+        The lock is taken first, here, so that only the one worker which gets it starts a thread.
+        :return: threading.Thread; or None if another worker is already refreshing.
+    """
+    if not take_refresh_lock(config, redis_client, redis_key):
+        return None
+
+    def _refresh():
+        try:
+            refresh_locked(config, redis_client, name, redis_key, endpoint, post_data)
+        except BackendQueryFailure as e:
+            logging.error('Meta Endpoint: background refresh failed, serving stale: %s' % e.message)
+
+    thr = threading.Thread(target=_refresh)
+    thr.daemon = True
+    thr.start()
+    return thr
+
+
+def wait_for_metadata(config, redis_client, redis_key):
+    """ Another worker holds the refresh lock for a value we don't have. Wait a while for it to appear.
+        :return: str, the value; or None if it did not show up in time.
+        :raise: redis.exceptions.RedisError
+    """
+    deadline = time.time() + config.get('metadata', {}).get('coalesce_wait', 10)
+    while time.time() < deadline:
+        time.sleep(0.05)
+        value = redis_client.get(redis_key)
+        if value:
+            return compression.gunzip(value)
+        if not redis_client.exists(lock_key(redis_key)):  # the other worker gave up.
+            return None
+    return None
+
+
+def metadata_caching(config, name, endpoint, post_data=None, accept_encoding=None):
+    """ Cache logic for Kairos "metadata" endpoints, which can be very slow to answer.
+        - Fresh values are served as-is.
+        - Values close to (refresh_ahead), or past, their expiry are served as-is while one worker
+          refreshes them in the background. If KairosDB fails, they stay until metadata.stale_expiry.
+        - On a miss, only one worker asks KairosDB; the rest wait for its answer.
         config: nested dict loaded from the 'tscached' section of a yaml file.
         name: string, used as a part of redis keying.
         endpoint: string, the corresponding kairosdb endpoint.
         post_data: None or string. overrides default GET proxy behavior. implies custom keying.
+        accept_encoding: None or string, the client's Accept-Encoding. values stored gzipped are then
+                         served without decompressing them.
         returns: 2-tuple: (content, HTTP code)
     """
     if post_data:
         redis_key = create_key(post_data, name)
     else:
         redis_key = 'tscached:' + name
+    headers = {'Content-Type': 'application/json'}
+    refresh_ahead = config.get('metadata', {}).get('refresh_ahead', 60)
 
     redis_client = redis.StrictRedis(host=config['redis']['host'], port=config['redis']['port'])
     try:
-        get_result = redis_client.get(redis_key)
+        pipeline = redis_client.pipeline()
+        pipeline.get(redis_key)
+        pipeline.ttl(fresh_key(redis_key))
+        get_result, fresh_ttl = pipeline.execute()
     except redis.exceptions.RedisError as e:
         logging.error('RedisError: ' + e.message)
         get_result = False  # proxy through to kairos even if redis is broken
+        fresh_ttl = None
 
     if get_result:  # hit. no need to process the JSON blob, so don't!
-        logging.info('Meta Endpoint HIT: %s' % redis_key)
-        return get_result, 200
-    else:
-        logging.info('Meta Endpoint MISS: %s' % redis_key)
-        url = 'http://%s:%s%s' % (config['kairosdb']['host'], config['kairosdb']['port'], endpoint)
-
-        try:
-            if post_data:
-                kairos_result = requests.post(url, data=post_data)
-            else:
-                kairos_result = requests.get(url)
-
-        except requests.exceptions.RequestException as e:
-            logging.error('BackendQueryFailure: %s' % e.message)
-            return json.dumps({'error': 'Could not connect to KairosDB: %s' % e.message}), 500
-
-        if kairos_result.status_code / 100 != 2:
-            # propagate the kairos message to the user along with its error code.
-            value = json.loads(kairos_result.text)
-            value_message = ', '.join(value.get('errors', ['No message given']))
-            message = 'Meta Endpoint: %s: KairosDB responded %d: %s' % (redis_key,
-                                                                        kairos_result.status_code,
-                                                                        value_message)
-            return json.dumps({'error': message}), 500
+        if fresh_ttl is None or fresh_ttl < 0 or fresh_ttl <= refresh_ahead:
+            logging.info('Meta Endpoint STALE, refreshing in background: %s' % redis_key)
+            refresh_in_background(config, redis_client, name, redis_key, endpoint, post_data)
         else:
-            # kairos response seems to be okay
-            expiry = config['expiry'].get(name, 300)  # 5 minute default
+            logging.info('Meta Endpoint HIT: %s' % redis_key)
+        if compression.is_gzipped(get_result):
+            if (config.get('compression', {}).get('enabled', False) and
+                    compression.GZIP in compression.accepted(accept_encoding)):
+                headers['Content-Encoding'] = compression.GZIP
+                headers['Vary'] = 'Accept-Encoding'
+                return get_result, 200, headers
+            get_result = compression.gunzip(get_result)
+        return get_result, 200, headers
 
+    logging.info('Meta Endpoint MISS: %s' % redis_key)
+    try:
+        text = refresh_metadata(config, redis_client, name, redis_key, endpoint, post_data)
+        if text is None:  # someone else is already asking Kairos.
+            logging.info('Meta Endpoint: waiting on refresh in flight: %s' % redis_key)
             try:
-                set_result = redis_client.set(redis_key, kairos_result.text, ex=expiry)
-                if not set_result:
-                    logging.error('Meta Endpoint: %s: Cache SET failed: %s' % (redis_key, set_result))
+                text = wait_for_metadata(config, redis_client, redis_key)
             except redis.exceptions.RedisError as e:
-                # Eat the Redis exception - turns these endpoints into straight proxies.
                 logging.error('RedisError: ' + e.message)
+            if text is None:
+                text = fetch_metadata(config, redis_key, endpoint, post_data).text
+    except BackendQueryFailure as e:
+        return json.dumps({'error': e.message}), 500
+    return text, 200, headers
 
-        return kairos_result.text, kairos_result.status_code, {'Content-Type': 'application/json'}
+
+def compressed(config, response):
+    """ Compress a handler's response tuple for the current request, as its Accept-Encoding allows. """
+    return compression.respond(config, request.headers.get('Accept-Encoding'), *response)
 
 
 @app.route('/api/v1/metricnames', methods=['GET'])
 def handle_metricnames():
-    return metadata_caching(app.config['tscached'], 'metricnames', '/api/v1/metricnames')
+    config = app.config['tscached']
+    return compressed(config, metadata_caching(config, 'metricnames', '/api/v1/metricnames',
+                                               accept_encoding=request.headers.get('Accept-Encoding')))
 
 
 @app.route('/api/v1/tagnames', methods=['GET'])
 def handle_tagnames():
-    return metadata_caching(app.config['tscached'], 'tagnames', '/api/v1/tagnames')
+    config = app.config['tscached']
+    return compressed(config, metadata_caching(config, 'tagnames', '/api/v1/tagnames',
+                                               accept_encoding=request.headers.get('Accept-Encoding')))
 
 
 @app.route('/api/v1/tagvalues', methods=['GET'])
 def handle_tagvalues():
-    return metadata_caching(app.config['tscached'], 'tagvalues', '/api/v1/tagvalues')
+    config = app.config['tscached']
+    return compressed(config, metadata_caching(config, 'tagvalues', '/api/v1/tagvalues',
+                                               accept_encoding=request.headers.get('Accept-Encoding')))
 
 
 @app.route('/api/v1/datapoints/query/tags', methods=['POST'])
 def handle_metaquery():
-    return metadata_caching(app.config['tscached'], 'metaquery', '/api/v1/datapoints/query/tags',
-                            request.data)
+    config = app.config['tscached']
+    try:
+        payload = json.loads(request.data)
+        redis_client = redis.StrictRedis(host=config['redis']['host'], port=config['redis']['port'])
+        answer = answer_tags_query(config, redis_client, payload)
+        if answer:
+            logging.info('Meta Endpoint: tags query answered from the tag index')
+            return compressed(config, (json.dumps(answer), 200, {'Content-Type': 'application/json'}))
+    except redis.exceptions.RedisError as e:
+        logging.error('RedisError: ' + e.message)
+    except (ValueError, AttributeError):
+        pass  # not something we understand; let KairosDB judge it.
+    return compressed(config, metadata_caching(config, 'metaquery', '/api/v1/datapoints/query/tags', request.data,
+                                               accept_encoding=request.headers.get('Accept-Encoding')))
+
+
+@app.route('/api/v1/<any(metricnames, tagnames, tagvalues):name>/search', methods=['GET'])
+def handle_metadata_search(name):
+    """ Search metric names, tag names or tag values, for autocompletion.
+        Query string: q (the search term), mode (prefix or substring; default prefix), limit, offset.
+        Responds {"results": [...], "total": N, "offset": N, "limit": N}, in lexical order.
+    """
+    config = app.config['tscached']
+    query = request.args.get('q', '')
+    mode = request.args.get('mode', meta_index.PREFIX)
+    try:
+        limit = min(int(request.args.get('limit', 100)), 10000)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return json.dumps({'error': 'limit and offset must be integers'}), 400
+    if limit < 1:
+        return json.dumps({'error': 'limit must be at least 1'}), 400
+    if mode not in [meta_index.PREFIX, meta_index.SUBSTRING]:
+        return json.dumps({'error': 'mode must be prefix or substring'}), 400
+
+    redis_client = redis.StrictRedis(host=config['redis']['host'], port=config['redis']['port'])
+    try:
+        found = meta_index.search_index(redis_client, name, query, mode, limit, offset)
+        if found is None:  # not indexed yet: fetching the endpoint builds the index.
+            response = metadata_caching(config, name, '/api/v1/' + name)
+            if response[1] != 200:
+                return response
+            found = meta_index.search_index(redis_client, name, query, mode, limit, offset)
+            if found is None:
+                found = meta_index.search_list(json.loads(response[0]).get('results', []), query, mode,
+                                               limit, offset)
+    except redis.exceptions.RedisError as e:
+        logging.error('RedisError: ' + e.message)
+        response = metadata_caching(config, name, '/api/v1/' + name)
+        if response[1] != 200:
+            return response
+        found = meta_index.search_list(json.loads(response[0]).get('results', []), query, mode, limit, offset)
+
+    results, total = found
+    return compressed(config, (json.dumps({'results': results, 'total': total, 'offset': offset, 'limit': limit}),
+                               200, {'Content-Type': 'application/json'}))
@@ -0,0 +1,145 @@
+import simplejson as json
+
+from tscached import instrumentation
+from tscached.eviction import forget_accounting
+from tscached.eviction import KQUERY_ACCESS
+from tscached.eviction import KQUERY_HITS
+from tscached.eviction import KQUERY_SIZES
+from tscached.mts import MTS
+from tscached.superset import BOOKKEEPING_FIELDS
+
+
+"""
+    What is in the cache? For tuning memory and spotting pathological (say, wildcard) queries.
+    KQueries are found through the size accounting hash kept for eviction, which every KQuery write updates;
+    hit counts and last client access come from their own hashes alongside. Times are unix seconds.
+"""
+
+
+SORTS = ['bytes', 'mts', 'hits', 'last_access', 'ttl']
+
+
+def gap_stats(timestamps):
+    """ How regular is a series? The expected interval is taken to be the median one.
+        :param timestamps: list of int, ms since epoch, ascending.
+        :return: dict, with keys points, first, last, interval, gaps (steps over 1.5 intervals),
+                 max_gap (seconds) and missing (points the gaps would have held).
+    """
+    stats = {'points': len(timestamps), 'first': None, 'last': None, 'interval': None, 'gaps': 0,
+             'max_gap': None, 'missing': 0}
+    if not timestamps:
+        return stats
+    stats['first'] = timestamps[0] / 1000.0
+    stats['last'] = timestamps[-1] / 1000.0
+    steps = [later - earlier for earlier, later in zip(timestamps, timestamps[1:])]
+    if not steps:
+        return stats
+    interval = sorted(steps)[(len(steps) - 1) / 2]  # the lower median
+    stats['interval'] = interval / 1000.0
+    stats['max_gap'] = max(steps) / 1000.0
+    if interval > 0:
+        for step in steps:
+            if step > 1.5 * interval:
+                stats['gaps'] += 1
+                stats['missing'] += int(round(float(step) / interval)) - 1
+    return stats
+
+
+def list_kqueries(redis_client, sort='bytes', limit=100, name=None):
+    """ Every cached KQuery, biggest (or as sorted) first. Accounting for those found expired is dropped.
+        :param redis_client: redis.StrictRedis
+        :param sort: str, one of SORTS; descending.
+        :param limit: int, at most this many KQueries listed. Totals count them all.
+        :param name: str, only KQueries for metric names starting with this.
+        :return: dict, with keys count, bytes, mts (totals) and kqueries (list of dict).
+        :raise: redis.exceptions.RedisError
+    """
+    sizes = redis_client.hgetall(KQUERY_SIZES)
+    hits = redis_client.hgetall(KQUERY_HITS)
+    access = redis_client.hgetall(KQUERY_ACCESS)
+    keys = []
+    for key, info in sizes.iteritems():
+        info = json.loads(info)
+        if not name or (info.get('name') or '').startswith(name):
+            keys.append((key, info))
+
+    pipeline = redis_client.pipeline()
+    for key, _ in keys:
+        pipeline.get(key)
+        pipeline.ttl(key)
+    results = instrumentation.execute(pipeline, 'inspection')
+
+    kqueries = []
+    expired = []
+    for ndx, (key, info) in enumerate(keys):
+        cached, ttl = results[2 * ndx], results[2 * ndx + 1]
+        if not cached:
+            expired.append(key)
+            continue
+        cached = json.loads(cached)
+        kqueries.append({
+            'key': key,
+            'name': info.get('name'),
+            'query': dict((k, v) for k, v in cached.iteritems() if k not in BOOKKEEPING_FIELDS),
+            'earliest_data': cached.get('earliest_data'),
+            'last_add_data': cached.get('last_add_data'),
+            'mts': len(cached.get('mts_keys', [])),
+            'bytes': info.get('bytes', 0),
+            'ttl': ttl,
+            'hits': int(hits.get(key, 0)),
+            'last_access': int(access[key]) if key in access else None,
+        })
+    forget_accounting(redis_client, expired)
+    kqueries.sort(key=lambda kq: kq[sort], reverse=True)
+    return {
+        'count': len(kqueries),
+        'bytes': sum([kq['bytes'] for kq in kqueries]),
+        'mts': sum([kq['mts'] for kq in kqueries]),
+        'kqueries': kqueries[:limit],
+    }
+
+
+def inspect_kquery(redis_client, kquery_key):
+    """ One KQuery and each of its MTS: size, TTL, points and how gappy they are.
+        :param redis_client: redis.StrictRedis
+        :param kquery_key: str, usually tscached:kquery:HASH
+        :return: dict, or None if the KQuery is not cached.
+        :raise: redis.exceptions.RedisError
+    """
+    pipeline = redis_client.pipeline()
+    pipeline.get(kquery_key)
+    pipeline.ttl(kquery_key)
+    pipeline.hget(KQUERY_HITS, kquery_key)
+    pipeline.hget(KQUERY_ACCESS, kquery_key)
+    cached, ttl, hits, access = instrumentation.execute(pipeline, 'inspection')
+    if not cached:
+        return None
+    cached = json.loads(cached)
+    mts_keys = cached.get('mts_keys', [])
+
+    pipeline = redis_client.pipeline()
+    for mts_key in mts_keys:
+        pipeline.ttl(mts_key)
+    ttls = dict(zip(mts_keys, instrumentation.execute(pipeline, 'inspection')))
+
+    mts_list = []
+    for mts in MTS.from_cache(mts_keys, redis_client):
+        timestamps = [pair[0] for pair in mts.result['values']]
+        entry = {'key': mts.get_key(), 'name': mts.result.get('name'), 'tags': mts.result.get('tags', {}),
+                 'group_by': mts.result.get('group_by', []), 'bytes': mts.size, 'ttl': ttls.get(mts.get_key())}
+        entry.update(gap_stats(timestamps))
+        mts_list.append(entry)
+
+    return {
+        'key': kquery_key,
+        'query': dict((k, v) for k, v in cached.iteritems() if k not in BOOKKEEPING_FIELDS),
+        'earliest_data': cached.get('earliest_data'),
+        'last_add_data': cached.get('last_add_data'),
+        'ttl': ttl,
+        'hits': int(hits or 0),
+        'last_access': int(access) if access else None,
+        'bytes': sum([m['bytes'] for m in mts_list]),
+        'points': sum([m['points'] for m in mts_list]),
+        'missing_mts': len(mts_keys) - len(mts_list),  # expired, or evicted with another KQuery
+        'mts': mts_list,
+    }
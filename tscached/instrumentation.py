@@ -0,0 +1,193 @@
+import bisect
+import logging
+import threading
+import time
+
+from flask import g
+from flask import request
+import redis
+
+
+"""
+    Counters and latency histograms for the cache and its backends.
+    Each process (uwsgi worker, readahead script) buffers its own increments and periodically flushes them,
+    with HINCRBYFLOAT, into one shared Redis hash, tscached:metrics. The hash therefore holds totals across
+    every worker, and render() turns it into the Prometheus text exposition format for /metrics.
+    Fields are named 'metric|label=value,label=value'; histogram buckets are stored cumulatively.
+"""
+
+
+METRICS_KEY = 'tscached:metrics'
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+# name -> (type, help). Only registered metrics are recorded.
+METRICS = {
+    'tscached_requests_total': (COUNTER, 'HTTP requests handled, by endpoint and status code.'),
+    'tscached_request_seconds': (HISTOGRAM, 'Time to answer an HTTP request, by endpoint.'),
+    'tscached_response_bytes_total': (COUNTER, 'Bytes of response bodies sent, by endpoint.'),
+    'tscached_kqueries_total': (COUNTER, 'KQueries answered, by cache mode.'),
+    'tscached_kquery_seconds': (HISTOGRAM, 'Time to answer one KQuery, by cache mode.'),
+    'tscached_kairos_request_seconds': (HISTOGRAM, 'Duration of KairosDB queries (one per chunk), by outcome.'),
+    'tscached_redis_pipeline_seconds': (HISTOGRAM, 'Duration of Redis pipeline executions, by caller.'),
+    'tscached_redis_pipeline_commands_total': (COUNTER, 'Commands sent in Redis pipelines, by caller.'),
+    'tscached_redis_pipelines_total': (COUNTER, 'Redis pipelines executed, by caller.'),
+    'tscached_readahead_runs_total': (COUNTER, 'Readahead runs, by outcome.'),
+    'tscached_readahead_kqueries_total': (COUNTER, 'KQueries refreshed by readahead.'),
+    'tscached_readahead_seconds': (HISTOGRAM, 'Duration of readahead runs.'),
+}
+
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+FLUSH_INTERVAL = 5  # seconds
+
+pending = {}  # field -> increment, not yet flushed
+lock = threading.Lock()
+last_flush = [time.time()]
+
+
+def field_name(name, labels):
+    """ 'tscached_kqueries_total', {'mode': 'hot'} -> 'tscached_kqueries_total|mode=hot' """
+    return '%s|%s' % (name, ','.join(['%s=%s' % (k, labels[k]) for k in sorted(labels)]))
+
+
+def incr(name, value=1, **labels):
+    """ Add to a counter. """
+    if name not in METRICS:
+        logging.error('Instrumentation: unregistered metric %s' % name)
+        return
+    field = field_name(name, labels)
+    with lock:
+        pending[field] = pending.get(field, 0) + value
+
+
+def observe(name, seconds, **labels):
+    """ Record one observation in a histogram. """
+    if name not in METRICS:
+        logging.error('Instrumentation: unregistered metric %s' % name)
+        return
+    first = bisect.bisect_left(BUCKETS, seconds)
+    fields = [field_name(name + '_bucket', dict(labels, le=le)) for le in BUCKETS[first:]]
+    fields.append(field_name(name + '_bucket', dict(labels, le='+Inf')))
+    fields.append(field_name(name + '_count', labels))
+    with lock:
+        for field in fields:
+            pending[field] = pending.get(field, 0) + 1
+        sum_field = field_name(name + '_sum', labels)
+        pending[sum_field] = pending.get(sum_field, 0) + seconds
+
+
+def execute(pipeline, caller):
+    """ Execute a Redis pipeline, recording its size and duration.
+        :param pipeline: redis.client.StrictPipeline
+        :param caller: str, label for where it was executed from.
+        :return: list, the pipeline's results.
+        :raise: redis.exceptions.RedisError
+    """
+    try:
+        size = len(pipeline)
+    except (TypeError, AttributeError):  # not a real pipeline.
+        size = 0
+    started = time.time()
+    try:
+        return pipeline.execute()
+    finally:
+        observe('tscached_redis_pipeline_seconds', time.time() - started, caller=caller)
+        incr('tscached_redis_pipeline_commands_total', size, caller=caller)
+        incr('tscached_redis_pipelines_total', caller=caller)
+
+
+def install(app):
+    """ Time and count every request the Flask app handles; also the natural point to flush this worker's
+        buffered metrics.
+        :param app: flask.Flask, with the 'tscached' config loaded.
+        :return: void
+    """
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.time()
+
+    @app.after_request
+    def record_request_metrics(response):
+        endpoint = request.endpoint or 'unknown'
+        if hasattr(g, 'request_started'):
+            observe('tscached_request_seconds', time.time() - g.request_started, endpoint=endpoint)
+        incr('tscached_requests_total', endpoint=endpoint, status=response.status_code)
+        incr('tscached_response_bytes_total', response.content_length or 0, endpoint=endpoint)
+
+        config = app.config['tscached']
+        flush(redis.StrictRedis(host=config['redis']['host'], port=config['redis']['port']))
+        return response
+
+
+def flush(redis_client, force=False):
+    """ Push buffered increments to Redis, at most every FLUSH_INTERVAL seconds unless forced.
+        On failure they are put back, to be retried with the next flush.
+        :param redis_client: redis.StrictRedis
+        :param force: bool, flush regardless of when we last did.
+        :return: int, number of fields flushed.
+    """
+    now = time.time()
+    with lock:
+        if not pending or (not force and now - last_flush[0] < FLUSH_INTERVAL):
+            return 0
+        batch = dict(pending)
+        pending.clear()
+        last_flush[0] = now
+
+    try:
+        pipeline = redis_client.pipeline()
+        for field, value in batch.iteritems():
+            pipeline.hincrbyfloat(METRICS_KEY, field, value)
+        pipeline.execute()
+    except redis.exceptions.RedisError as e:
+        logging.error('RedisError: ' + e.message)
+        with lock:
+            for field, value in batch.iteritems():
+                pending[field] = pending.get(field, 0) + value
+        return 0
+    return len(batch)
+
+
+def format_value(value):
+    value = float(value)
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def render(fields):
+    """ Prometheus text exposition format.
+        :param fields: dict, the contents of METRICS_KEY.
+        :return: str
+    """
+    by_metric = {}
+    for field, value in fields.iteritems():
+        sample_name, _, label_str = field.partition('|')
+        base = sample_name
+        for suffix in ['_bucket', '_sum', '_count']:
+            if sample_name.endswith(suffix) and sample_name[:-len(suffix)] in METRICS:
+                base = sample_name[:-len(suffix)]
+        if base not in METRICS:
+            continue
+        labels = [tuple(pair.split('=', 1)) for pair in label_str.split(',') if pair]
+        by_metric.setdefault(base, []).append((sample_name, labels, value))
+
+    def sort_key(sample):
+        sample_name, labels, _ = sample
+        le = dict(labels).get('le')
+        le = float('inf') if le == '+Inf' else float(le or 0)
+        return (sample_name, [pair for pair in labels if pair[0] != 'le'], le)
+
+    lines = []
+    for base in sorted(by_metric):
+        metric_type, help_text = METRICS[base]
+        lines.append('# HELP %s %s' % (base, help_text))
+        lines.append('# TYPE %s %s' % (base, metric_type))
+        for sample_name, labels, value in sorted(by_metric[base], key=sort_key):
+            label_text = ','.join(['%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                                   for k, v in labels])
+            lines.append('%s%s %s' % (sample_name, '{%s}' % label_text if label_text else '',
+                                      format_value(value)))
+    return '\n'.join(lines) + '\n'
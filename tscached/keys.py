@@ -0,0 +1,75 @@
+import hashlib
+
+import simplejson as json
+
+try:
+    import xxhash
+except ImportError:  # optional: pip install xxhash
+    xxhash = None
+
+
+"""
+    Canonical cache keys. A key's hash is taken over a canonical JSON rendering of its basis: keys sorted,
+    no insignificant whitespace, and integral floats written as integers. Two queries that differ only in
+    dict ordering or in 60 vs 60.0 therefore share a cache entry.
+    This is not what earlier tscached hashed (json.dumps of the raw basis), so every key changes on upgrade:
+    the cache starts over from empty, and what was stored under the old keys ages out with its TTL.
+    The hash itself is configurable, from the 'keys' section of the config, via configure():
+    - md5 (default): available everywhere.
+    - blake2: hashlib.blake2b; Python 3.6+ only.
+    - xxhash: xxh64; needs the xxhash package.
+    Changing it, likewise, starts the cache over.
+"""
+
+
+def _md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def _blake2(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _xxhash(data):
+    return xxhash.xxh64(data).hexdigest()
+
+
+HASHES = {
+    'md5': _md5,
+    'blake2': _blake2 if hasattr(hashlib, 'blake2b') else None,
+    'xxhash': _xxhash if xxhash else None,
+}
+
+digest = _md5
+
+
+def configure(config):
+    """ Choose the key hash. Call once per process at startup.
+        Workers must agree on it, so one that cannot use the configured hash refuses to start.
+        :param config: dict, 'tscached' level from config file.
+        :return: void
+        :raise: ValueError, if the hash is unknown or unavailable here.
+    """
+    global digest
+    name = config.get('keys', {}).get('hash', 'md5')
+    if name not in HASHES:
+        raise ValueError('Unknown key hash: %s' % name)
+    if not HASHES[name]:
+        raise ValueError('Key hash %s is unavailable here' % name)
+    digest = HASHES[name]
+
+
+def normalize_numbers(data):
+    """ Recursively rewrite integral floats (60.0) as ints (60). Returns a new structure. """
+    if isinstance(data, float) and data.is_integer():
+        return int(data)
+    if isinstance(data, dict):
+        return dict((k, normalize_numbers(v)) for k, v in data.iteritems())
+    if isinstance(data, list):
+        return [normalize_numbers(v) for v in data]
+    return data
+
+
+def canonical_json(data):
+    """ Order-independent, whitespace-free JSON for hashing. Not meant to be parsed back. """
+    return json.dumps(normalize_numbers(data), sort_keys=True, separators=(',', ':'))
@@ -2,10 +2,19 @@ import copy
 import datetime
 import logging
 import threading
+import time
 
+import circuit
 from datacache import DataCache
+import instrumentation
+from keys import canonical_json
+from mts import group_values
+from mts import query_basis_for
+from normalize import normalize_query
+import timing
 from utils import BackendQueryFailure
 from utils import get_timedelta
+from utils import KairosUnavailable
 from utils import query_kairos
 
 
@@ -15,6 +24,8 @@ class KQuery(DataCache):
     query = None
     related_mts = None
     window_size = False  # or datetime.timedelta of largest aggregator
+    mts_query_basis = None  # set in get_mts_query_basis
+    refs_until = None  # unix timestamp its MTS references were last registered to; see cache_calls.write_kquery
 
     def __init__(self, redis_client):
         super(KQuery, self).__init__(redis_client, 'kquery')
@@ -53,7 +64,7 @@ class KQuery(DataCache):
         pipeline = redis_client.pipeline()
         for key in redis_keys:
             pipeline.get(key)
-        results = pipeline.execute()
+        results = instrumentation.execute(pipeline, 'kquery_from_cache')
         for ctr in xrange(len(redis_keys)):
             try:
                 new = cls(redis_client)
@@ -65,9 +76,26 @@ class KQuery(DataCache):
             except KeyError:
                 logging.error('KQuery no longer cached: %s' % redis_keys[ctr])
 
+    def clone(self):
+        """ Copy this KQuery so it can be worked on elsewhere; only the redis client is shared. """
+        new = self.__class__(self.redis_client)
+        new.redis_key = self.get_key()
+        new.query = copy.deepcopy(self.query)
+        new.cached_data = copy.deepcopy(getattr(self, 'cached_data', None))
+        new.window_size = self.window_size
+        return new
+
     def key_basis(self):
-        """ We already remove the timestamps and store them separately. """
-        return self.query
+        """ We already remove the timestamps and store them separately.
+            The query is normalized, so that equivalent spellings of it share a key; Kairos still gets the original.
+        """
+        return normalize_query(self.query)
+
+    def get_mts_query_basis(self):
+        """ The canonical query component of every MTS key under this KQuery. Built once, shared by all. """
+        if self.mts_query_basis is None:
+            self.mts_query_basis = canonical_json(query_basis_for(self.query))
+        return self.mts_query_basis
 
     def proxy_to_kairos(self, host, port, time_range):
         """ Send this KQuery to Kairos with a custom time range and get the response.
@@ -92,14 +120,30 @@ class KQuery(DataCache):
             :param host: str, kairosdb host.
             :param port: int, kairosdb port.
             :param time_ranges: list of 2-tuples of datetime.datetime. new to old.
+            :param timeout: int, seconds to wait for *all* chunks, not for each one.
             :return: dict, int->dict. key is index of entry in time_ranges; value is kairos response.
-            :raise: utils.BackendQueryFailure, if the query fails.
+            :raise: utils.BackendQueryFailure, if the query fails or any chunk times out.
         """
         results = {}
+        durations = {}  # ndx -> seconds, for timing
         threads = []
 
+        # Room for every chunk at once, or we don't start: chunks shed one by one would fail the KQuery anyway.
+        taken = 0
+        if circuit.in_flight:
+            taken = circuit.in_flight.acquire(len(time_ranges))
+            if not taken:
+                logging.error('Shedding load: too many in-flight KairosDB requests')
+                raise KairosUnavailable('Too many in-flight KairosDB requests')
+
         def _thread_wrap(ndx, query):
-            results[ndx] = query_kairos(host, port, query, propagate=False)
+            started = time.time()
+            try:
+                results[ndx] = query_kairos(host, port, query, propagate=False, reserved=ndx < taken)
+            finally:
+                if ndx < taken:  # each chunk gives its slot back as it finishes, even after our deadline.
+                    circuit.in_flight.release()
+            durations[ndx] = time.time() - started
 
         ndx = 0
         for time_range in time_ranges:
@@ -111,17 +155,27 @@ class KQuery(DataCache):
 
             # Create the thread, keep a reference to it, and start it off.
             thr = threading.Thread(target=_thread_wrap, args=(ndx, query))
+            thr.daemon = True  # a hung chunk must not keep the worker alive
             threads.append(thr)
             thr.start()
             ndx += 1
 
-        for thr in threads:  # Wait for all threads to finish.
-            thr.join(timeout)
+        deadline = time.time() + timeout
+        for thr in threads:  # Wait for all threads to finish, sharing a single deadline.
+            thr.join(max(deadline - time.time(), 0))
+        timing.note('kairos_chunks_ms', [round(durations[n] * 1000, 3) if n in durations else None
+                                         for n in xrange(len(threads))])
+
+        if len(results) != len(threads):
+            raise BackendQueryFailure('KairosDB timed out: %d of %d chunks returned within %ss' %
+                                      (len(results), len(threads), timeout))
 
         for val in results.values():  # Quick and dirty exception propagation.
+            if val.get('unavailable'):
+                raise KairosUnavailable(val['error'])
             if 'error' in val:
                 raise BackendQueryFailure('KairosDB responded %d: %s' % (val.get('status_code', 0),
-                                          val.get('message', 'no error given')))
+                                          val.get('error') or 'no error given'))
 
         return results
 
@@ -132,13 +186,22 @@ class KQuery(DataCache):
             :return: void
         """
         # This could be a separate Redis layer but I don't see how that's a win.
-        self.query['mts_keys'] = [x.get_key() for x in self.related_mts]
+        related_mts = list(self.related_mts)
+        self.query['mts_keys'] = [x.get_key() for x in related_mts]
+        # Alongside, for tag-grouped KQueries: lets a superset pick out MTS without loading them all.
+        mts_groups = [group_values(x.result or {}) for x in related_mts]
+        if any(mts_groups):
+            self.query['mts_groups'] = mts_groups
+        else:
+            self.query.pop('mts_groups', None)
         # Use as a sentinel to check for WARM vs HOT
         if end_time:
             self.query['last_add_data'] = int(end_time.strftime('%s'))
         else:
             self.query['last_add_data'] = int(datetime.datetime.now().strftime('%s'))
         self.query['earliest_data'] = int(start_time.strftime('%s'))
+        if self.refs_until:
+            self.query['refs_until'] = self.refs_until
         self.set_cached(self.query)
 
     def add_mts(self, mts):
@@ -147,3 +210,7 @@ class KQuery(DataCache):
             :return: void
         """
         self.related_mts.add(mts)
+
+    def total_bytes(self):
+        """ Sum of the serialized sizes of all associated MTS. """
+        return sum([mts.size for mts in self.related_mts])
@@ -0,0 +1,108 @@
+import logging
+import uuid
+
+import simplejson as json
+
+
+"""
+    Searchable indexes over the metricnames, tagnames and tagvalues metadata endpoints.
+    Each is a Redis sorted set, tscached:meta_index:NAME, holding every name with score 0, so Redis keeps
+    them in lexical order: prefix searches are a ZRANGEBYLEX, substring searches a ZSCAN. Indexes are
+    rebuilt whenever their endpoint's response is cached (see handler_meta.store_metadata).
+"""
+
+
+INDEXED = ['metricnames', 'tagnames', 'tagvalues']
+INDEX_PREFIX = 'tscached:meta_index:'
+
+PREFIX = 'prefix'
+SUBSTRING = 'substring'
+
+
+def index_key(name):
+    return INDEX_PREFIX + name
+
+
+def building_key(name):
+    """ A fresh key to build an index under. Unique per build, so concurrent rebuilds never share one. """
+    return '%s:building:%s' % (index_key(name), uuid.uuid4().hex)
+
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def build_index(redis_client, name, text, expiry):
+    """ Replace an index with the names in a Kairos metadata response. Readers never see it half-built.
+        :param redis_client: redis.StrictRedis
+        :param name: str, one of INDEXED.
+        :param text: str, the Kairos response: {"results": [...]}.
+        :param expiry: int, seconds for the index to live; usually as long as the cached response.
+        :return: int, number of names indexed.
+        :raise: redis.exceptions.RedisError
+    """
+    values = json.loads(text).get('results', [])
+    building = building_key(name)
+    pipeline = redis_client.pipeline()
+    for ndx in xrange(0, len(values), 1000):
+        args = []
+        for value in values[ndx:ndx + 1000]:
+            args.extend([0, encode(value)])
+        pipeline.zadd(building, *args)
+    if values:
+        pipeline.rename(building, index_key(name))
+        pipeline.expire(index_key(name), expiry)
+    else:
+        pipeline.delete(index_key(name))
+    pipeline.execute()
+    logging.info('Meta index %s: %d names' % (name, len(values)))
+    return len(values)
+
+
+def glob_escape(query):
+    """ Make a user's query safe to embed in a Redis MATCH pattern. """
+    return ''.join(['\\' + c if c in '*?[]\\' else c for c in query])
+
+
+def search_index(redis_client, name, query, mode=PREFIX, limit=100, offset=0):
+    """ Search an index.
+        :param redis_client: redis.StrictRedis
+        :param name: str, one of INDEXED.
+        :param query: str, what to look for. Case sensitive.
+        :param mode: str, PREFIX or SUBSTRING.
+        :param limit: int, at most this many results; at least 1.
+        :param offset: int, skip this many results, for pagination.
+        :return: 2-tuple (list of str in lexical order, int total matches); or None if there is no index.
+        :raise: redis.exceptions.RedisError, ValueError if limit is under 1.
+    """
+    if limit < 1:
+        raise ValueError('limit must be at least 1')
+    key = index_key(name)
+    if not redis_client.exists(key):
+        return None
+    query = encode(query)
+
+    if mode == PREFIX:
+        low, high = '[' + query, '[' + query + '\xff'
+        if not query:
+            low, high = '-', '+'
+        total = redis_client.zlexcount(key, low, high)
+        return redis_client.zrangebylex(key, low, high, start=offset, num=limit), total
+
+    # ZSCAN may return a member more than once (if the set is rehashed mid-scan).
+    matches = sorted(set([member for member, _ in
+                          redis_client.zscan_iter(key, match='*%s*' % glob_escape(query), count=1000)]))
+    return matches[offset:offset + limit], len(matches)
+
+
+def search_list(values, query, mode=PREFIX, limit=100, offset=0):
+    """ As search_index, over a plain list; for when Redis can't help.
+        :return: 2-tuple (list of str in lexical order, int total matches).
+    """
+    if mode == PREFIX:
+        matches = sorted([v for v in values if v.startswith(query)])
+    else:
+        matches = sorted([v for v in values if query in v])
+    return matches[offset:offset + limit], len(matches)
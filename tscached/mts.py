@@ -2,16 +2,114 @@ import copy
 import datetime
 import logging
 
+import simplejson as json
+
 from datacache import DataCache
+import instrumentation
+from keys import canonical_json
+from normalize import normalize_query
+from utils import create_key
 from utils import get_needed_absolute_time_range
 
 
+# Fields of the KQuery that change what an MTS holds, besides its name and group: two KQueries differing in
+# any of them must not share MTS. The time range never is one; it is kept out of queries altogether.
+MTS_QUERY_FIELDS = ['aggregators', 'exclude_tags', 'limit', 'order', 'tags']
+
+
+def query_basis_for(query_mask):
+    """ The KQuery's part of an MTS key's basis, normalized; see normalize.normalize_query. """
+    return normalize_query(dict((field, query_mask[field]) for field in MTS_QUERY_FIELDS if field in query_mask))
+
+
+def key_basis_for(result, query_mask):
+    """ What goes into an MTS key's hash. Shared by MTS and MTSHandle so both derive the same key.
+        Kairos results carry their name and group, but not the aggregators etc. that shaped their values;
+        those come from the query.
+    """
+    mts_key_dict = {'name': result['name'], 'query': query_basis_for(query_mask)}
+    if result.get('group_by'):
+        mts_key_dict['group_by'] = result['group_by']
+    return mts_key_dict
+
+
+def hashable_for(result, query_basis):
+    """ canonical_json(key_basis_for(...)), reusing an already-rendered query component.
+        'query' sorts after every other key in the basis, so it can simply be spliced onto the end.
+        :param result: dict, one MTS result from Kairos.
+        :param query_basis: str, canonical_json of query_basis_for(the masking query); see KQuery.get_mts_query_basis.
+        :return: str
+    """
+    basis = key_basis_for(result, {})
+    del basis['query']
+    return '%s,"query":%s}' % (canonical_json(basis)[:-1], query_basis)
+
+
+def group_values(result):
+    """ The tag values that define an MTS' group, e.g. {'host': 'web1'}. """
+    for group in result.get('group_by', []) or []:
+        if group.get('name') == 'tag' and isinstance(group.get('group'), dict):
+            return group['group']
+    return {}
+
+
+def merge_tags(result, other):
+    """ Union other's tags into result's, in place. Kairos reports, per series, every tag value seen in the range
+        asked for, so two chunks of one series may each know only some of them.
+        :param result: dict, one MTS result.
+        :param other: dict, another result for the same series.
+        :return: void
+    """
+    if not other.get('tags'):
+        return
+    tags = result.setdefault('tags', {})
+    for name, values in other['tags'].iteritems():
+        if name not in tags:
+            tags[name] = list(values)
+        else:
+            tags[name] = sorted(set(tags[name]) | set(values))
+
+
+class MTSHandle(object):
+    """ One series as it came off a Kairos response, before we decide what to do with it.
+        Wildcard queries return thousands of series per chunk, most of which are merged into another chunk's
+        copy straight away; a handle holds only the raw result slice and its key, and becomes a full MTS
+        (redis client, expiry settings, etc.) via materialize() once per unique series.
+    """
+    __slots__ = ('result', 'query_mask', 'query_basis', 'redis_key')
+
+    def __init__(self, result, query_mask, query_basis):
+        self.result = result
+        self.query_mask = query_mask
+        self.query_basis = query_basis
+        self.redis_key = None
+
+    def get_key(self):
+        if not self.redis_key:
+            self.redis_key = create_key(hashable_for(self.result, self.query_basis), 'mts')
+        return self.redis_key
+
+    def extend(self, other):
+        """ Append another handle's values (and tags), in place. Only safe when the two do not overlap in time. """
+        self.result['values'] += other.result['values']
+        merge_tags(self.result, other.result)
+
+    def materialize(self, redis_client):
+        """ :return: MTS, sharing (not copying) our result. """
+        new = MTS(redis_client)
+        new.result = self.result
+        new.query_mask = self.query_mask
+        new.redis_key = self.redis_key
+        return new
+
+
 class MTS(DataCache):
 
     def __init__(self, redis_client):
         super(MTS, self).__init__(redis_client, 'mts')
         self.result = None
         self.query_mask = {}
+        self.size = 0  # bytes, as last read from or written to Redis
 
         # TODO make these configurable
         self.gc_expiry = 12600  # three and a half hours
@@ -28,34 +126,39 @@ class MTS(DataCache):
             new.query_mask = kquery.query
             yield new
 
+    @classmethod
+    def handles_from_result(cls, results, kquery):
+        """ Like from_result, but yields lightweight MTSHandles; see MTSHandle. """
+        for result in results['results']:
+            yield MTSHandle(result, kquery.query, kquery.get_mts_query_basis())
+
     @classmethod
     def from_cache(cls, redis_keys, redis_client):
         pipeline = redis_client.pipeline()
         for key in redis_keys:
             pipeline.get(key)
-        results = pipeline.execute()
+        results = instrumentation.execute(pipeline, 'mts_from_cache')
 
         for ctr in xrange(len(redis_keys)):
             new = cls(redis_client)
             new.redis_key = redis_keys[ctr]  # this must not be recalculated, due to masking
             new.result = new.process_cached_data(results[ctr])
+            new.size = len(results[ctr] or '')
             if new.result and isinstance(new.result.get('values'), list):
                 yield new
 
     def key_basis(self):
-        mts_key_dict = {}
-        mts_key_dict['tags'] = self.query_mask.get('tags', {})
-
-        if self.result.get('group_by'):
-            mts_key_dict['group_by'] = self.result['group_by']
-        if self.result.get('aggregators'):
-            mts_key_dict['aggregators'] = self.result['aggregators']
-        mts_key_dict['name'] = self.result['name']
-        return mts_key_dict
+        return key_basis_for(self.result, self.query_mask)
 
     def upsert(self):
         self.set_cached(self.result)
 
+    def serialize(self):
+        """ JSON-dump our result for writing to Redis, remembering its size for eviction accounting. """
+        serialized = json.dumps(self.result)
+        self.size = len(serialized)
+        return serialized
+
     def ttl_expire(self):
         """ Trim off data older than the TTL on the backing KairosDB.
             The second threshold (gc_expiry) prevents frequent (and expensive!) list slicing.
@@ -75,7 +178,15 @@ class MTS(DataCache):
         return False
 
     def merge_at_end(self, new_mts, cutoff=10):
-        """ Append one MTS to the end of another. Remove up to cutoff values from end of cached MTS. """
+        """ Append one MTS to the end of another. Remove up to cutoff values from end of cached MTS.
+            If the values are merged, so are the tags.
+        """
+        before = self.result and self.result['values']
+        self._merge_values_at_end(new_mts, cutoff)
+        if self.result and self.result['values'] is not before:
+            merge_tags(self.result, new_mts.result)
+
+    def _merge_values_at_end(self, new_mts, cutoff):
         reverse_offset = -1
 
         # two edge cases that suggest corrupt data.
@@ -117,8 +228,14 @@ class MTS(DataCache):
     def merge_at_beginning(self, new_mts, cutoff=10):
         """ Append new_mts to the beginning of this one.
             Remove up to cutoff values from beginning of cached MTS if they conflict.
-            May raise IndexError if merge fails.
+            May raise IndexError if merge fails. If the values are merged, so are the tags.
         """
+        before = self.result and self.result['values']
+        self._merge_values_at_beginning(new_mts, cutoff)
+        if self.result and self.result['values'] is not before:
+            merge_tags(self.result, new_mts.result)
+
+    def _merge_values_at_beginning(self, new_mts, cutoff):
         # an edge case that suggests corrupt/missing data
         if not new_mts.result or len(new_mts.result['values']) == 0:
             logging.error('merge_at_beginning: new MTS is None, or contained no data! ' +
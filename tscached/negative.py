@@ -0,0 +1,64 @@
+import logging
+
+import simplejson as json
+
+
+"""
+    Negative caching: remember, briefly, that a KQuery came back empty or made KairosDB fail.
+    Entries are keyed like the KQuery itself (tscached:negative:HASH for tscached:kquery:HASH), so a broken
+    panel costs one Redis GET per refresh instead of a full chunked fan-out against Kairos.
+    A KQuery's key leaves out the time range, so each entry records the range it was written for, and only
+    counts for requests with that same range: an empty last hour says nothing about last week.
+"""
+
+
+REASON_EMPTY = 'empty'
+REASON_ERROR = 'error'
+
+
+def negative_key(kquery_key):
+    """ tscached:kquery:HASH -> tscached:negative:HASH """
+    return kquery_key.replace('tscached:kquery:', 'tscached:negative:', 1)
+
+
+def get_negative(redis_client, kquery_key, time_range):
+    """ Is there a negative entry for this KQuery, over this time range?
+        :param redis_client: redis.StrictRedis
+        :param kquery_key: str, usually tscached:kquery:HASH
+        :param time_range: dict, time range from the HTTP request payload.
+        :return: dict with keys reason and time_range (and message, for errors), or None.
+        :raise: redis.exceptions.RedisError
+    """
+    value = redis_client.get(negative_key(kquery_key))
+    if not value:
+        return None
+    value = json.loads(value)
+    if value.get('time_range') != time_range:
+        logging.debug('Negative entry is for another time range: %s' % kquery_key)
+        return None
+    logging.debug('Negative HIT: %s' % kquery_key)
+    return value
+
+
+def set_negative(config, redis_client, kquery_key, time_range, reason, message=None):
+    """ Write a short-lived negative entry. A configured expiry of 0 disables that kind of entry.
+        :param config: dict, 'tscached' level from config file.
+        :param redis_client: redis.StrictRedis
+        :param kquery_key: str, usually tscached:kquery:HASH
+        :param time_range: dict, time range from the HTTP request payload.
+        :param reason: str, REASON_EMPTY or REASON_ERROR.
+        :param message: str, the backend error message (errors only).
+        :return: bool, whether an entry was written.
+        :raise: redis.exceptions.RedisError
+    """
+    defaults = {REASON_EMPTY: 60, REASON_ERROR: 15}
+    expiry = config.get('negative_cache', {}).get('%s_expiry' % reason, defaults[reason])
+    if not expiry:
+        return False
+
+    value = {'reason': reason, 'time_range': time_range}
+    if message:
+        value['message'] = message
+    redis_client.set(negative_key(kquery_key), json.dumps(value), ex=expiry)
+    logging.info('Negative SET (%s, %ds): %s' % (reason, expiry, kquery_key))
+    return True
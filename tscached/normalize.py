@@ -0,0 +1,127 @@
+import copy
+
+
+"""
+    Canonical forms of Kairos metric queries, used only for deriving cache keys. Queries that mean the same
+    thing to Kairos but are spelled differently (tag values in another order, "1" for 1, 60 minutes for an
+    hour, fields set to their defaults) normalize to the same thing and so share one cache entry.
+    The query actually sent to Kairos is never rewritten.
+"""
+
+
+# Exact conversions only: months and years vary in length, so sampling in those units is left alone.
+UNIT_MILLISECONDS = [
+                     ('weeks', 604800000),
+                     ('days', 86400000),
+                     ('hours', 3600000),
+                     ('minutes', 60000),
+                     ('seconds', 1000),
+                     ('milliseconds', 1),
+                    ]
+
+# Metric and aggregator fields whose value here is what Kairos assumes when they are absent.
+METRIC_DEFAULTS = {'tags': {}, 'group_by': [], 'aggregators': [], 'exclude_tags': False, 'order': 'asc'}
+AGGREGATOR_DEFAULTS = {'align_start_time': False, 'align_end_time': False, 'align_sampling': False}
+
+# Aggregator parameters that are numbers, however the client chose to write them.
+NUMERIC_AGGREGATOR_FIELDS = ['divisor', 'factor', 'percentile', 'threshold']
+
+
+def normalize_number(value):
+    """ "1", 1.0 and 1 all become 1; "0.5" becomes 0.5. Anything else is returned untouched. """
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, basestring):
+        try:
+            value = float(value)
+        except ValueError:
+            return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def normalize_sampling(sampling):
+    """ Express a sampling window in the largest unit that represents it exactly. e.g. 60 minutes -> 1 hours
+        :param sampling: dict, with keys value and unit.
+        :return: dict, a new sampling dict.
+    """
+    new = dict(sampling)
+    new['value'] = normalize_number(sampling.get('value'))
+    unit = (sampling.get('unit') or '').lower()
+    new['unit'] = unit
+
+    per_unit = dict(UNIT_MILLISECONDS).get(unit)
+    if per_unit is None or not isinstance(new['value'], (int, long, float)):
+        return new
+
+    total = new['value'] * per_unit
+    for name, length in UNIT_MILLISECONDS:
+        if total % length == 0:
+            new['value'] = normalize_number(total / length)
+            new['unit'] = name
+            break
+    return new
+
+
+def normalize_tags(tags):
+    """ Tag values are a set to Kairos, and always strings. Sort and de-duplicate them.
+        :param tags: dict of str -> list (or a single value).
+        :return: dict, new tags dict.
+    """
+    normalized = {}
+    for name, values in (tags or {}).iteritems():
+        if not isinstance(values, list):
+            values = [values]
+        normalized[name] = sorted(set([v if isinstance(v, basestring) else unicode(v) for v in values]))
+    return normalized
+
+
+def normalize_aggregator(aggregator):
+    """ :param aggregator: dict, one Kairos aggregator.
+        :return: dict, a new aggregator dict.
+    """
+    new = {}
+    for field, value in aggregator.iteritems():
+        if field in AGGREGATOR_DEFAULTS and value == AGGREGATOR_DEFAULTS[field]:
+            continue
+        if field == 'sampling' and isinstance(value, dict):
+            value = normalize_sampling(value)
+        elif field in NUMERIC_AGGREGATOR_FIELDS:
+            value = normalize_number(value)
+        new[field] = value
+    return new
+
+
+def normalize_group_by(group_by):
+    """ The order of tags within a tag grouper has no effect on the groups Kairos returns. """
+    new = copy.deepcopy(group_by)
+    if new.get('name') == 'tag' and isinstance(new.get('tags'), list):
+        new['tags'] = sorted(new['tags'])
+    return new
+
+
+def normalize_query(query):
+    """ Canonicalize one Kairos metric query, for keying only.
+        :param query: dict, one member of a Kairos request's 'metrics' list.
+        :return: dict, a new normalized query. The input is not modified.
+    """
+    if not isinstance(query, dict):
+        return query
+
+    normalized = {}
+    for field, value in query.iteritems():
+        if field in METRIC_DEFAULTS and value == METRIC_DEFAULTS[field]:
+            continue
+        if field == 'tags':
+            value = normalize_tags(value)
+        elif field == 'aggregators':
+            value = [normalize_aggregator(agg) for agg in value]  # order matters: aggregators are chained.
+        elif field == 'group_by':
+            value = [normalize_group_by(group) for group in value]
+        elif field == 'limit':
+            value = normalize_number(value)
+        else:
+            value = copy.deepcopy(value)
+        normalized[field] = value
+    return normalized
@@ -0,0 +1,219 @@
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import redis
+import simplejson as json
+
+from tscached import instrumentation
+
+
+"""
+    A sampling profiler for a live worker: which tscached functions is it busy in?
+    Started on one worker (whichever serves /api/maintenance/profiler/start) for a bounded time, a background
+    thread wakes every `interval` seconds and records, via sys._current_frames, the stack of every other thread.
+    Nothing is traced, so handling requests costs no more than it did; the sampler itself costs a few
+    microseconds per thread per sample. Stacks are kept collapsed (root first, frames joined by ';'), counted,
+    and written to Redis when the run ends, per host and pid, in the format flamegraph.pl takes as-is.
+    uwsgi must run with threads enabled (enable-threads), or the sampler never gets to run.
+"""
+
+
+PROFILE_KEY = 'tscached:profile:%s'  # worker -> hash, collapsed stack -> samples
+PROFILES_KEY = 'tscached:profiles'  # hash, worker -> JSON summary of its latest run
+TRUNCATED = '(truncated)'  # where samples go once max_stacks distinct stacks have been seen
+
+lock = threading.Lock()
+running = {}  # 'profiler' -> the Profiler of this process, while it runs
+
+
+def worker_name():
+    """ :return: str, 'host:pid', which identifies this worker's profiles. """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def settings(config):
+    profiler_config = config.get('profiler', {})
+    return {
+        'enabled': profiler_config.get('enabled', False),
+        'interval': profiler_config.get('interval', 0.01),
+        'max_duration': profiler_config.get('max_duration', 60),
+        'max_stacks': profiler_config.get('max_stacks', 5000),
+        'max_depth': profiler_config.get('max_depth', 100),
+        'expiry': profiler_config.get('expiry', 86400),
+    }
+
+
+def frame_name(frame):
+    """ 'handle_query (handler_general.py)'; line numbers would split one function into many boxes. """
+    code = frame.f_code
+    return '%s (%s)' % (code.co_name, os.path.basename(code.co_filename))
+
+
+def collapse(frame, max_depth=100):
+    """ :param frame: the innermost frame of a stack.
+        :return: str, its frames outermost first, joined by ';'. The outermost are dropped past max_depth.
+    """
+    names = []
+    while frame is not None and len(names) < max_depth:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Profiler(object):
+    """ One sampling run, on a thread of its own. """
+
+    def __init__(self, interval=0.01, duration=60, max_stacks=5000, max_depth=100):
+        """ :param interval: float, seconds between samples.
+            :param duration: float, seconds to run for at most.
+            :param max_stacks: int, distinct stacks kept; more are counted under TRUNCATED.
+            :param max_depth: int, frames kept per stack.
+        """
+        self.interval = interval
+        self.duration = duration
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        self.stacks = {}  # collapsed stack -> samples
+        self.samples = 0
+        self.started = None
+        self.stopped = None
+        self.done = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        """ Record the stack of every thread but the sampler's own. """
+        own = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = collapse(frame, self.max_depth)
+            if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+                stack = TRUNCATED
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def run(self, on_finish=None):
+        deadline = self.started + self.duration
+        while not self.done.is_set() and time.time() < deadline:
+            self.sample()
+            self.done.wait(self.interval)
+        self.stopped = time.time()
+        self.done.set()
+        if on_finish:
+            on_finish(self)
+
+    def start(self, on_finish=None):
+        """ :param on_finish: function, called with this Profiler, on its thread, once the run ends. """
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.run, args=(on_finish,), name='tscached-profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, wait=True):
+        self.done.set()
+        if wait and self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def summary(self):
+        return {
+            'worker': worker_name(),
+            'started': self.started,
+            'stopped': self.stopped,
+            'running': not self.done.is_set(),
+            'interval': self.interval,
+            'duration': self.duration,
+            'samples': self.samples,
+            'stacks': len(self.stacks),
+        }
+
+
+def save(redis_client, profiler, expiry):
+    """ Replace this worker's stored profile with the given run.
+        :return: boolean, success.
+    """
+    worker = worker_name()
+    try:
+        pipeline = redis_client.pipeline()
+        pipeline.delete(PROFILE_KEY % worker)
+        if profiler.stacks:
+            pipeline.hmset(PROFILE_KEY % worker, profiler.stacks)
+            pipeline.expire(PROFILE_KEY % worker, expiry)
+        pipeline.hset(PROFILES_KEY, worker, json.dumps(profiler.summary()))
+        pipeline.expire(PROFILES_KEY, expiry)
+        instrumentation.execute(pipeline, 'profiler')
+    except redis.exceptions.RedisError as e:
+        logging.error('RedisError: ' + e.message)
+        return False
+    return True
+
+
+def start(config, duration=None):
+    """ Start profiling this worker, unless it already is (or profiling is disabled).
+        :param config: dict, 'tscached' level from config file.
+        :param duration: float, seconds; capped at profiler.max_duration.
+        :return: 2-tuple (Profiler or None, str message).
+    """
+    params = settings(config)
+    if not params['enabled']:
+        return None, 'Profiling is disabled; set profiler.enabled in the config.'
+    duration = min(duration or params['max_duration'], params['max_duration'])
+
+    def _finish(profiler):
+        with lock:
+            if running.get('profiler') is profiler:
+                del running['profiler']
+        redis_client = redis.StrictRedis(host=config['redis']['host'], port=config['redis']['port'])
+        save(redis_client, profiler, params['expiry'])
+        logging.info('Profiler finished on %s: %d samples' % (worker_name(), profiler.samples))
+
+    with lock:
+        if running.get('profiler'):
+            return running['profiler'], 'Already profiling %s.' % worker_name()
+        profiler = Profiler(params['interval'], duration, params['max_stacks'], params['max_depth'])
+        running['profiler'] = profiler
+    profiler.start(on_finish=_finish)
+    return profiler, 'Profiling %s for %s seconds.' % (worker_name(), duration)
+
+
+def stop():
+    """ Stop profiling this worker, and wait for its results to be saved.
+        :return: Profiler or None, the run stopped.
+    """
+    with lock:
+        profiler = running.get('profiler')
+    if profiler:
+        profiler.stop()
+    return profiler
+
+
+def status(redis_client):
+    """ :return: dict, worker -> summary of its latest run, for every worker that has stored one. """
+    try:
+        stored = redis_client.hgetall(PROFILES_KEY)
+    except redis.exceptions.RedisError as e:
+        logging.error('RedisError: ' + e.message)
+        stored = {}
+    workers = dict((worker, json.loads(summary)) for worker, summary in stored.iteritems())
+    with lock:
+        profiler = running.get('profiler')
+    if profiler:
+        workers[worker_name()] = profiler.summary()
+    return workers
+
+
+def collapsed(redis_client, workers):
+    """ Stored profiles, summed over the given workers, as flamegraph.pl input.
+        :param workers: list of str, 'host:pid'.
+        :return: str, one 'stack count' line per stack; busiest first.
+        :raise: redis.exceptions.RedisError
+    """
+    totals = {}
+    for worker in workers:
+        for stack, count in redis_client.hgetall(PROFILE_KEY % worker).iteritems():
+            totals[stack] = totals.get(stack, 0) + int(count)
+    lines = ['%s %d' % (stack, count) for stack, count in sorted(totals.items(), key=lambda sc: (-sc[1], sc[0]))]
+    return '\n'.join(lines) + '\n' if lines else ''
@@ -6,7 +6,10 @@ import argparse
 import redis
 import yaml
 
+from tscached import circuit
+from tscached import keys
 from tscached.shadow import perform_readahead
+from tscached.utils import configure_requests
 
 
 def start():
@@ -19,6 +22,9 @@ def start():
     with open(args.config, 'r') as config_file:
         config = yaml.load(config_file.read())['tscached']
 
+    circuit.configure(config)
+    keys.configure(config)
+    configure_requests(config)
     redis_client = redis.StrictRedis(host=config['redis']['host'], port=config['redis']['port'])
     perform_readahead(config, redis_client)
 
@@ -0,0 +1,133 @@
+import logging
+import time
+
+
+"""
+    MTS keys depend on the series' name and group, and on the query fields that shape its values (aggregators,
+    limit, order, exclude_tags and the tag filter; see mts.MTS_QUERY_FIELDS). Only KQueries that agree on all
+    of those hold the same data for a series, and so can share its MTS.
+    For each MTS we keep a Redis hash, tscached:mts_refs:HASH, mapping every referring KQuery key to the
+    unix timestamp at which that KQuery expires. The MTS lives exactly as long as its longest-lived referrer.
+"""
+
+
+MTS_PREFIX = 'tscached:mts:'
+REFS_PREFIX = 'tscached:mts_refs:'
+
+
+def refs_key(mts_key):
+    """ tscached:mts:HASH -> tscached:mts_refs:HASH """
+    return REFS_PREFIX + mts_key[len(MTS_PREFIX):]
+
+
+def mts_key_for(ref_key):
+    """ tscached:mts_refs:HASH -> tscached:mts:HASH """
+    return MTS_PREFIX + ref_key[len(REFS_PREFIX):]
+
+
+def register_references(redis_client, kquery_key, mts_keys, expiry, now=None):
+    """ Record that a KQuery refers to some MTS, then extend each MTS to its longest-lived referrer.
+        :param redis_client: redis.StrictRedis
+        :param kquery_key: str, usually tscached:kquery:HASH
+        :param mts_keys: list of str, the MTS keys this KQuery uses.
+        :param expiry: int, seconds until the KQuery itself expires.
+        :param now: int, unix timestamp; optional, for testing.
+        :return: void
+        :raise: redis.exceptions.RedisError
+    """
+    if not mts_keys:
+        return
+    if not now:
+        now = int(time.time())
+
+    pipeline = redis_client.pipeline()
+    for mts_key in mts_keys:
+        pipeline.hset(refs_key(mts_key), kquery_key, now + expiry)
+        pipeline.hvals(refs_key(mts_key))
+    results = pipeline.execute()
+
+    pipeline = redis_client.pipeline()
+    for ndx in xrange(len(mts_keys)):
+        deadlines = [int(x) for x in results[ndx * 2 + 1]]
+        ttl = max(max(deadlines) - now, expiry)
+        pipeline.expire(mts_keys[ndx], ttl)
+        pipeline.expire(refs_key(mts_keys[ndx]), ttl)
+    pipeline.execute()
+
+
+def release_references(redis_client, kquery_key, mts_keys):
+    """ Forget a KQuery's references. MTS left without any referrer are deleted.
+        :param redis_client: redis.StrictRedis
+        :param kquery_key: str, usually tscached:kquery:HASH
+        :param mts_keys: list of str, the MTS keys this KQuery used.
+        :return: list of str, the MTS keys that were orphaned and deleted.
+        :raise: redis.exceptions.RedisError
+    """
+    if not mts_keys:
+        return []
+
+    pipeline = redis_client.pipeline()
+    for mts_key in mts_keys:
+        pipeline.hdel(refs_key(mts_key), kquery_key)
+        pipeline.hlen(refs_key(mts_key))
+    results = pipeline.execute()
+
+    orphans = [mts_keys[ndx] for ndx in xrange(len(mts_keys)) if results[ndx * 2 + 1] == 0]
+    if orphans:
+        redis_client.delete(*(orphans + [refs_key(x) for x in orphans]))
+    return orphans
+
+
+def collect_orphans(redis_client, now=None):
+    """ Sweep every reference hash, dropping referrers that expired or were deleted.
+        MTS with no remaining referrer are deleted.
+        :param redis_client: redis.StrictRedis
+        :param now: int, unix timestamp; optional, for testing.
+        :return: int, number of MTS deleted.
+        :raise: redis.exceptions.RedisError
+    """
+    if not now:
+        now = int(time.time())
+
+    collected = 0
+    for ref_key in redis_client.scan_iter(match=REFS_PREFIX + '*'):
+        referrers = redis_client.hgetall(ref_key)
+        kquery_keys = list(referrers.keys())
+
+        pipeline = redis_client.pipeline()
+        for kquery_key in kquery_keys:
+            pipeline.exists(kquery_key)
+        alive = pipeline.execute()
+
+        dead = [kquery_keys[ndx] for ndx in xrange(len(kquery_keys))
+                if not alive[ndx] or int(referrers[kquery_keys[ndx]]) < now]
+        if len(dead) == len(kquery_keys):
+            redis_client.delete(mts_key_for(ref_key), ref_key)
+            collected += 1
+        elif dead:
+            redis_client.hdel(ref_key, *dead)
+
+    logging.info('Collected %d orphaned MTS' % collected)
+    return collected
+
+
+def refreshed_elsewhere(mts_list, end_needed, staleness_threshold):
+    """ Did some other KQuery already bring all of these shared MTS up to date?
+        :param mts_list: list of mts.MTS, as loaded from the cache.
+        :param end_needed: datetime.datetime, the end of the range we would otherwise fetch.
+        :param staleness_threshold: int, seconds of staleness we tolerate.
+        :return: int unix timestamp (seconds) of the oldest MTS end if so; False otherwise.
+    """
+    if not mts_list:
+        return False
+
+    ends = []
+    for mts in mts_list:
+        if not mts.result or len(mts.result['values']) == 0:
+            return False
+        ends.append(mts.result['values'][-1][0] / 1000)
+
+    oldest_end = min(ends)
+    if oldest_end >= int(end_needed.strftime('%s')) - staleness_threshold:
+        return oldest_end
+    return False
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+import argparse
+import os
+import Queue
+import threading
+import time
+
+import requests
+import simplejson as json
+import yaml
+
+from tscached.capture import hit_ratio
+from tscached.capture import load_trace
+from tscached.simulator import simulate
+
+
+"""
+    Replay a capture file (see tscached.capture), to try cache settings against real traffic.
+    Two ways:
+    - live: send the captured requests to a tscached instance, keeping their relative timing (scaled by
+      --speed). Pair it with testing.kairos_simulator (--kairos) to see the load that reaches the backend.
+    - simulate: no servers at all; see tscached.simulator, which can also sweep settings.
+    Both report the hit ratio, next to the one captured.
+        python -m tscached.replay capture.jsonl --target http://localhost:8008 --speed 10
+        python -m tscached.replay capture.jsonl --simulate -c tscached.yaml
+"""
+
+
+def request_for(entry):
+    """ The HTTP request body a capture entry came from, near enough. """
+    payload = dict(entry['time_range'])
+    payload['metrics'] = [kq['query'] for kq in entry['kqueries']]
+    return payload
+
+
+def captured_modes(trace):
+    modes = {}
+    for entry in trace:
+        for kq in entry['kqueries']:
+            modes[kq['mode']] = modes.get(kq['mode'], 0) + 1
+    return modes
+
+
+def response_modes(response, kquery_count):
+    """ Cache modes of a replayed request, one per KQuery, as a capture counts them.
+        :param response: requests.Response; None if tscached could not be reached.
+        :param kquery_count: int, KQueries in the request.
+        :return: list of str
+    """
+    if response is None:
+        return ['none'] * kquery_count
+    modes = response.headers.get('X-tscached-modes')
+    if modes:
+        return modes.split(',')
+    # Errors (and older versions) only give one mode, if any, for the whole request.
+    return [response.headers.get('X-tscached-mode', 'none')] * kquery_count
+
+
+def replay_live(trace, target, speed=1.0, concurrency=8):
+    """ Send a trace's requests to tscached, as they were spaced out in time (divided by speed).
+        :param trace: list of dict, capture entries in time order.
+        :param target: str, base URL of tscached.
+        :param speed: float, how much faster than real time to go.
+        :param concurrency: int, requests in flight at most; falls behind schedule if too few.
+        :return: dict, with keys modes (cache mode -> KQueries, like captured_modes), statuses (HTTP status ->
+                 requests), hit_ratio and lag_s.
+    """
+    work = Queue.Queue(maxsize=concurrency * 2)
+    lock = threading.Lock()
+    modes = {}
+    statuses = {}
+
+    def _worker():
+        session = requests.Session()
+        while True:
+            payload = work.get()
+            if payload is None:
+                return
+            try:
+                r = session.post(target.rstrip('/') + '/api/v1/datapoints/query', data=json.dumps(payload))
+                status = r.status_code
+            except requests.exceptions.RequestException:
+                r, status = None, 'unreachable'
+            with lock:
+                for mode in response_modes(r, len(payload['metrics'])):
+                    modes[mode] = modes.get(mode, 0) + 1
+                statuses[status] = statuses.get(status, 0) + 1
+
+    workers = [threading.Thread(target=_worker) for _ in xrange(concurrency)]
+    for thr in workers:
+        thr.daemon = True
+        thr.start()
+
+    lag = 0
+    started = time.time()
+    for entry in trace:
+        due = started + (entry['ts'] - trace[0]['ts']) / speed
+        if due > time.time():
+            time.sleep(due - time.time())
+        lag = max(lag, time.time() - due)
+        work.put(request_for(entry))
+    for _ in workers:
+        work.put(None)
+    for thr in workers:
+        thr.join()
+
+    return {'modes': modes, 'statuses': statuses, 'hit_ratio': hit_ratio(modes), 'lag_s': round(lag, 3),
+            'elapsed_s': round(time.time() - started, 3)}
+
+
+def kairos_stats(url):
+    try:
+        return requests.get(url.rstrip('/') + '/simulator/stats').json()
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+
+def start():
+    parser = argparse.ArgumentParser(description='Replay captured tscached traffic.')
+    parser.add_argument('trace', help='capture file, as written with capture.enabled')
+    parser.add_argument('-c', '--config', type=str, default=os.path.abspath('tscached.yaml'),
+                        help='Path to config file (for --simulate).')
+    parser.add_argument('--simulate', action='store_true', help='model the cache instead of replaying live')
+    parser.add_argument('--target', default='http://localhost:8008', help='base URL of tscached')
+    parser.add_argument('--kairos', help='base URL of testing.kairos_simulator, to report backend load')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay this many times faster than captured')
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    trace = load_trace(args.trace)
+    if not trace:
+        print 'Empty trace.'
+        return
+
+    report = {'entries': len(trace), 'span_s': round(trace[-1]['ts'] - trace[0]['ts'], 3),
+              'captured': {'modes': captured_modes(trace), 'hit_ratio': hit_ratio(captured_modes(trace))}}
+    if args.simulate:
+        with open(args.config, 'r') as config_file:
+            config = yaml.load(config_file.read())['tscached']
+        report['simulated'] = simulate(config, trace)
+    else:
+        before = kairos_stats(args.kairos) if args.kairos else None
+        report['replayed'] = replay_live(trace, args.target, args.speed, args.concurrency)
+        after = kairos_stats(args.kairos) if before else None
+        if after:
+            report['replayed']['kairos'] = dict((name, after[name] - before[name])
+                                                for name in ['requests', 'queries', 'errors', 'datapoints'])
+    print json.dumps(report, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    start()
@@ -1,8 +1,12 @@
 import logging
 import socket
+import time
 
 from tscached import cache_calls
+from tscached import eviction
+from tscached import instrumentation
 from tscached import kquery
+from tscached import references
 from tscached.utils import BackendQueryFailure
 
 import redis
@@ -118,13 +122,18 @@ def perform_readahead(config, redis_client):
     lock = become_leader(config, redis_client)
     if not lock:
         logging.info('Could not become leader; exiting.')
+        instrumentation.incr('tscached_readahead_runs_total', outcome='not_leader')
+        instrumentation.flush(redis_client, force=True)
         return
 
+    outcome = 'error'
+    started = time.time()
     try:
         redis_keys = list(redis_client.smembers(SHADOW_LIST))
         logging.info('Found %d KQuery keys in the shadow list' % len(redis_keys))
 
         for kq in kquery.KQuery.from_cache(redis_keys, redis_client):
+            instrumentation.incr('tscached_readahead_kqueries_total')
             last_ts = kq.cached_data['last_add_data']  # unix timestamp, seconds
             mins_in_past = (last_ts / 60) - 5  # add 5m of margin
 
@@ -134,9 +143,24 @@ def perform_readahead(config, redis_client):
             kq_resp, _ = cache_calls.process_cache_hit(config, redis_client, kq, kairos_time_range)
             size = kq_resp.get('sample_size', -1)
             logging.debug('Processed KQuery %s; sample size now at %d' % (kq.redis_key, size))
+        outcome = 'success'
     except BackendQueryFailure as e:
         logging.error('BackendQueryFailure: %s' % e.message)
     except redis.exceptions.RedisError as e:
         logging.error('RedisError: ' + e.message)
 
+    # We hold the leader lock anyway, so this is the natural place to enforce memory budgets.
+    # A failed refresh (say, KairosDB is down) must not skip it.
+    try:
+        evicted = eviction.perform_eviction(config, redis_client)
+        if evicted:
+            redis_client.srem(SHADOW_LIST, *evicted)
+        references.collect_orphans(redis_client)
+    except redis.exceptions.RedisError as e:
+        logging.error('RedisError: ' + e.message)
+        outcome = 'error'
+
     release_leader(lock, redis_client)
+    instrumentation.observe('tscached_readahead_seconds', time.time() - started)
+    instrumentation.incr('tscached_readahead_runs_total', outcome=outcome)
+    instrumentation.flush(redis_client, force=True)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+import argparse
+import copy
+import datetime
+import heapq
+import itertools
+import os
+import time
+
+import simplejson as json
+import yaml
+
+from tscached.capture import hit_ratio
+from tscached.capture import load_trace
+from tscached.kquery import KQuery
+from tscached.mts import MTS
+from tscached.utils import FETCH_AFTER
+from tscached.utils import FETCH_ALL
+from tscached.utils import FETCH_BEFORE
+from tscached.utils import get_chunked_time_ranges
+from tscached.utils import get_needed_absolute_time_range
+from tscached.utils import get_range_needed
+
+
+"""
+    Cache-policy simulator: how would a config have fared on a captured trace (see tscached.capture)?
+    Each KQuery is modelled by its cached range and expiry, stepped through get_range_needed,
+    get_chunked_time_ranges and the MTS TTL trimming exactly as handle_query would, with no Redis, Kairos or
+    waiting. From the captured response sizes it estimates KairosDB requests, datapoints fetched and the
+    Redis memory held. Not modelled: MTS shared between KQueries, supersets, the negative cache, readahead.
+    Parameters can be swept; every combination gets a row in a comparison table:
+        python -m tscached.simulator capture.jsonl -c tscached.yaml \\
+            --sweep chunking.chunk_length=1800,3600 --sweep data.staleness_threshold=10,60
+    Expiries are not in the config file (they are fixed in KQuery and MTS), but can be swept as
+    model.kquery_expiry, model.mts_expiry and model.mts_gc_expiry.
+"""
+
+
+BYTES_PER_POINT = 24  # one [ms timestamp, value] pair, JSON-encoded
+BYTES_PER_SERIES = 250  # name, tags and group_by of an MTS, its key, and its entry in the KQuery
+
+
+def model_params(config):
+    """ Expiries, from the model section if given, else as KQuery and MTS have them. """
+    mts = MTS(None)
+    model = config.get('model', {})
+    return {
+        'kquery_expiry': model.get('kquery_expiry', KQuery.expiry),
+        'mts_expiry': model.get('mts_expiry', mts.expiry),
+        'mts_gc_expiry': model.get('mts_gc_expiry', mts.gc_expiry),
+    }
+
+
+def seconds(start, end):
+    return max((end - start).total_seconds(), 0)
+
+
+def footprint(state):
+    """ Estimated bytes held in Redis for one KQuery and its MTS. """
+    held = seconds(state['earliest'], state['last'])
+    return int(state['series'] * (BYTES_PER_SERIES + state['density'] * held * BYTES_PER_POINT))
+
+
+def simulate(config, trace):
+    """ Run a trace through a model of the cache.
+        :param config: dict, 'tscached' level from config file; plus an optional 'model' section.
+        :param trace: list of dict, capture entries in time order.
+        :return: dict: modes (cache mode -> KQueries), hit_ratio, kairos_requests, points_fetched,
+                 peak_bytes, final_bytes, and how fast the simulation ran.
+    """
+    started = time.time()
+    params = model_params(config)
+    staleness_threshold = config['data']['staleness_threshold']
+    stale_grace = config['data'].get('stale_grace', 0)
+
+    cached = {}  # kquery key -> {earliest, last, expires (datetime.datetime), series, density, bytes}
+    expiries = []  # heap of (expires, key); stale entries are skipped
+    window_sizes = {}  # kquery key -> window_size, as KQuery.from_request derives it
+    modes = {}
+    kairos_requests = 0
+    points_fetched = 0
+    total_bytes = 0
+    peak_bytes = 0
+
+    for entry in trace:
+        now = datetime.datetime.fromtimestamp(entry['ts'])
+        while expiries and expiries[0][0] <= now:
+            expires, key = heapq.heappop(expiries)
+            if key in cached and cached[key]['expires'] == expires:
+                total_bytes -= cached.pop(key)['bytes']
+
+        start_request, end_request = get_needed_absolute_time_range(entry['time_range'], now)
+        end_request = end_request or now  # get_range_needed would take the wall clock's now.
+        requested = seconds(start_request, end_request)
+        for kq in entry['kqueries']:
+            key = kq['key']
+            if key not in window_sizes:
+                query = copy.deepcopy(kq['query'])
+                window_sizes[key] = next(KQuery.from_request({'metrics': [query]}, None)).window_size
+            state = cached.get(key)
+            series = kq.get('series', 1)
+            density = kq.get('points', 0) / float(series * requested) if series and requested else 0
+
+            if state:
+                range_needed = get_range_needed(start_request, end_request, state['earliest'], state['last'],
+                                                staleness_threshold, window_sizes[key])
+            else:
+                range_needed = (start_request, end_request, FETCH_ALL)
+
+            if not range_needed:
+                mode = 'hot'
+            elif range_needed[2] == FETCH_ALL:
+                chunks = get_chunked_time_ranges(config, entry['time_range'], now)
+                kairos_requests += len(chunks)
+                points_fetched += int(series * density * requested)
+                mode = 'cold_overwrite' if state else 'cold_miss'
+                if state:
+                    total_bytes -= state['bytes']
+                state = {'earliest': chunks[-1][0], 'last': chunks[0][1], 'series': series, 'density': density}
+            else:
+                kairos_requests += 1
+                points_fetched += int(state['series'] * state['density'] * seconds(range_needed[0], range_needed[1]))
+                total_bytes -= state['bytes']
+                if range_needed[2] == FETCH_AFTER:
+                    grace = stale_grace and seconds(state['last'], now) <= stale_grace
+                    mode = 'hot_stale' if grace else 'warm_append'
+                    state['last'] = range_needed[1]
+                    # As MTS.ttl_expire: trim old data once it is past gc_expiry.
+                    if state['earliest'] < now - datetime.timedelta(seconds=params['mts_gc_expiry']):
+                        state['earliest'] = now - datetime.timedelta(seconds=params['mts_expiry'])
+                elif range_needed[2] == FETCH_BEFORE:
+                    mode = 'warm_prepend'
+                    state['earliest'] = range_needed[0]
+
+            if range_needed:
+                state['expires'] = now + datetime.timedelta(seconds=params['kquery_expiry'])
+                state['bytes'] = footprint(state)
+                total_bytes += state['bytes']
+                cached[key] = state
+                heapq.heappush(expiries, (state['expires'], key))
+            modes[mode] = modes.get(mode, 0) + 1
+        peak_bytes = max(peak_bytes, total_bytes)
+
+    wall = time.time() - started
+    span = trace[-1]['ts'] - trace[0]['ts'] if trace else 0
+    return {
+        'modes': modes,
+        'hit_ratio': hit_ratio(modes),
+        'kairos_requests': kairos_requests,
+        'points_fetched': points_fetched,
+        'peak_bytes': peak_bytes,
+        'final_bytes': total_bytes,
+        'simulated_s': round(span, 3),
+        'wall_s': round(wall, 3),
+        'speedup': int(span / wall) if wall else None,
+    }
+
+
+def with_param(config, name, value):
+    """ A copy of config with one dotted setting changed, e.g. 'chunking.chunk_length'. """
+    config = copy.deepcopy(config)
+    section, _, field = name.rpartition('.')
+    node = config
+    for part in section.split('.') if section else []:
+        node = node.setdefault(part, {})
+    node[field] = value
+    return config
+
+
+def parse_sweep(specs):
+    """ ['chunking.chunk_length=1800,3600'] -> [('chunking.chunk_length', [1800, 3600])] """
+    sweep = []
+    for spec in specs:
+        name, _, values = spec.partition('=')
+        sweep.append((name.strip(), [yaml.safe_load(v) for v in values.split(',')]))
+    return sweep
+
+
+def sweep(config, trace, grid):
+    """ Simulate every combination of parameter values.
+        :param config: dict, the baseline config.
+        :param trace: list of dict, capture entries in time order.
+        :param grid: list of 2-tuples (dotted setting name, list of values).
+        :return: list of 2-tuples (dict setting -> value, dict simulate result).
+    """
+    rows = []
+    names = [name for name, _ in grid]
+    for values in itertools.product(*[values for _, values in grid]):
+        variant = config
+        for name, value in zip(names, values):
+            variant = with_param(variant, name, value)
+        rows.append((dict(zip(names, values)), simulate(variant, trace)))
+    return rows
+
+
+def format_table(rows):
+    """ :param rows: as returned by sweep.
+        :return: str, a plain-text comparison table.
+    """
+    names = sorted(rows[0][0].keys()) if rows else []
+    header = names + ['hit_ratio', 'kairos_reqs', 'points', 'peak_MB', 'final_MB']
+    lines = [header]
+    for params, result in rows:
+        lines.append([str(params[name]) for name in names] + [
+            str(result['hit_ratio']), str(result['kairos_requests']), str(result['points_fetched']),
+            '%.1f' % (result['peak_bytes'] / 1048576.0), '%.1f' % (result['final_bytes'] / 1048576.0)])
+    widths = [max([len(line[ndx]) for line in lines]) for ndx in xrange(len(header))]
+    return '\n'.join(['  '.join([cell.rjust(width) for cell, width in zip(line, widths)]) for line in lines])
+
+
+def start():
+    parser = argparse.ArgumentParser(description='Simulate cache policies over a captured trace.')
+    parser.add_argument('trace', help='capture file, as written with capture.enabled')
+    parser.add_argument('-c', '--config', type=str, default=os.path.abspath('tscached.yaml'),
+                        help='Path to config file.')
+    parser.add_argument('--sweep', action='append', default=[],
+                        help='setting=value,value,... e.g. chunking.chunk_length=1800,3600; repeatable')
+    parser.add_argument('--json', action='store_true', help='print JSON instead of a table')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as config_file:
+        config = yaml.load(config_file.read())['tscached']
+    trace = load_trace(args.trace)
+    rows = sweep(config, trace, parse_sweep(args.sweep))
+    if args.json:
+        print json.dumps([{'params': params, 'result': result} for params, result in rows], indent=2, sort_keys=True)
+    else:
+        print format_table(rows)
+
+
+if __name__ == '__main__':
+    start()
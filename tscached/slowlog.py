@@ -0,0 +1,98 @@
+import logging
+import time
+
+import redis
+import simplejson as json
+
+from tscached import instrumentation
+from tscached.capture import query_of
+
+
+"""
+    Slow-query log: every KQuery that took longer than slow_query_log.threshold to handle, with what it takes
+    to see why. How it was served, what the planner asked Kairos for (range_needed, the chunk plan), how
+    much came back, and where the time went, phase by phase (see tscached.timing).
+    Entries are JSON, newest first, in one Redis list shared by every worker, trimmed to max_entries.
+    GET /api/maintenance/slowlog reads them.
+"""
+
+
+SLOWLOG_KEY = 'tscached:slowlog'
+
+
+def settings(config):
+    slowlog_config = config.get('slow_query_log', {})
+    return {
+        'enabled': slowlog_config.get('enabled', False),
+        'threshold': slowlog_config.get('threshold', 1.0),
+        'max_entries': slowlog_config.get('max_entries', 1000),
+    }
+
+
+def entry(time_range, kquery, mode, response, kquery_timings, now=None):
+    """ One slow-query log entry.
+        :param time_range: dict, the request's time range; see utils.populate_time_range.
+        :param kquery: kquery.KQuery
+        :param mode: str, cache mode it was served with.
+        :param response: dict, its response; with keys results and sample_size.
+        :param kquery_timings: dict, its entry in timing.Timings.kqueries.
+        :param now: float, unix timestamp; optional, for testing.
+        :return: dict
+    """
+    return {
+        'ts': round(now or time.time(), 3),
+        'key': kquery.get_key(),
+        'mode': mode,
+        'query': query_of(kquery),
+        'time_range': time_range,
+        'range_needed': kquery_timings.get('range_needed'),  # [start, end (unix seconds), fetch type]
+        'chunks': kquery_timings.get('chunks'),  # [[start, end (unix seconds)], ...] asked of Kairos
+        'kairos_chunks_ms': kquery_timings.get('kairos_chunks_ms'),
+        'mts': len(response.get('results', [])),
+        'points': response.get('sample_size', 0),
+        'total_ms': kquery_timings.get('total_ms'),
+        'phases_ms': dict((name, round(secs * 1000, 3)) for name, secs in kquery_timings['phases'].iteritems()),
+    }
+
+
+def record(config, redis_client, time_range, kqueries, timings):
+    """ Log the KQueries of a request that were slow, if the slow-query log is enabled. Never raises.
+        :param config: dict, 'tscached' level from config file.
+        :param redis_client: redis.StrictRedis
+        :param time_range: dict, the request's time range.
+        :param kqueries: list of 3-tuples (kquery.KQuery, str cache mode, dict KQuery response).
+        :param timings: timing.Timings, of the same request; its kqueries line up with the above.
+        :return: int, number of entries logged.
+    """
+    try:
+        params = settings(config)
+        if not params['enabled']:
+            return 0
+        threshold_ms = params['threshold'] * 1000
+        slow = [entry(time_range, kquery, mode, response, kquery_timings)
+                for (kquery, mode, response), kquery_timings in zip(kqueries, timings.kqueries)
+                if kquery_timings.get('total_ms', 0) >= threshold_ms]
+        if not slow:
+            return 0
+        pipeline = redis_client.pipeline()
+        for line in slow:
+            pipeline.lpush(SLOWLOG_KEY, json.dumps(line, separators=(',', ':')))
+        pipeline.ltrim(SLOWLOG_KEY, 0, params['max_entries'] - 1)
+        instrumentation.execute(pipeline, 'slowlog')
+    except redis.exceptions.RedisError as e:
+        logging.error('RedisError: ' + e.message)
+        return 0
+    except (AttributeError, KeyError, TypeError, ValueError) as e:  # say, a timings entry missing its phases.
+        logging.error('Slow-query log failed: %s' % e)
+        return 0
+    for line in slow:
+        logging.info('Slow KQuery (%.1f ms, %s): %s' % (line['total_ms'], line['mode'], line['key']))
+    return len(slow)
+
+
+def read(redis_client, count=100):
+    """ :param count: int, at most this many entries; at least 1.
+        :return: list of dict, newest first.
+        :raise: redis.exceptions.RedisError
+    """
+    return [json.loads(line) for line in redis_client.lrange(SLOWLOG_KEY, 0, count - 1)]
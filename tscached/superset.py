@@ -0,0 +1,199 @@
+import datetime
+import logging
+
+from tscached.keys import canonical_json
+from tscached.kquery import KQuery
+from tscached.mts import group_values
+from tscached.mts import MTS
+from tscached.normalize import normalize_query
+from tscached.normalize import normalize_tags
+from tscached.utils import create_key
+from tscached.utils import get_needed_absolute_time_range
+from tscached.utils import get_range_needed
+
+
+"""
+    Serving tag-filtered queries from cached group_by queries. A KQuery that groups by tag has one MTS per
+    group, so a request that is the same query but filters to some of those groups can be answered by picking
+    MTS out of it. e.g. {host: [web1]} grouped by host, from {} grouped by host.
+    Cached KQueries are indexed by everything but their tag filter, in Redis sets named tscached:superset:HASH.
+"""
+
+
+# Written into a KQuery's stored query by KQuery.upsert and friends; not part of its meaning.
+BOOKKEEPING_FIELDS = ['mts_keys', 'mts_groups', 'last_add_data', 'earliest_data', 'refs_until', 'values']
+
+
+def enabled(config):
+    return config.get('superset', {}).get('enabled', False)
+
+
+def tag_group_names(query):
+    """ Names of the tags a query groups by; empty if it has no tag grouper. """
+    names = set()
+    for group in query.get('group_by', []) or []:
+        if group.get('name') == 'tag':
+            names.update(group.get('tags', []))
+    return names
+
+
+def index_key(query):
+    """ Redis key of the set of cached KQueries that differ from this one only in their tag filter.
+        :param query: dict, a KQuery's query.
+        :return: str, tscached:superset:HASH
+    """
+    basis = normalize_query(dict((k, v) for k, v in query.iteritems()
+                                 if k != 'tags' and k not in BOOKKEEPING_FIELDS))
+    return create_key(canonical_json(basis), 'superset')
+
+
+def index_kquery(config, redis_client, kquery):
+    """ Make a freshly written KQuery findable as a superset. Only tag-grouped KQueries qualify.
+        :param config: dict, 'tscached' level from config file.
+        :param redis_client: redis.StrictRedis
+        :param kquery: kquery.KQuery object, already upserted.
+        :return: void
+        :raise: redis.exceptions.RedisError
+    """
+    if not enabled(config) or not tag_group_names(kquery.query):
+        return
+    key = index_key(kquery.query)
+    pipeline = redis_client.pipeline()
+    pipeline.sadd(key, kquery.get_key())
+    pipeline.expire(key, kquery.expiry)
+    pipeline.execute()
+
+
+def covers(cached_query, query):
+    """ Does cached_query return (at least) every series query would, each one exactly as query would?
+        Both are assumed to match in everything but their tag filters; see index_key.
+        :param cached_query: dict, the candidate superset.
+        :param query: dict, the query to be answered.
+        :return: boolean
+    """
+    cached_tags = normalize_tags(cached_query.get('tags', {}))
+    tags = normalize_tags(query.get('tags', {}))
+    grouped = tag_group_names(cached_query)
+
+    for name in cached_tags:
+        if name not in tags:  # the cached query filters on something we don't.
+            return False
+    for name, values in tags.iteritems():
+        if cached_tags.get(name) == values:
+            continue
+        # A narrower filter only picks out whole MTS if every MTS has a single value for this tag.
+        if name not in grouped:
+            return False
+        if name in cached_tags and not set(values).issubset(cached_tags[name]):
+            return False
+    return True
+
+
+def selects(result, tags):
+    """ Would a query with this tag filter return the MTS with this result?
+        :param result: dict, an MTS result.
+        :param tags: dict, normalized tag filter.
+        :return: boolean
+    """
+    groups = group_values(result)
+    for name, values in tags.iteritems():
+        present = [groups[name]] if name in groups else result.get('tags', {}).get(name, [])
+        if not present or not set(present).issubset(values):
+            return False
+    return True
+
+
+def choose_mts_keys(cached_query, tags):
+    """ Which of a superset's MTS would a query with this tag filter return? Decided from the group values
+        stored alongside mts_keys (see KQuery.upsert), so only those MTS need loading. Where they can't tell
+        (no stored groups, or a filtered tag that isn't grouped and differs from the superset's filter), the
+        MTS is loaded anyway and checked with selects().
+        :param cached_query: dict, the superset's stored query.
+        :param tags: dict, normalized tag filter.
+        :return: tuple, (list of str: MTS keys to load, in order; set of str: those still to check).
+    """
+    mts_keys = cached_query.get('mts_keys', [])
+    mts_groups = cached_query.get('mts_groups')
+    if not mts_groups or len(mts_groups) != len(mts_keys):
+        return mts_keys, set(mts_keys)
+
+    cached_tags = normalize_tags(cached_query.get('tags', {}))
+    wanted = []
+    unsure = set()
+    for mts_key, groups in zip(mts_keys, mts_groups):
+        for name, values in tags.iteritems():
+            if name in groups:
+                if groups[name] not in values:
+                    break
+            elif cached_tags.get(name) != values:  # the superset's own filter passes every MTS it has.
+                unsure.add(mts_key)
+        else:
+            wanted.append(mts_key)
+    return wanted, unsure
+
+
+def find_superset(redis_client, kquery):
+    """ Find a cached KQuery that covers this one. Index entries for expired KQueries are dropped.
+        :param redis_client: redis.StrictRedis
+        :param kquery: kquery.KQuery object
+        :return: kquery.KQuery (from cache) or None.
+        :raise: redis.exceptions.RedisError
+    """
+    if not tag_group_names(kquery.query):
+        return None
+    key = index_key(kquery.query)
+    members = list(redis_client.smembers(key))
+    if not members:
+        return None
+
+    found = None
+    alive = set()
+    for candidate in KQuery.from_cache(members, redis_client):
+        alive.add(candidate.redis_key)
+        if not found and candidate.redis_key != kquery.get_key() and covers(candidate.query, kquery.query):
+            found = candidate
+
+    expired = [member for member in members if member not in alive]
+    if expired:
+        redis_client.srem(key, *expired)
+    return found
+
+
+def serve_from_superset(config, redis_client, kquery, kairos_time_range):
+    """ Answer a KQuery from a HOT cached superset, without asking Kairos.
+        :param config: dict, 'tscached' level from config file.
+        :param redis_client: redis.StrictRedis
+        :param kquery: kquery.KQuery object, not in the cache itself.
+        :param kairos_time_range: dict, time range from HTTP request payload
+        :return: dict, with keys sample_size (int) and results (list of dicts); or None if no HOT superset
+                 with matching MTS exists.
+        :raise: redis.exceptions.RedisError
+    """
+    if not enabled(config):
+        return None
+    superset = find_superset(redis_client, kquery)
+    if not superset:
+        return None
+
+    try:
+        start_cache = superset.query['earliest_data']
+        end_cache = superset.query['last_add_data']
+    except KeyError:
+        return None
+    start_request, end_request = get_needed_absolute_time_range(kairos_time_range)
+    if get_range_needed(start_request, end_request, datetime.datetime.fromtimestamp(float(start_cache)),
+                        datetime.datetime.fromtimestamp(float(end_cache)),
+                        config['data']['staleness_threshold'], kquery.window_size):
+        logging.debug('Superset %s is not HOT for %s' % (superset.redis_key, kquery.get_key()))
+        return None
+
+    tags = normalize_tags(kquery.query.get('tags', {}))
+    response_kquery = {'results': [], 'sample_size': 0}
+    wanted, unsure = choose_mts_keys(superset.query, tags)
+    for mts in MTS.from_cache(wanted, redis_client):
+        if mts.get_key() not in unsure or selects(mts.result, tags):
+            response_kquery = mts.build_response(kairos_time_range, response_kquery)
+    if not response_kquery['results']:
+        return None
+    logging.info('KQuery %s served from superset %s' % (kquery.get_key(), superset.redis_key))
+    return response_kquery
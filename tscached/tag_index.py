@@ -0,0 +1,156 @@
+import logging
+import time
+
+import simplejson as json
+
+from tscached.normalize import normalize_tags
+from tscached.superset import covers
+from tscached.superset import selects
+from tscached.utils import get_needed_absolute_time_range
+from tscached.utils import populate_time_range
+
+
+"""
+    Answering /api/v1/datapoints/query/tags from the cache. Every MTS we write already knows its tags, so
+    per metric we keep two Redis hashes:
+    - tscached:tag_index:METRIC, MTS key -> {tags, group_by} of that MTS.
+    - tscached:tag_coverage:METRIC, KQuery key -> {tags, group_by, earliest, last, mts_keys} of that KQuery.
+    A tags query can be answered locally when a KQuery on its metric was refreshed recently, reaches back far
+    enough, does not reach past the query's end (if it has one), and selects (at least) the same series;
+    see superset.covers. Tags are unioned as chunks of a series are merged (see mts.merge_tags).
+"""
+
+
+TAG_INDEX_PREFIX = 'tscached:tag_index:'
+COVERAGE_PREFIX = 'tscached:tag_coverage:'
+
+
+def enabled(config):
+    return config.get('tag_index', {}).get('enabled', False)
+
+
+def record_tags(config, redis_client, kquery, index_mts=True):
+    """ Index the tags of a freshly written KQuery's MTS.
+        :param config: dict, 'tscached' level from config file.
+        :param redis_client: redis.StrictRedis
+        :param kquery: kquery.KQuery object, already upserted; related_mts hold their results.
+        :param index_mts: bool, (re-)index each MTS' tags too; without it, only the KQuery's coverage is updated.
+        :return: void
+        :raise: redis.exceptions.RedisError
+    """
+    name = kquery.query.get('name')
+    if not enabled(config) or not name:
+        return
+
+    pipeline = redis_client.pipeline()
+    mts_keys = []
+    for mts in kquery.related_mts:
+        if not mts.result:
+            continue
+        mts_keys.append(mts.get_key())
+        if index_mts:
+            pipeline.hset(TAG_INDEX_PREFIX + name, mts.get_key(),
+                          json.dumps({'tags': mts.result.get('tags', {}),
+                                      'group_by': mts.result.get('group_by', [])}))
+    coverage = {'tags': kquery.query.get('tags', {}), 'group_by': kquery.query.get('group_by', []),
+                'earliest': kquery.query.get('earliest_data'), 'last': kquery.query.get('last_add_data'),
+                'mts_keys': mts_keys}
+    pipeline.hset(COVERAGE_PREFIX + name, kquery.get_key(), json.dumps(coverage))
+    pipeline.expire(TAG_INDEX_PREFIX + name, kquery.expiry)
+    pipeline.expire(COVERAGE_PREFIX + name, kquery.expiry)
+    pipeline.execute()
+
+
+def find_coverage(config, redis_client, metric, start, now=None, end=None):
+    """ A recently refreshed KQuery on this metric, reaching back to start (and, given an end, not reaching past
+        it, or its tags might include series that only showed up later), that covers the metric query.
+        Coverage that has aged out is forgotten, along with MTS no longer covered by anything.
+        :param config: dict, 'tscached' level from config file.
+        :param redis_client: redis.StrictRedis
+        :param metric: dict, one member of a tags query's 'metrics' list.
+        :param start: int, unix timestamp the tags query starts at.
+        :param now: int, unix timestamp; optional, for testing.
+        :param end: int, unix timestamp the tags query ends at; None if it runs up to now.
+        :return: dict, coverage entry; or None.
+        :raise: redis.exceptions.RedisError
+    """
+    if not now:
+        now = int(time.time())
+    max_age = config.get('tag_index', {}).get('max_age', 300)
+    key = COVERAGE_PREFIX + metric['name']
+
+    found = None
+    live_keys = set()
+    aged = {}
+    for kquery_key, raw in redis_client.hgetall(key).iteritems():
+        entry = json.loads(raw)
+        if not entry.get('last') or entry['last'] < now - max_age:
+            aged[kquery_key] = entry
+            continue
+        live_keys.update(entry['mts_keys'])
+        if (not found and entry.get('earliest') is not None and entry['earliest'] <= start and
+                (end is None or entry['last'] <= end) and covers(entry, metric)):
+            found = entry
+
+    if aged:
+        redis_client.hdel(key, *aged.keys())
+        dropped = set()
+        for entry in aged.values():
+            dropped.update(entry['mts_keys'])
+        dropped -= live_keys
+        if dropped:
+            redis_client.hdel(TAG_INDEX_PREFIX + metric['name'], *dropped)
+    return found
+
+
+def answer_metric(config, redis_client, metric, start, now=None, end=None):
+    """ Kairos' query/tags result for one metric, from the index.
+        :return: dict, {name, tags, values}; or None if the index can't answer.
+        :raise: redis.exceptions.RedisError
+    """
+    coverage = find_coverage(config, redis_client, metric, start, now, end)
+    if not coverage:
+        return None
+
+    tags = normalize_tags(metric.get('tags', {}))
+    found = {}
+    if coverage['mts_keys']:
+        for raw in redis_client.hmget(TAG_INDEX_PREFIX + metric['name'], coverage['mts_keys']):
+            if not raw:
+                return None  # index incomplete; let Kairos answer.
+            entry = json.loads(raw)
+            if not selects(entry, tags):
+                continue
+            for tag_name, values in entry.get('tags', {}).iteritems():
+                found.setdefault(tag_name, set()).update(values)
+    return {'name': metric['name'], 'tags': dict((k, sorted(v)) for k, v in found.iteritems()), 'values': []}
+
+
+def answer_tags_query(config, redis_client, payload, now=None):
+    """ Answer a whole /api/v1/datapoints/query/tags request from the index, or not at all.
+        :param config: dict, 'tscached' level from config file.
+        :param redis_client: redis.StrictRedis
+        :param payload: dict, the request body.
+        :param now: int, unix timestamp; optional, for testing.
+        :return: dict, the response Kairos would give; or None if any metric can't be answered.
+        :raise: redis.exceptions.RedisError
+    """
+    time_range = populate_time_range(payload)
+    if not enabled(config) or not payload.get('metrics'):
+        return None
+    if not time_range.get('start_absolute') and not time_range.get('start_relative'):
+        return None
+    start, end = get_needed_absolute_time_range(time_range)
+    start = int(start.strftime('%s'))
+    end = int(end.strftime('%s')) if end else None
+
+    queries = []
+    for metric in payload['metrics']:
+        if not metric.get('name'):
+            return None
+        result = answer_metric(config, redis_client, metric, start, now, end)
+        if result is None:
+            logging.debug('Tag index cannot answer for %s' % metric['name'])
+            return None
+        queries.append({'results': [result]})
+    return {'queries': queries}
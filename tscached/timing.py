@@ -0,0 +1,137 @@
+import contextlib
+import threading
+import time
+
+
+"""
+    Where did the time go? A per-request breakdown by phase, collected on the request's own thread.
+    handle_query starts a collector; code along the way wraps its work in phase('name'), which is a no-op on
+    threads with no collector (readahead, background revalidation). The totals go out as a Server-Timing
+    header, and, if the 'timing' config allows it and the client asks, as a verbose per-KQuery debug payload.
+"""
+
+
+CACHE_LOOKUP = 'cache_lookup'  # Redis GETs of KQueries and MTS, and parsing them
+SUPERSET = 'superset'  # looking for, and serving from, a cached superset of a KQuery
+PLAN = 'plan'  # get_range_needed and friends: what do we need from Kairos?
+KAIROS = 'kairos'  # waiting on Kairos, all chunks
+MERGE = 'merge'  # stitching chunks and cached MTS together
+BUILD_RESPONSE = 'build_response'  # trimming MTS and assembling each KQuery's response
+CACHE_WRITE = 'cache_write'  # writing MTS and KQueries back, and the indexes that go with them
+SERIALIZE = 'serialize'  # encoding (and compressing) the HTTP response
+
+DEBUG_HEADER = 'X-tscached-debug'
+
+local = threading.local()
+
+
+class Timings(object):
+    """ Phase timings of one HTTP request, overall and per KQuery. """
+
+    def __init__(self):
+        self.started = time.time()
+        self.totals = {}  # phase -> [seconds, count]
+        self.order = []  # phases, in the order first seen
+        self.kqueries = []  # one dict per KQuery: key, mode, phases, and whatever was noted
+        self.kquery = None  # the entry of the KQuery being handled right now
+        self.kquery_started = None
+
+    def add(self, name, seconds):
+        if name not in self.totals:
+            self.totals[name] = [0, 0]
+            self.order.append(name)
+        self.totals[name][0] += seconds
+        self.totals[name][1] += 1
+        if self.kquery is not None:
+            self.kquery['phases'][name] = self.kquery['phases'].get(name, 0) + seconds
+
+    def begin_kquery(self, key):
+        self.kquery = {'key': key, 'phases': {}}
+        self.kqueries.append(self.kquery)
+        self.kquery_started = time.time()
+
+    def end_kquery(self, mode):
+        if self.kquery is not None:
+            self.kquery['mode'] = mode
+            self.kquery['total_ms'] = round((time.time() - self.kquery_started) * 1000, 3)
+        self.kquery = None
+
+    def note(self, name, value):
+        """ Attach a detail (chunk timings, say) to the current KQuery. """
+        if self.kquery is not None:
+            self.kquery[name] = value
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def server_timing(self):
+        """ :return: str, value for a Server-Timing header. Durations are in milliseconds. """
+        entries = ['%s;dur=%.1f' % (name, self.totals[name][0] * 1000) for name in self.order]
+        entries.append('total;dur=%.1f' % (self.elapsed() * 1000))
+        return ', '.join(entries)
+
+    def debug_payload(self):
+        """ :return: dict, everything collected; durations in milliseconds. """
+        kqueries = []
+        for entry in self.kqueries:
+            entry = dict(entry)
+            entry['phases'] = dict((name, round(secs * 1000, 3)) for name, secs in entry['phases'].iteritems())
+            kqueries.append(entry)
+        return {
+            'total_ms': round(self.elapsed() * 1000, 3),
+            'phases': dict((name, {'ms': round(secs * 1000, 3), 'count': count})
+                           for name, (secs, count) in self.totals.iteritems()),
+            'kqueries': kqueries,
+        }
+
+
+def start():
+    """ Begin collecting for the request on this thread, replacing any earlier collector.
+        :return: Timings
+    """
+    local.timings = Timings()
+    return local.timings
+
+
+def stop():
+    local.timings = None
+
+
+def current():
+    """ :return: Timings, or None if nothing is being collected on this thread. """
+    return getattr(local, 'timings', None)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """ Time the enclosed block as (part of) a phase. """
+    timings = current()
+    if timings is None:
+        yield
+        return
+    started = time.time()
+    try:
+        yield
+    finally:
+        timings.add(name, time.time() - started)
+
+
+def note(name, value):
+    timings = current()
+    if timings is not None:
+        timings.note(name, value)
+
+
+def server_timing_enabled(config):
+    return config.get('timing', {}).get('server_timing', False)
+
+
+def debug_requested(config, headers):
+    """ Does the client want the debug payload, and may it have it?
+        :param config: dict, 'tscached' level from config file.
+        :param headers: dict-like, the HTTP request headers.
+        :return: boolean
+    """
+    if not config.get('timing', {}).get('debug', False):
+        return False
+    return headers.get(DEBUG_HEADER, '').lower() in ['1', 'true', 'yes']
@@ -1,11 +1,16 @@
 import datetime
-import hashlib
 import logging
 import math
+import time
 
 import requests
 import simplejson as json
 
+from tscached import circuit
+from tscached import compression
+from tscached import instrumentation
+from tscached import keys
+
 
 # note: this doesn't work perfectly for months (31 days) or years (365 days)
 SECONDS_IN_UNIT = {
@@ -20,6 +25,19 @@ SECONDS_IN_UNIT = {
                   }
 
 
+# query bodies larger than this (bytes) are sent to Kairos gzipped; None to never. see configure_requests.
+gzip_requests_over = None
+
+
+def configure_requests(config):
+    """ Set up how we talk to Kairos. Call once per process at startup.
+        :param config: dict, 'tscached' level from config file.
+        :return: void
+    """
+    global gzip_requests_over
+    gzip_requests_over = config.get('kairosdb', {}).get('gzip_requests_over')
+
+
 # constants used in get_range_needed
 FETCH_BEFORE = 'prepend'
 FETCH_AFTER = 'append'
@@ -31,6 +49,13 @@ class BackendQueryFailure(requests.exceptions.RequestException):
     pass
 
 
+class KairosUnavailable(BackendQueryFailure):
+    """ Raised when we did not ask KairosDB at all: its circuit is open, or too many requests are in flight.
+        Says nothing about the query itself, so it is not remembered as a negative entry.
+    """
+    pass
+
+
 def setup_logging():
     logger = logging.getLogger()
     handler = logging.StreamHandler()
@@ -46,34 +71,79 @@ def get_timedelta(value):
     return datetime.timedelta(seconds=seconds)
 
 
-def query_kairos(kairos_host, kairos_port, query, propagate=True):
-    """ As the name states.
+def query_kairos(kairos_host, kairos_port, query, propagate=True, reserved=False):
+    """ As the name states. Guarded by the circuit breaker and in-flight limit (see tscached.circuit).
         :param kairos_host: str, host/fqdn of kairos server. commonly a load balancer.
         :param kairos_port: int, port that kairos (or a proxy) listens on.
         :param query: dict to send to kairos.
         :param propagate: bool, should we raise (or swallow) exceptions.
-        :return: dict containing kairos' response.
-        :raise: BackendQueryFailure if the operation doesn't succeed.
+        :param reserved: bool, has the caller already taken an in-flight slot for this request (and will
+                         release it)?
+        :return: dict containing kairos' response. Swallowed errors are dicts with keys status_code and error,
+                 and unavailable if KairosDB was not asked at all.
+        :raise: BackendQueryFailure if the operation doesn't succeed; KairosUnavailable if it was not attempted.
     """
+    def _unavailable(message):
+        if propagate:
+            raise KairosUnavailable(message)
+        return {'status_code': 503, 'error': message, 'unavailable': True}
+
+    # Take a slot first: a request the breaker lets through (maybe as its trial) must get to report back.
+    taken = 0
+    if circuit.in_flight and not reserved:
+        taken = circuit.in_flight.acquire()
+        if not taken:
+            logging.error('Shedding load: too many in-flight KairosDB requests')
+            return _unavailable('Too many in-flight KairosDB requests')
+
+    if not circuit.breaker.allow():
+        if taken:
+            circuit.in_flight.release(taken)
+        return _unavailable('KairosDB circuit breaker is open; not sending query')
+
+    kwargs = {}
+    if circuit.request_timeout:
+        kwargs['timeout'] = circuit.request_timeout
+
+    # Ask for a gzipped response; requests inflates it. Large query bodies may be gzipped on the way out.
+    headers = {'Accept-Encoding': 'gzip'}
+    data = json.dumps(query)
+    if gzip_requests_over and len(data) > gzip_requests_over:
+        data = compression.compress(data, compression.GZIP)
+        headers['Content-Encoding'] = compression.GZIP
+
+    started = time.time()
     try:
         url = 'http://%s:%s/api/v1/datapoints/query' % (kairos_host, kairos_port)
-        r = requests.post(url, data=json.dumps(query))
-        value = json.loads(r.text)
+        r = requests.post(url, data=data, headers=headers, **kwargs)
+        # Client errors (a malformed query, say) say nothing about Kairos health.
+        circuit.breaker.record(r.status_code / 100 != 5, time.time() - started)
+        instrumentation.observe('tscached_kairos_request_seconds', time.time() - started,
+                                outcome='success' if r.status_code / 100 == 2 else 'error')
+        # Parse the raw (UTF-8) bytes: r.text would first guess at a charset and decode the whole body.
+        value = json.loads(r.content)
         if r.status_code / 100 != 2:
             message = ', '.join(value.get('errors', ['No message given']))
             if propagate:
                 raise BackendQueryFailure('KairosDB responded %d: %s' % (r.status_code, message))
             return {'status_code': r.status_code, 'error': message}
         return value
+    except BackendQueryFailure:
+        raise
     except requests.exceptions.RequestException as e:
+        circuit.breaker.record(False, time.time() - started)
+        instrumentation.observe('tscached_kairos_request_seconds', time.time() - started, outcome='unreachable')
         if propagate:
             raise BackendQueryFailure('Could not connect to KairosDB: %s' % e.message)
         return {'status_code': 500, 'error': e.message}
+    finally:
+        if taken:
+            circuit.in_flight.release(taken)
 
 
 def create_key(data, tipo):
-    """ data should be hashable (str, usually). tipo is str. """
-    genHash = hashlib.md5(data).hexdigest()
+    """ data should be hashable (str, usually). tipo is str. The hash is chosen in keys.configure. """
+    genHash = keys.digest(data)
     key = "tscached:%s:%s" % (tipo, genHash)
     return key
 
@@ -117,16 +187,18 @@ def get_needed_absolute_time_range(time_range, now=None):
     return (start, end)
 
 
-def get_chunked_time_ranges(config, time_range):
+def get_chunked_time_ranges(config, time_range, now=None):
     """ Given a long kairos range, return N timestamp pairs so we can parallelize COLD calls (new->old).
         This implements up to second precision.
         :param config: dict, top-level tscached config.
         :param time_range: dict, generated by populate_time_range containing kairos-formatted keys.
+        :param now: datetime.datetime, optional. set to remove drift in time, or to replay the past.
         :return: list of 2-tuples of datetime.datetimes
     """
     chunk_length = config['chunking'].get('chunk_length', 3600)  # 1 hour default
     num_chunks = config['chunking'].get('max_chunks', 6)
-    now = datetime.datetime.now()
+    if not now:
+        now = datetime.datetime.now()
 
     start_time, end_time = get_needed_absolute_time_range(time_range, now)
     if not end_time: